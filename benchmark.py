@@ -0,0 +1,453 @@
+import io
+import sys
+import glob
+import json
+import time
+import platform
+import atexit
+import argparse
+import contextlib
+import numpy as np
+from nexcsi import decoder
+from csi_stream import DecoderSession, PcapStreamParser, iter_pcap_frames
+
+device = 'raspberrypi'
+DEFAULT_BASELINE = 'benchmark_baseline.json'
+DEFAULT_OUTPUT = 'benchmark.json'
+
+# ベンチマーク名 -> 関数 の対応表
+BENCHMARKS = {}
+
+
+def register_benchmark(name):
+    """
+    ベンチマークを登録するデコレータ
+
+    登録する関数は (データ, オプション) を受け取り、(処理した件数, 計測する関数) を返す。
+    計測する関数は引数なしで呼ばれ、1件ごとの所要時間のリストを返してもよい
+    (返した場合は1件あたりのレイテンシのパーセンタイルも記録する)。
+    """
+    def decorator(func):
+        BENCHMARKS[name] = func
+        return func
+    return decorator
+
+
+class BenchmarkData:
+    """
+    各ベンチマークで使い回す入力データ (pcapの読み込みは計測に含めない)
+    """
+    def __init__(self, pcap_paths):
+        self.pcap_paths = pcap_paths
+        self.samples = [decoder(device).read_pcap(path) for path in pcap_paths]
+        self.csi = [np.asarray(decoder(device).unpack(s['csi'])) for s in self.samples]
+        self.amplitude = [np.abs(csi) for csi in self.csi]
+
+    @property
+    def n_packets(self):
+        return sum(len(s) for s in self.samples)
+
+
+def _quiet():
+    # 検出器はパケットごとに print するので計測中は捨てる
+    return contextlib.redirect_stdout(io.StringIO())
+
+
+@register_benchmark('read_pcap')
+def bench_read_pcap(data, options):
+    def run():
+        for path in data.pcap_paths:
+            decoder(device).read_pcap(path)
+    return data.n_packets, run
+
+
+@register_benchmark('pcap_loader.read_pcap')
+def bench_loader_read_pcap(data, options):
+    """
+    メモリマップによる一括読み込み (read_pcap と同じ構造化配列)
+    """
+    import pcap_loader
+
+    def run():
+        for path in data.pcap_paths:
+            pcap_loader.read_pcap(path)
+    return data.n_packets, run
+
+
+@register_benchmark('pcap_loader.load_csi')
+def bench_loader_load_csi(data, options):
+    """
+    pcapからCSIの complex64 配列まで (read_pcap + unpack に相当)
+    """
+    import pcap_loader
+
+    def run():
+        for path in data.pcap_paths:
+            pcap_loader.load_csi(path, device)
+    return data.n_packets, run
+
+
+@register_benchmark('unpack')
+def bench_unpack(data, options):
+    def run():
+        for samples in data.samples:
+            decoder(device).unpack(samples['csi'])
+    return data.n_packets, run
+
+
+@register_benchmark('stream_decode')
+def bench_stream_decode(data, options):
+    """
+    csi_stream によるライブ用のパケット単位のデコード
+    """
+    def run():
+        for path in data.pcap_paths:
+            with open(path, 'rb') as f:
+                for _ in iter_pcap_frames(f, device):
+                    pass
+    return data.n_packets, run
+
+
+@register_benchmark('decoder_session.decode_into')
+def bench_decoder_session(data, options):
+    """
+    DecoderSession で1パケットずつ確保済みの配列にデコードする (pcapの解析は含まない)
+    """
+    packets = []
+    for path in data.pcap_paths:
+        parser = PcapStreamParser(device)
+        with open(path, 'rb') as f:
+            parser.feed(f.read())
+        packets.extend(bytes(packet) for _, packet in parser.iter_records())
+    session = DecoderSession(device)
+
+    def run():
+        latencies = []
+        for packet in packets:
+            start = time.perf_counter()
+            session.decode_into(packet)
+            latencies.append(time.perf_counter() - start)
+        return latencies
+    return data.n_packets, run
+
+
+@register_benchmark('shm_pipeline.SharedRingBuffer')
+def bench_shared_ring(data, options):
+    """
+    共有メモリのリングバッファへの書き込みと、読み出し側のコピー・上書きの確認 (同じプロセス内)
+    """
+    from shm_pipeline import SharedRingBuffer
+    frames = [frame for csi in data.csi for frame in csi]
+    ring = SharedRingBuffer.create(len(frames), frames[0].shape[-1])
+    atexit.register(ring.close)
+
+    def run():
+        latencies = []
+        cursor = ring.count
+        for i, frame in enumerate(frames):
+            start = time.perf_counter()
+            ring.append(frame, i * 0.1)
+            latencies.append(time.perf_counter() - start)
+        ring.read_since(cursor, copy=True)
+        return latencies
+    return len(frames), run
+
+
+def _detect_motion_run(make_detector, data):
+    def run():
+        latencies = []
+        with _quiet():
+            for csi in data.csi:
+                detector = make_detector()
+                for i, frame in enumerate(csi):
+                    start = time.perf_counter()
+                    # 記録時と同じく0.1秒間隔のタイムスタンプを渡す
+                    detector.detect_motion(frame, i * 0.1)
+                    latencies.append(time.perf_counter() - start)
+        return latencies
+    return run
+
+
+@register_benchmark('ras.detect_motion')
+def bench_ras_detect_motion(data, options):
+    from ras import NexmonCSIMotionDetector
+    return data.n_packets, _detect_motion_run(NexmonCSIMotionDetector, data)
+
+
+@register_benchmark('realtime_judge.detect_motion')
+def bench_realtime_judge_detect_motion(data, options):
+    from realtime_judge import NexmonCSIMotionDetector
+    with _quiet():
+        # 参照プロファイルを事前に作っておき、計測に含めない
+        NexmonCSIMotionDetector(standing_pcap=options.standing, sitting_pcap=options.sitting)
+
+    def make_detector():
+        return NexmonCSIMotionDetector(standing_pcap=options.standing, sitting_pcap=options.sitting)
+    return data.n_packets, _detect_motion_run(make_detector, data)
+
+
+@register_benchmark('judges_.label')
+def bench_judges_label(data, options):
+    """
+    judges_ の isStanding / isSitting と同じ参照モデルによるバッチ判定
+    """
+    from judges_ import ReferenceModel
+    standing = ReferenceModel.from_pcap(options.standing)
+    sitting = ReferenceModel.from_pcap(options.sitting)
+
+    def run():
+        for amplitude in data.amplitude:
+            standing.label(amplitude, 3, 1, below=True)
+            sitting.label(amplitude, 8, 2, below=False)
+    return data.n_packets, run
+
+
+@register_benchmark('judges_.label.pca')
+def bench_judges_label_pca(data, options):
+    """
+    ヌル・パイロットを除き、8主成分に射影した特徴量の空間での判定 (射影の時間も含む)
+    """
+    from judges_ import ReferenceModel
+    from features import FeatureStage
+    stage = FeatureStage.from_references([options.standing, options.sitting], n_components=8)
+    standing = ReferenceModel.from_pcap(options.standing, features=stage)
+    sitting = ReferenceModel.from_pcap(options.sitting, features=stage)
+
+    def run():
+        for amplitude in data.amplitude:
+            standing.label(amplitude, 3, 1, below=True)
+            sitting.label(amplitude, 8, 2, below=False)
+    return data.n_packets, run
+
+
+@register_benchmark('features.update')
+def bench_feature_update(data, options):
+    """
+    ライブの検出器でパケットごとに特徴量へ変換する時間 (主成分の逐次更新なし)
+    """
+    from features import FeatureStage
+    stage = FeatureStage.from_references([options.standing, options.sitting], n_components=8)
+
+    def run():
+        latencies = []
+        for amplitude in data.amplitude:
+            for frame in amplitude:
+                start = time.perf_counter()
+                stage.update(frame)
+                latencies.append(time.perf_counter() - start)
+        return latencies
+    return data.n_packets, run
+
+
+@register_benchmark('ras.detect_motion.pca')
+def bench_ras_detect_motion_pca(data, options):
+    """
+    ras の検出器の前段に8主成分への射影を入れた場合
+    """
+    from ras import NexmonCSIMotionDetector
+    from features import FeatureStage
+    stage = FeatureStage.from_references([options.standing, options.sitting], n_components=8)
+    return data.n_packets, _detect_motion_run(lambda: NexmonCSIMotionDetector(features=stage), data)
+
+
+@register_benchmark('templates.classify')
+def bench_templates_classify(data, options):
+    """
+    全pcapをテンプレート (ファイル名の先頭の数字をクラス) にした kNN でのパケットごとの分類
+    """
+    import os
+    from templates import TemplateIndex
+    index = TemplateIndex(method='knn', k=3)
+    for path in data.pcap_paths:
+        index.add_pcap(os.path.basename(path)[0], path, device)
+
+    def run():
+        latencies = []
+        for amplitude in data.amplitude:
+            for frame in amplitude:
+                start = time.perf_counter()
+                index.classify(frame)
+                latencies.append(time.perf_counter() - start)
+        return latencies
+    return data.n_packets, run
+
+
+@register_benchmark('online_stats.AdaptiveBaseline')
+def bench_adaptive_baseline(data, options):
+    """
+    適応的な背景モデルのパケットごとの更新 (判定・ドリフトの計算を含む)
+    """
+    from online_stats import AdaptiveBaseline
+
+    def run():
+        latencies = []
+        for amplitude in data.amplitude:
+            baseline = AdaptiveBaseline(warmup=20)
+            for frame in amplitude:
+                start = time.perf_counter()
+                baseline.update(frame)
+                latencies.append(time.perf_counter() - start)
+        return latencies
+    return data.n_packets, run
+
+
+@register_benchmark('scoring.squared_error')
+def bench_squared_error(data, options):
+    """
+    squarederror.get_squared_error の中身 (参照平均との二乗誤差和)
+    """
+    from scoring import squared_error
+    reference = np.mean(data.amplitude[0], axis=0)
+
+    def run():
+        for amplitude in data.amplitude:
+            squared_error(amplitude, reference)
+    return data.n_packets, run
+
+
+@register_benchmark('presence.batch_presence')
+def bench_batch_presence(data, options):
+    """
+    frequency.ispresent と同じ計算 (frequency.py は読み込み時にpcapを開くので直接は呼ばない)
+    """
+    from presence import batch_presence
+
+    def run():
+        for amplitude in data.amplitude:
+            batch_presence(amplitude)
+    return data.n_packets, run
+
+
+@register_benchmark('presence.streaming')
+def bench_streaming_presence(data, options):
+    from presence import StreamingPresenceDetector
+
+    def run():
+        latencies = []
+        for amplitude in data.amplitude:
+            detector = StreamingPresenceDetector()
+            for frame in amplitude:
+                start = time.perf_counter()
+                detector.update(frame)
+                latencies.append(time.perf_counter() - start)
+        return latencies
+    return data.n_packets, run
+
+
+def run_benchmark(name, data, options):
+    """
+    1つのベンチマークを repeat 回計測し、最速の回の結果を返す
+    1回の計測が min_time 秒に満たない速い処理は、何周かまとめて1回として計測する
+    """
+    n_items, run = BENCHMARKS[name](data, options)
+    start = time.perf_counter()
+    run()  # ウォームアップ
+    loops = max(1, int(options.min_time / max(time.perf_counter() - start, 1e-9)))
+    best = None
+    best_latencies = None
+    for _ in range(options.repeat):
+        start = time.perf_counter()
+        for _ in range(loops):
+            latencies = run()
+        elapsed = (time.perf_counter() - start) / loops
+        if best is None or elapsed < best:
+            best, best_latencies = elapsed, latencies
+    result = {
+        'items': n_items,
+        'seconds': best,
+        'items_per_sec': n_items / best if best > 0 else float('inf'),
+        'us_per_item': best / n_items * 1e6,
+    }
+    if best_latencies:
+        latencies = np.asarray(best_latencies) * 1e6
+        result['latency_p50_us'] = float(np.percentile(latencies, 50))
+        result['latency_p99_us'] = float(np.percentile(latencies, 99))
+        result['latency_max_us'] = float(np.max(latencies))
+    return result
+
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'platform': platform.platform(),
+    }
+
+
+def compare(results, baseline):
+    """
+    各ベンチマークの items_per_sec のベースラインに対する比を返す (1未満なら遅くなった)
+    """
+    return {name: result['items_per_sec'] / baseline[name]['items_per_sec']
+            for name, result in results.items() if name in baseline}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='デコード・特徴量・判定の処理速度を計測し、ベースラインと比較する')
+    parser.add_argument('pcap_dir', nargs='?', default='pcaps', help='入力に使うpcapのディレクトリ')
+    parser.add_argument('-k', '--only', nargs='+', choices=list(BENCHMARKS), default=None,
+                        help='実行するベンチマーク (デフォルトはすべて)')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='繰り返し回数 (最速の回を採用)')
+    parser.add_argument('--min-time', type=float, default=0.2, help='1回の計測の最短時間 (秒)')
+    parser.add_argument('-o', '--output', type=str, default=DEFAULT_OUTPUT, help='結果を書き出すJSON')
+    parser.add_argument('-b', '--baseline', type=str, default=DEFAULT_BASELINE, help='比較するベースラインのJSON')
+    parser.add_argument('-t', '--tolerance', type=float, default=0.5,
+                        help='この割合以上遅くなったら性能低下とみなす')
+    parser.add_argument('--update-baseline', action='store_true', help='結果をベースラインとして保存する')
+    parser.add_argument('--standing', type=str, default='pcaps/101.pcap', help='立位の参照pcap')
+    parser.add_argument('--sitting', type=str, default='pcaps/001.pcap', help='座位の参照pcap')
+    options = parser.parse_args()
+
+    pcap_paths = sorted(glob.glob(f"{options.pcap_dir}/*.pcap"))
+    if not pcap_paths:
+        print(f"{options.pcap_dir} にpcapファイルがありません")
+        sys.exit(1)
+    data = BenchmarkData(pcap_paths)
+    print(f"{len(pcap_paths)} ファイル {data.n_packets} パケット")
+
+    results = {}
+    for name in options.only or BENCHMARKS:
+        results[name] = run_benchmark(name, data, options)
+
+    try:
+        with open(options.baseline) as f:
+            baseline = json.load(f)['results']
+    except (OSError, ValueError, KeyError):
+        baseline = {}
+    ratios = compare(results, baseline)
+    regressions = sorted(name for name, ratio in ratios.items() if ratio < 1 - options.tolerance)
+
+    for name, result in results.items():
+        line = f"{name:<30} {result['items_per_sec']:>12.0f} pkt/s {result['us_per_item']:>10.1f} us/pkt"
+        if 'latency_p99_us' in result:
+            line += f"  p99 {result['latency_p99_us']:.1f} us"
+        if name in ratios:
+            line += f"  ベースライン比 {ratios[name]:.2f}"
+        if name in regressions:
+            line += "  ← 性能低下"
+        print(line)
+
+    report = {
+        'environment': environment(),
+        'pcaps': pcap_paths,
+        'n_packets': data.n_packets,
+        'repeat': options.repeat,
+        'results': results,
+        'baseline_ratios': ratios,
+        'regressions': regressions,
+    }
+    with open(options.output, 'w') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    if options.update_baseline:
+        with open(options.baseline, 'w') as f:
+            json.dump({'environment': report['environment'], 'results': results}, f, indent=2, ensure_ascii=False)
+        print(f"ベースラインを {options.baseline} に保存しました")
+
+    if regressions:
+        print(f"性能低下: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
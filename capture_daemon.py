@@ -0,0 +1,258 @@
+import os
+import queue
+import socket
+import asyncio
+import argparse
+import threading
+from csi_stream import PcapStreamParser
+from fusion import encode_frame, decode_frame, LENGTH_PREFIX
+
+DEFAULT_SOCKET = '/tmp/csi_capture.sock'
+
+
+class Subscription:
+    """
+    購読者ごとの上限付きキュー
+    キューがいっぱいのときは最も古いフレームを捨てて新しいフレームを入れる
+    """
+    def __init__(self, name, maxsize):
+        self.name = name
+        self.queue = asyncio.Queue(maxsize)
+        self.delivered = 0
+        self.dropped = 0
+
+    def put(self, item):
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(item)
+        self.delivered += 1
+
+    async def get(self):
+        return await self.queue.get()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        item = await self.queue.get()
+        if item is None:
+            raise StopAsyncIteration
+        return item
+
+
+class ThreadSubscription:
+    """
+    別スレッドの購読者 (検出器やプロット) 用の上限付きキュー
+    """
+    def __init__(self, name, maxsize):
+        self.name = name
+        self.queue = queue.Queue(maxsize)
+        self.delivered = 0
+        self.dropped = 0
+
+    def put(self, item):
+        while True:
+            try:
+                self.queue.put_nowait(item)
+                break
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+        self.delivered += 1
+
+    def __iter__(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            yield item
+
+
+class CaptureDaemon:
+    """
+    キャプチャとデコードを1か所で行い、デコード済みフレームを全購読者に配る
+
+    tcpdumpは1つだけ起動し、各フレームは1回だけデコードする。購読者は
+    同じプロセス内(asyncio/スレッド)でも、Unixドメインソケット経由の別プロセスでもよく、
+    それぞれが自分の上限付きキューを持つので、遅い購読者が他を止めることはない。
+    """
+    def __init__(self, interface='wlan0', capture_filter='dst port 5500', device='raspberrypi',
+                 socket_path=DEFAULT_SOCKET, queue_size=256, command=None):
+        self.interface = interface
+        self.capture_filter = capture_filter
+        self.socket_path = socket_path
+        self.queue_size = queue_size
+        self.command = command or (['sudo', 'tcpdump', '-i', interface, '-U', '-w', '-'] + capture_filter.split())
+        self.parser = PcapStreamParser(device)
+        self.subscribers = []
+        self.loop = None
+        self.process = None
+        self.server = None
+        self.seq = 0
+        self._stopped = None
+        self._client_tasks = set()
+
+    def subscribe(self, name='subscriber', maxsize=None):
+        """
+        asyncioの購読者を登録する (イベントループ内から呼ぶ)
+        キューには (通し番号, タイムスタンプ, CSI) が入る
+        """
+        subscription = Subscription(name, maxsize or self.queue_size)
+        self.subscribers.append(subscription)
+        return subscription
+
+    def subscribe_threadsafe(self, name='subscriber', maxsize=None):
+        """
+        別スレッドの購読者を登録する
+        キューには (通し番号, タイムスタンプ, CSI) が入る
+        """
+        subscription = ThreadSubscription(name, maxsize or self.queue_size)
+        self.subscribers.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        if subscription in self.subscribers:
+            self.subscribers.remove(subscription)
+            subscription.put(None)
+
+    def publish(self, timestamp, csi_frame):
+        # 全購読者で同じ配列を共有するので書き換えられないようにしておく
+        csi_frame.flags.writeable = False
+        # 通し番号はキャプチャしたフレームごとに1つ振る。どの購読者にも同じ番号が届くので、
+        # 購読者は番号の飛びから自分のキューで捨てられたフレームの数がわかる
+        item = (self.seq, timestamp, csi_frame)
+        self.seq += 1
+        for subscription in list(self.subscribers):
+            subscription.put(item)
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        if self.socket_path:
+            await self._start_socket_server()
+
+        self.process = await asyncio.create_subprocess_exec(
+            *self.command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+        print(f"キャプチャデーモンを開始しました: {' '.join(self.command)}")
+        try:
+            while not self._stopped.is_set():
+                data = await self.process.stdout.read(1 << 16)
+                if not data:
+                    break
+                self.parser.feed(data)
+                for timestamp, csi_frame in self.parser.iter_frames():
+                    self.publish(timestamp, csi_frame)
+        finally:
+            await self._shutdown()
+
+    def stop(self):
+        """
+        別スレッドからでも呼べる停止要求
+        """
+        if self.loop is not None and self._stopped is not None:
+            self.loop.call_soon_threadsafe(self._stopped.set)
+            if self.process is not None and self.process.returncode is None:
+                self.loop.call_soon_threadsafe(self.process.terminate)
+
+    async def _shutdown(self):
+        if self.process is not None and self.process.returncode is None:
+            self.process.terminate()
+            await self.process.wait()
+        for subscription in list(self.subscribers):
+            self.unsubscribe(subscription)
+        # ソケットの購読者がキューに残ったフレームを送り終えるのを待つ
+        if self._client_tasks:
+            await asyncio.wait(self._client_tasks, timeout=2)
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+    def start_in_thread(self):
+        """
+        デーモンを別スレッドのイベントループで動かす (同じプロセス内の検出器・プロット用)
+        """
+        thread = threading.Thread(target=asyncio.run, args=(self.run(),), daemon=True)
+        thread.start()
+        return thread
+
+    async def _start_socket_server(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self.server = await asyncio.start_unix_server(self._serve_client, path=self.socket_path)
+        print(f"購読用ソケット: {self.socket_path}")
+
+    async def _serve_client(self, reader, writer):
+        subscription = self.subscribe('socket')
+        task = asyncio.current_task()
+        self._client_tasks.add(task)
+        try:
+            async for seq, timestamp, csi_frame in subscription:
+                data = encode_frame(0, seq, timestamp, csi_frame)
+                writer.write(LENGTH_PREFIX.pack(len(data)) + data)
+                await writer.drain()
+        except (ConnectionError, BrokenPipeError):
+            pass
+        finally:
+            self.unsubscribe(subscription)
+            self._client_tasks.discard(task)
+            writer.close()
+
+    def stats(self):
+        stats = self.parser.stats()
+        stats['subscribers'] = [
+            {'name': s.name, 'delivered': s.delivered, 'dropped': s.dropped, 'queued': s.queue.qsize()}
+            for s in self.subscribers
+        ]
+        return stats
+
+
+def iter_socket_frames(socket_path=DEFAULT_SOCKET):
+    """
+    キャプチャデーモンのソケットに接続し、デコード済みの (タイムスタンプ, CSI) を順に返す
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(socket_path)
+    stream = sock.makefile('rb')
+    try:
+        while True:
+            header = stream.read(LENGTH_PREFIX.size)
+            if len(header) < LENGTH_PREFIX.size:
+                return
+            length, = LENGTH_PREFIX.unpack(header)
+            data = stream.read(length)
+            if len(data) < length:
+                return
+            _, _, timestamp, csi_frame = decode_frame(data)
+            yield timestamp, csi_frame
+    finally:
+        stream.close()
+        sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='CSIキャプチャを1か所で行い、複数の購読者に配るデーモン')
+    parser.add_argument('-i', '--interface', type=str, default='wlan0')
+    parser.add_argument('-f', '--filter', type=str, default='dst port 5500', help='tcpdumpのフィルタ')
+    parser.add_argument('-s', '--socket', type=str, default=DEFAULT_SOCKET, help='購読用Unixドメインソケット')
+    parser.add_argument('-q', '--queue-size', type=int, default=256, help='購読者ごとのキューの長さ')
+    parser.add_argument('--replay', type=str, default=None, help='tcpdumpの代わりにpcapファイルを流す (試験用)')
+    args = parser.parse_args()
+
+    command = ['cat', args.replay] if args.replay else None
+    daemon = CaptureDaemon(args.interface, args.filter, socket_path=args.socket,
+                           queue_size=args.queue_size, command=command)
+    try:
+        asyncio.run(daemon.run())
+    except KeyboardInterrupt:
+        pass
+    print(daemon.stats())
+
+
+if __name__ == "__main__":
+    main()
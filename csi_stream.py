@@ -0,0 +1,319 @@
+import struct
+import time
+import numpy as np
+from nexcsi import decoder
+from nexcsi._decoder import raspberrypi, nexus5
+
+# pcapグローバルヘッダ(24バイト)とレコードヘッダ(16バイト)
+PCAP_GLOBAL_HEADER_LEN = 24
+PCAP_RECORD_HEADER_LEN = 16
+
+# Ethernet + IP + UDP ヘッダ長と Nexmon メタデータ長
+NBYTES_HEADERS = 42
+NBYTES_NEXMON_META = 18
+NEXMON_MAGIC = 0x1111
+
+# CSIがint16の実部・虚部の並びで入っている機種 (nexcsi.interleaved で読む機種)
+INTERLEAVED_DEVICES = set(raspberrypi + nexus5)
+
+
+def parse_global_header(header):
+    """
+    pcapグローバルヘッダを解析し、(バイトオーダー, タイムスタンプの分解能) を返す
+    """
+    magic = header[:4]
+    if magic == b'\xd4\xc3\xb2\xa1':
+        return '<', 1e-6
+    if magic == b'\xa1\xb2\xc3\xd4':
+        return '>', 1e-6
+    if magic == b'\x4d\x3c\xb2\xa1':
+        return '<', 1e-9
+    if magic == b'\xa1\xb2\x3c\x4d':
+        return '>', 1e-9
+    raise ValueError(f"pcapのマジックナンバーが不正です: {bytes(magic).hex()}")
+
+
+def find_bandwidth(frame_len):
+    """
+    パケット長から帯域幅を求める (nexcsi.interleaved と同じ計算)
+    """
+    return 20 * int((frame_len + 128 - 60) // (20 * 3.2 * 4))
+
+
+class DecoderSession:
+    """
+    1パケットずつのCSIデコードを、確保済みの配列に書き込んで行うセッション
+
+    パケット長からの帯域幅・サブキャリア数の判定は長さが変わったときだけ行う。
+    int16の実部・虚部の並び (raspberrypi など) は、fftshiftの前半・後半を
+    np.copyto で出力先のfloat32ビューに直接書き込むので、作業用の配列も確保しない。
+    出力は nexcsi の unpack (fftshift済み, complex64) と同じ。
+    """
+    def __init__(self, device='raspberrypi'):
+        self.device = device
+        self.interleaved = device in INTERLEAVED_DEVICES
+        self.decoder = decoder(device)
+        self.frame_len = None
+        self.bandwidth = None
+        self.nsub = 0
+        self.frame = None  # decode_into の出力先を省略したときに使う配列
+
+    def _configure(self, frame_len):
+        self.frame_len = frame_len
+        self.bandwidth = find_bandwidth(frame_len)
+        self.nsub = int(self.bandwidth * 3.2)
+        if self.nsub > 0:
+            self.frame = self.new_frame()
+
+    def new_frame(self):
+        """
+        現在のサブキャリア数で出力用の配列を確保する
+        """
+        return np.empty(self.nsub, dtype=np.complex64)
+
+    def decode_into(self, packet, out=None):
+        """
+        1パケット分のバイト列のCSIを out (complex64, サブキャリア数) に書き込んで返す
+        out を省略するとセッションの self.frame に書き込む (次のデコードで上書きされる)
+        CSIパケットでなければ None を返す
+        """
+        if len(packet) < NBYTES_HEADERS + NBYTES_NEXMON_META:
+            return None
+        if packet[NBYTES_HEADERS] != 0x11 or packet[NBYTES_HEADERS + 1] != 0x11:
+            return None
+        if len(packet) != self.frame_len:
+            self._configure(len(packet))
+        nsub = self.nsub
+        offset = NBYTES_HEADERS + NBYTES_NEXMON_META
+        if nsub == 0 or len(packet) < offset + nsub * 4:
+            return None
+        if out is None:
+            out = self.frame
+
+        csi = np.frombuffer(packet, dtype='<i2', count=nsub * 2, offset=offset)
+        if self.interleaved:
+            # fftshift: 後半のサブキャリアを先頭に、前半を後ろに置く (float32で nsub 要素ずつ)
+            values = out.view(np.float32)
+            np.copyto(values[:nsub], csi[nsub:], casting='unsafe')
+            np.copyto(values[nsub:], csi[:nsub], casting='unsafe')
+        else:
+            out[:] = np.asarray(self.decoder.unpack(csi[np.newaxis, :]))[0]
+        return out
+
+    def decode(self, packet):
+        """
+        新しい配列にデコードして返す (呼び出し側が配列を保持する場合用)
+        """
+        if len(packet) != self.frame_len:
+            self._configure(len(packet))
+        return self.decode_into(packet, self.new_frame() if self.nsub else None)
+
+
+_sessions = {}
+
+
+def decode_packet(packet, device='raspberrypi'):
+    """
+    1パケット分のバイト列からCSIを取り出して複素数配列(サブキャリア数,)を返す
+    CSIパケットでなければ None を返す
+    """
+    session = _sessions.get(device)
+    if session is None:
+        session = _sessions[device] = DecoderSession(device)
+    return session.decode(packet)
+
+
+class PcapStreamParser:
+    """
+    細切れに届くpcapストリームを逐次的に解析するパーサ
+
+    受信データは再利用するバッファに書き込み、レコードはmemoryviewの
+    スライスとして取り出すため、チャンクごとのコピーは発生しない。
+    取り出したmemoryviewは次に feed/commit するまでの間だけ有効。
+
+    reuse_frames=True にすると、デコードしたCSIを毎回同じ配列に書き込んで返す
+    (フレームごとの確保がなくなる代わりに、返した配列は次のフレームで上書きされる)。
+    """
+    def __init__(self, device='raspberrypi', buffer_size=1 << 16, reuse_frames=False):
+        self.device = device
+        self.session = DecoderSession(device)
+        self.reuse_frames = reuse_frames
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._start = 0  # 未処理データの先頭
+        self._end = 0    # 受信済みデータの末尾
+        self._record_header = None
+        self._ts_unit = None
+        self._last_seq = None
+        # デコード時間 (秒) を受け取る関数 (metrics.PipelineMetrics.attach_parser が設定する)
+        self.decode_observer = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.bytes_received = 0
+        self.records = 0
+        self.frames = 0
+        self.decode_errors = 0
+        self.lost_packets = 0
+        self.started_at = None
+        self.last_timestamp = None
+
+    def reset_stream(self):
+        """
+        新しいpcapストリーム (グローバルヘッダから始まる) を読み始める
+        統計は引き継ぐ
+        """
+        self._start = self._end = 0
+        self._record_header = None
+        self._ts_unit = None
+        self._last_seq = None
+
+    def buffered_bytes(self):
+        """
+        受信済みでまだレコードとして取り出していないバイト数
+        """
+        return self._end - self._start
+
+    def writable(self, min_size=PCAP_RECORD_HEADER_LEN):
+        """
+        次の受信データを書き込むための空き領域をmemoryviewで返す (readinto用)
+        """
+        if len(self._buffer) - self._end < min_size:
+            self._compact(min_size)
+        return self._view[self._end:]
+
+    def commit(self, nbytes):
+        """
+        writable() に書き込んだバイト数を確定する
+        """
+        if self.started_at is None:
+            self.started_at = time.time()
+        self._end += nbytes
+        self.bytes_received += nbytes
+
+    def feed(self, data):
+        """
+        受信したバイト列をバッファに追加する
+        """
+        data = memoryview(data)
+        while len(data) > 0:
+            view = self.writable(1)
+            n = min(len(view), len(data))
+            view[:n] = data[:n]
+            self.commit(n)
+            data = data[n:]
+
+    def _compact(self, min_size):
+        # 未処理データをバッファの先頭に寄せる
+        remaining = self._end - self._start
+        if self._start > 0:
+            self._buffer[:remaining] = self._view[self._start:self._end]
+            self._start = 0
+            self._end = remaining
+        if len(self._buffer) - self._end < min_size:
+            self._grow(max(len(self._buffer) * 2, self._end + min_size))
+
+    def _grow(self, size):
+        # memoryviewが参照中のbytearrayはリサイズできないので作り直す
+        buffer = bytearray(size)
+        buffer[:self._end - self._start] = self._view[self._start:self._end]
+        self._buffer = buffer
+        self._view = memoryview(buffer)
+        self._end -= self._start
+        self._start = 0
+
+    def iter_records(self):
+        """
+        バッファ内の完全なレコードを (タイムスタンプ, パケットのmemoryview) として返す
+        """
+        if self._record_header is None:
+            if self._end - self._start < PCAP_GLOBAL_HEADER_LEN:
+                return
+            byteorder, self._ts_unit = parse_global_header(self._view[self._start:self._start + PCAP_GLOBAL_HEADER_LEN])
+            self._record_header = struct.Struct(byteorder + 'IIII')
+            self._start += PCAP_GLOBAL_HEADER_LEN
+
+        while self._end - self._start >= PCAP_RECORD_HEADER_LEN:
+            ts_sec, ts_frac, incl_len, _ = self._record_header.unpack_from(self._buffer, self._start)
+            record_end = self._start + PCAP_RECORD_HEADER_LEN + incl_len
+            if record_end > self._end:
+                # レコードが途中までしか届いていない
+                if record_end - self._start > len(self._buffer):
+                    self._grow(record_end - self._start)
+                return
+            packet = self._view[self._start + PCAP_RECORD_HEADER_LEN:record_end]
+            self._start = record_end
+            self.records += 1
+            yield ts_sec + ts_frac * self._ts_unit, packet
+
+        if self._start == self._end:
+            self._start = self._end = 0
+
+    def iter_frames(self):
+        """
+        バッファ内の完全なレコードをデコードして (タイムスタンプ, CSI複素数配列) として返す
+        """
+        for timestamp, packet in self.iter_records():
+            if self.decode_observer is not None:
+                start = time.perf_counter()
+            try:
+                if self.reuse_frames:
+                    csi_frame = self.session.decode_into(packet)
+                else:
+                    csi_frame = self.session.decode(packet)
+            except ValueError:
+                csi_frame = None
+            if self.decode_observer is not None:
+                self.decode_observer(time.perf_counter() - start)
+            if csi_frame is None:
+                self.decode_errors += 1
+                continue
+            self._count_sequence(packet)
+            self.frames += 1
+            self.last_timestamp = timestamp
+            yield timestamp, csi_frame
+
+    def _count_sequence(self, packet):
+        # Nexmonのシーケンス番号(12ビット)の飛びからパケットロスを数える
+        offset = NBYTES_HEADERS + 10
+        seq = int.from_bytes(packet[offset:offset + 2], 'little') >> 4
+        if self._last_seq is not None:
+            gap = (seq - self._last_seq) % 4096
+            if 1 < gap < 2048:
+                self.lost_packets += gap - 1
+        self._last_seq = seq
+
+    def stats(self):
+        """
+        スループットとパケットロスの統計を辞書で返す
+        """
+        elapsed = time.time() - self.started_at if self.started_at is not None else 0.0
+        expected = self.frames + self.lost_packets
+        return {
+            'elapsed': elapsed,
+            'bytes': self.bytes_received,
+            'records': self.records,
+            'frames': self.frames,
+            'decode_errors': self.decode_errors,
+            'lost_packets': self.lost_packets,
+            'loss_rate': self.lost_packets / expected if expected > 0 else 0.0,
+            'packets_per_sec': self.frames / elapsed if elapsed > 0 else 0.0,
+            'mbps': self.bytes_received * 8 / elapsed / 1e6 if elapsed > 0 else 0.0,
+        }
+
+
+def iter_pcap_frames(stream, device='raspberrypi', parser=None):
+    """
+    pcapストリームからCSIフレームを順に取り出す
+    (タイムスタンプ, CSI複素数配列) を返すジェネレータ
+    """
+    if parser is None:
+        parser = PcapStreamParser(device)
+    # 届いた分だけ読み込む (バッファが埋まるまで待たない)
+    readinto = getattr(stream, 'readinto1', stream.readinto)
+    while True:
+        nbytes = readinto(parser.writable())
+        if not nbytes:
+            return
+        parser.commit(nbytes)
+        yield from parser.iter_frames()
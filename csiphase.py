@@ -0,0 +1,117 @@
+import os
+import numpy as np
+from dataset import DEFAULT_STORE, load_recording
+from features import subcarrier_mask
+
+PHASE_VERSION = 1
+PHASE_COLUMN = f'phase_v{PHASE_VERSION}'
+
+
+def valid_subcarriers(nsub):
+    """
+    ヌルサブキャリア (DCと両端) を除いたサブキャリアのマスク
+    (パイロットは位相の当てはめに使えるので残す)
+    """
+    return subcarrier_mask(nsub, drop_pilots=False)
+
+
+def wrap(phase):
+    """
+    位相を [-π, π) に折り返す
+    """
+    return (phase + np.pi) % (2 * np.pi) - np.pi
+
+
+def sanitize_phase(csi, mask=None):
+    """
+    生の位相から、パケットごとに入るランダムな線形成分を取り除く
+
+    サブキャリア方向にアンラップしたあと、パケットごとに
+    φ(k) ≈ a k + b を最小二乗で当てはめて引く (a: タイミングずれによる傾き,
+    b: 搬送波周波数・位相ずれによるオフセット)。ヌルサブキャリアは当てはめに使わず0にする。
+    記録全体 (パケット数, サブキャリア数) でも1パケット (サブキャリア数,) でも、1回のベクトル演算で処理する。
+    """
+    csi = np.asarray(csi)
+    nsub = csi.shape[-1]
+    if mask is None:
+        mask = valid_subcarriers(nsub)
+    k = np.arange(nsub, dtype=np.float64)[mask]
+    k -= k.mean()
+
+    phase = np.unwrap(np.angle(csi[..., mask]), axis=-1)
+    slope = phase @ k / np.dot(k, k)
+    offset = phase.mean(axis=-1)
+    sanitized = np.zeros(csi.shape, dtype=np.float32)
+    sanitized[..., mask] = phase - slope[..., np.newaxis] * k - offset[..., np.newaxis]
+    return sanitized
+
+
+def phase_change(phase):
+    """
+    隣接パケット間の位相変化の絶対値をサブキャリアについて足したもの (パケット数 - 1,)
+    差は [-π, π) に折り返してから取るので、±πをまたいだ変化も小さい変化として扱う
+    """
+    return np.sum(np.abs(wrap(np.diff(phase, axis=0))), axis=1)
+
+
+class PhaseTracker:
+    """
+    ライブの検出器向けに、1パケットずつ位相を補正して直前のパケットからの変化量を返す
+    処理内容は sanitize_phase / phase_change と同じ
+    """
+    def __init__(self, mask=None):
+        self.mask = mask
+        self.previous = None
+        self.phase = None
+        self.change = None
+
+    def update(self, csi_frame):
+        """
+        1パケット分のCSIを追加し、直前のパケットからの位相変化量を返す (最初のパケットでは None)
+        """
+        csi_frame = np.asarray(csi_frame).ravel()
+        if self.mask is None:
+            self.mask = valid_subcarriers(len(csi_frame))
+        self.phase = sanitize_phase(csi_frame, self.mask)
+        if self.previous is not None:
+            self.change = float(np.sum(np.abs(wrap(self.phase - self.previous))))
+        self.previous = self.phase
+        return self.change
+
+    def reset(self):
+        self.previous = None
+        self.phase = None
+        self.change = None
+
+
+def cached_phase(recording):
+    """
+    dataset の録画について、補正済みの位相を録画と同じディレクトリにキャッシュして返す
+
+    pcapが変わると録画のディレクトリごと作り直されるので、古いキャッシュが残ることはない。
+    """
+    path = os.path.join(recording.path, f"{PHASE_COLUMN}.npy")
+    if not os.path.exists(path):
+        phase = sanitize_phase(recording.csi)
+        tmp_path = path + '.tmp.npy'
+        np.save(tmp_path, phase)
+        os.replace(tmp_path, path)
+    return np.load(path, mmap_mode='r')
+
+
+def load_phase(pcap_path, store_dir=DEFAULT_STORE):
+    """
+    pcapファイルの補正済みの位相を返す (必要ならデータストアに取り込み、位相を計算してキャッシュする)
+    """
+    return cached_phase(load_recording(pcap_path, store_dir))
+
+
+if __name__ == "__main__":
+    # 生の位相と補正後の位相で、静止時 (0xx) と動作時 (1xx) の位相変化量を比べる
+    import sys
+
+    for pcap_file in sys.argv[1:]:
+        recording = load_recording(pcap_file)
+        raw = np.mean(phase_change(np.angle(recording.csi)))
+        sanitized = np.mean(phase_change(cached_phase(recording)))
+        print(f"{pcap_file}: 生の位相 {raw:.1f}  補正後 {sanitized:.1f}")
@@ -0,0 +1,277 @@
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+import contextlib
+import numpy as np
+import pcap_loader
+from reference_cache import file_sha256
+
+device = 'raspberrypi'
+DEFAULT_STORE = 'csi_store'
+MANIFEST_NAME = 'manifest.json'
+META_NAME = 'meta.json'
+
+# 列名と説明 (各列は <store>/<録画名>/<列名>.npy に保存する)
+COLUMNS = {
+    'csi': 'CSI複素数行列 complex64 (パケット数, サブキャリア数), fftshift済み',
+    'timestamp': 'キャプチャ時刻 float64 (秒)',
+    'rssi': 'RSSI int8',
+    'mac': '送信元MACアドレス uint8 (パケット数, 6)',
+    'core': 'コア番号 uint8',
+    'stream': '空間ストリーム番号 uint8',
+    'seq': 'シーケンス番号 uint16 (シーケンス制御の上位12ビット)',
+    'chanspec': 'チャンネル指定 uint16',
+}
+
+
+def source_path(pcap_path):
+    return os.path.realpath(pcap_path)
+
+
+def recording_name(pcap_path):
+    """
+    録画名 (ファイル名 + 元のpcapの絶対パスのハッシュ)
+    別のディレクトリにある同じ名前のpcap (a/001.pcap と b/001.pcap) を別の録画として保存する
+    """
+    stem = os.path.splitext(os.path.basename(pcap_path))[0]
+    digest = hashlib.sha1(source_path(pcap_path).encode()).hexdigest()[:8]
+    return f"{stem}-{digest}"
+
+
+def _read_meta(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_json(path, data):
+    # 複数のプロセスが同時に書いても互いの一時ファイルを消さないよう、名前はプロセスごとに変える
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.' + os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, indent=2, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        raise
+
+
+def _is_ingested(meta, source, sha256=None, stat=None):
+    # 保存済みの録画が source と同じ内容か (sha256 か、大きさと更新日時で判断する)
+    if meta is None or meta['source'] != source or meta['device'] != device:
+        return False
+    if sha256 is not None:
+        return meta['sha256'] == sha256
+    return meta['size'] == stat.st_size and meta['mtime_ns'] == stat.st_mtime_ns
+
+
+def _publish(tmp_dir, recording_dir, source, sha256):
+    """
+    書き終えた一時ディレクトリを録画のディレクトリに置き換える
+    他のプロセスが先に同じ内容を置いていれば、それを使って自分の一時ディレクトリは捨てる
+    """
+    store_dir, name = os.path.split(recording_dir)
+    meta_path = os.path.join(recording_dir, META_NAME)
+    while True:
+        try:
+            os.replace(tmp_dir, recording_dir)
+            return
+        except OSError:
+            # 置き換え先のディレクトリが空でない
+            pass
+        if _is_ingested(_read_meta(meta_path), source, sha256):
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+        # 古い録画を別の名前に移してから消す (移している間に他のプロセスが動かしていればやり直す)
+        trash_dir = tempfile.mkdtemp(dir=store_dir, prefix=f".{name}.", suffix='.old')
+        try:
+            os.replace(recording_dir, os.path.join(trash_dir, name))
+        except FileNotFoundError:
+            pass
+        shutil.rmtree(trash_dir, ignore_errors=True)
+
+
+def _columns_from_pcap(pcap_path):
+    samples = pcap_loader.read_pcap(pcap_path)
+    csi = pcap_loader.unpack(samples['csi'], device)
+    css = samples['css']
+    columns = {
+        'csi': csi,
+        'timestamp': samples['ts_sec'] + samples['ts_usec'] * 1e-6,
+        'rssi': samples['rssi'].astype(np.int8),
+        'mac': samples['mac'].astype(np.uint8),
+        'core': (css & 0x7).astype(np.uint8),
+        'stream': ((css >> 3) & 0x7).astype(np.uint8),
+        'seq': (samples['seq'] >> 4).astype(np.uint16),
+        'chanspec': samples['csp'].astype(np.uint16),
+    }
+    return columns, samples.dtype.metadata['bandwidth']
+
+
+def ingest_file(pcap_path, store_dir=DEFAULT_STORE):
+    """
+    pcapファイル1つを列形式で保存する
+    既に同じ内容が保存済みなら何もしない
+
+    Returns:
+        (録画名, 取り込み直したかどうか)
+    """
+    name = recording_name(pcap_path)
+    source = source_path(pcap_path)
+    recording_dir = os.path.join(store_dir, name)
+    meta_path = os.path.join(recording_dir, META_NAME)
+    stat = os.stat(pcap_path)
+
+    meta = _read_meta(meta_path)
+    if _is_ingested(meta, source, stat=stat):
+        return name, False
+    sha256 = file_sha256(pcap_path)
+    if _is_ingested(meta, source, sha256):
+        # 更新日時だけが変わった場合はメタデータだけ直す
+        meta['size'], meta['mtime_ns'] = stat.st_size, stat.st_mtime_ns
+        _write_json(meta_path, meta)
+        return name, False
+
+    columns, bandwidth = _columns_from_pcap(pcap_path)
+
+    # 書き込み途中の録画を読まないように一時ディレクトリに書いてから置き換える。
+    # 一時ディレクトリはプロセスごとに作り、"." で始めて manifest の対象から外す
+    os.makedirs(store_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=store_dir, prefix=f".{name}.", suffix='.tmp')
+    try:
+        for column, values in columns.items():
+            np.save(os.path.join(tmp_dir, f"{column}.npy"), values)
+        _write_json(os.path.join(tmp_dir, META_NAME), {
+            'name': name,
+            'source': source,
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'sha256': sha256,
+            'device': device,
+            'bandwidth': int(bandwidth),
+            'n_packets': int(len(columns['csi'])),
+            'n_subcarriers': int(columns['csi'].shape[1]),
+            'columns': list(columns),
+            'ingested_at': time.time(),
+        })
+        _publish(tmp_dir, recording_dir, source, sha256)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    return name, True
+
+
+def write_manifest(store_dir=DEFAULT_STORE):
+    """
+    各録画のメタデータをまとめた索引 manifest.json を作り直す
+    """
+    recordings = {}
+    for meta_path in sorted(glob.glob(os.path.join(store_dir, '*', META_NAME))):
+        meta = _read_meta(meta_path)
+        if meta is not None:
+            recordings[meta['name']] = meta
+    _write_json(os.path.join(store_dir, MANIFEST_NAME), {'columns': COLUMNS, 'recordings': recordings})
+    return recordings
+
+
+def ingest(pcap_dir, store_dir=DEFAULT_STORE):
+    """
+    ディレクトリ内のpcapを列形式のストアに取り込む
+    新しいpcapと変更されたpcapだけをデコードする
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    updated = []
+    for pcap_path in sorted(glob.glob(os.path.join(pcap_dir, '*.pcap'))):
+        name, changed = ingest_file(pcap_path, store_dir)
+        if changed:
+            updated.append(name)
+    write_manifest(store_dir)
+    return updated
+
+
+def read_manifest(store_dir=DEFAULT_STORE):
+    with open(os.path.join(store_dir, MANIFEST_NAME)) as f:
+        return json.load(f)['recordings']
+
+
+class Recording:
+    """
+    ストアに保存された録画1つ分
+    各列は最初にアクセスしたときにメモリマップで開くので、必要な範囲だけ読み込まれる
+
+    使い方:
+        rec = load_recording('pcaps/001.pcap')
+        amplitude = np.abs(rec.csi[100:200])
+    """
+    def __init__(self, recording_dir):
+        self.path = recording_dir
+        self._columns = {}
+        self._meta = None
+
+    @property
+    def meta(self):
+        if self._meta is None:
+            self._meta = _read_meta(os.path.join(self.path, META_NAME))
+        return self._meta
+
+    def __getitem__(self, column):
+        if column not in self._columns:
+            self._columns[column] = np.load(os.path.join(self.path, f"{column}.npy"), mmap_mode='r')
+        return self._columns[column]
+
+    def __getattr__(self, column):
+        if column.startswith('_') or column not in COLUMNS:
+            raise AttributeError(column)
+        return self[column]
+
+    def __len__(self):
+        return len(self['timestamp'])
+
+
+def open_recording(name, store_dir=DEFAULT_STORE):
+    recording_dir = os.path.join(store_dir, name)
+    if not os.path.isdir(recording_dir):
+        raise FileNotFoundError(f"録画 {name} が {store_dir} にありません")
+    return Recording(recording_dir)
+
+
+def load_recording(pcap_path, store_dir=DEFAULT_STORE):
+    """
+    pcapファイルに対応する録画を開く (必要なら先に取り込む)
+    """
+    name, _ = ingest_file(pcap_path, store_dir)
+    return open_recording(name, store_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='pcapを列形式のCSIデータストアに変換する')
+    parser.add_argument('command', choices=['ingest', 'list'])
+    parser.add_argument('pcap_dir', nargs='?', default='pcaps')
+    parser.add_argument('-s', '--store', default=DEFAULT_STORE, help='データストアのディレクトリ')
+    args = parser.parse_args()
+
+    if args.command == 'ingest':
+        start = time.perf_counter()
+        updated = ingest(args.pcap_dir, args.store)
+        print(f"{len(updated)} ファイルを取り込みました ({time.perf_counter() - start:.2f} 秒): {' '.join(updated)}")
+    else:
+        try:
+            recordings = read_manifest(args.store)
+        except OSError:
+            print(f"{args.store} に manifest.json がありません")
+            sys.exit(1)
+        for name, meta in recordings.items():
+            print(f"{name:<10} {meta['n_packets']:>7} パケット {meta['bandwidth']:>4} MHz  {meta['source']}")
+
+
+if __name__ == "__main__":
+    main()
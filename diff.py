@@ -1,18 +1,20 @@
 from nexcsi import decoder
+import pcap_loader
 import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
 from scipy.ndimage import gaussian_filter1d
+from filters import moving_average
 
 # デバイス設定
 device = 'raspberrypi'
 
 # 最初のpcapファイルの読み込みと処理
-samples_1 = decoder(device).read_pcap('pcaps/106.pcap')
+samples_1 = pcap_loader.read_pcap('pcaps/106.pcap')
 csi_data_1 = decoder(device).unpack(samples_1['csi'])
 
 # 2つ目のpcapファイルの読み込みと処理
-samples_2 = decoder(device).read_pcap('pcaps/107.pcap')
+samples_2 = pcap_loader.read_pcap('pcaps/107.pcap')
 csi_data_2 = decoder(device).unpack(samples_2['csi'])
 
 def moving_average_filter(csi_amplitude, window_size=5):
@@ -26,17 +28,9 @@ def moving_average_filter(csi_amplitude, window_size=5):
     Returns:
         numpy.ndarray: フィルタ適用後の CSI 振幅データ
     """
-    num_packets, num_subcarriers = csi_amplitude.shape  # データのサイズ取得
-    filtered_csi = np.zeros_like(csi_amplitude)  # 結果を保存する配列
-    
-    for subcarrier in range(num_subcarriers):
-        filtered_csi[:, subcarrier] = np.convolve(
-            csi_amplitude[:, subcarrier], 
-            np.ones(window_size) / window_size, 
-            mode='same'  # 端のデータが消えないようにする
-        )
-    
-    return filtered_csi
+    # 全サブキャリアをまとめて処理する (端のデータが消えないよう np.convolve の mode='same' と同じ結果)
+    # ライブで使う場合は因果的な filters.MovingAverage を使う
+    return moving_average(csi_amplitude, window_size, centered=True)
 def gauss(amp, sigma=1.0):
     return gaussian_filter1d(amp,sigma=sigma)
 
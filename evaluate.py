@@ -0,0 +1,202 @@
+import os
+import io
+import sys
+import glob
+import json
+import time
+import argparse
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from dataset import DEFAULT_STORE, ingest_file, open_recording, write_manifest
+
+
+# 検出器の登録先: 名前 -> 準備関数(options) -> 判定関数(csi, timestamps) -> (予測ラベル, スコア)
+# 準備関数でimportや参照データの読み込みを済ませ、判定関数ではパケットの処理だけを行う
+DETECTORS = {}
+
+# ワーカープロセスごとに準備済みの判定関数 (名前 -> 判定関数)
+_prepared = {}
+
+
+def register_detector(name):
+    """
+    評価対象の検出器の準備関数を登録するデコレータ
+    """
+    def register(func):
+        DETECTORS[name] = func
+        return func
+    return register
+
+
+@register_detector('squared_error')
+def squared_error_detector(options):
+    """
+    無動作の参照データとの二乗誤差が大きいパケットの割合で動きを判定する
+    """
+    from judges_ import reference_model
+    model = reference_model(options['reference'])
+
+    def run(csi, timestamps):
+        labels = model.label(np.abs(csi), options['threshold_ratio'], 1, below=False)
+        fraction = float(np.mean(labels))
+        return int(fraction > options['min_fraction']), fraction
+    return run
+
+
+@register_detector('dynamic_threshold')
+def dynamic_threshold_detector(options):
+    """
+    ras.NexmonCSIMotionDetector に記録時のタイムスタンプ付きで1パケットずつ流して、一度でも動きを検出したか
+    """
+    from ras import NexmonCSIMotionDetector
+
+    def run(csi, timestamps):
+        detector = NexmonCSIMotionDetector()
+        detections = 0
+        # 検出器はパケットごとに print するので評価中は捨てる
+        with contextlib.redirect_stdout(io.StringIO()):
+            for frame, timestamp in zip(csi, timestamps):
+                if detector.detect_motion(frame, float(timestamp)):
+                    detections += 1
+        return int(detections > 0), detections
+    return run
+
+
+@register_detector('fft_presence')
+def fft_presence_detector(options):
+    """
+    presence.batch_presence による帯域エネルギーでの判定
+    """
+    from presence import batch_presence
+
+    def run(csi, timestamps):
+        energy, present = batch_presence(np.abs(csi))
+        return int(present), float(energy)
+    return run
+
+
+def prepare_detectors(detector_names, options):
+    """
+    指定された検出器を準備する (プロセスプールの initializer としてワーカーごとに1回呼ぶ)
+    """
+    for name in detector_names:
+        if name not in _prepared:
+            _prepared[name] = DETECTORS[name](options)
+
+
+def label_from_filename(pcap_path):
+    """
+    ファイル名からラベルを決める (000番台: 動きなし 0, 100番台: 動きあり 1, それ以外: None)
+    """
+    stem = os.path.splitext(os.path.basename(pcap_path))[0]
+    return {'0': 0, '1': 1}.get(stem[:1]) if len(stem) == 3 and stem.isdigit() else None
+
+
+def evaluate_file(pcap_path, detector_names, options):
+    """
+    1ファイルをデコードして、指定された全検出器で判定する (プロセスプール内で実行)
+    """
+    # 準備 (importや参照データの読み込み) は処理時間に含めない
+    prepare_detectors(detector_names, options)
+
+    start = time.perf_counter()
+    # デコード済みのCSIはデータストアからメモリマップで読む
+    name, ingested = ingest_file(pcap_path, options['store'])
+    recording = open_recording(name, options['store'])
+    csi, timestamps = recording.csi, recording.timestamp
+    cached = not ingested
+    decode_time = time.perf_counter() - start
+
+    label = label_from_filename(pcap_path)
+    rows = []
+    for name in detector_names:
+        start = time.perf_counter()
+        prediction, score = _prepared[name](csi, timestamps)
+        elapsed = time.perf_counter() - start
+        rows.append({
+            'file': pcap_path,
+            'detector': name,
+            'label': label,
+            'prediction': prediction,
+            'correct': None if label is None else prediction == label,
+            'score': score,
+            'packets': len(csi),
+            'decode_ms': decode_time * 1000,
+            'cached': cached,
+            'latency_ms': elapsed * 1000,
+            'per_packet_us': elapsed / max(len(csi), 1) * 1e6,
+        })
+    return rows
+
+
+def summarize(rows):
+    """
+    検出器ごとに正解率と処理時間を集計する
+    """
+    summary = {}
+    for name in sorted({row['detector'] for row in rows}):
+        detector_rows = [row for row in rows if row['detector'] == name]
+        labeled = [row for row in detector_rows if row['label'] is not None]
+        summary[name] = {
+            'files': len(detector_rows),
+            'labeled_files': len(labeled),
+            'accuracy': float(np.mean([row['correct'] for row in labeled])) if labeled else None,
+            'mean_latency_ms': float(np.mean([row['latency_ms'] for row in detector_rows])),
+            'mean_per_packet_us': float(np.mean([row['per_packet_us'] for row in detector_rows])),
+        }
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='pcapディレクトリ全体で検出器をまとめて評価する')
+    parser.add_argument('pcap_dir', nargs='?', default='pcaps', help='pcapファイルのディレクトリ')
+    parser.add_argument('-d', '--detectors', nargs='+', default=sorted(DETECTORS),
+                        choices=sorted(DETECTORS), help='評価する検出器')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='並列プロセス数')
+    parser.add_argument('-o', '--output', default='evaluation.json', help='結果を書き出すJSONファイル')
+    parser.add_argument('-s', '--store', default=DEFAULT_STORE, help='デコード済みCSIのデータストア')
+    parser.add_argument('--reference', default='pcaps/001.pcap', help='squared_error 用の無動作参照pcap')
+    parser.add_argument('--threshold-ratio', type=float, default=3.0)
+    parser.add_argument('--min-fraction', type=float, default=0.5)
+    args = parser.parse_args()
+
+    pcap_files = sorted(glob.glob(os.path.join(args.pcap_dir, '*.pcap')))
+    if not pcap_files:
+        print(f"{args.pcap_dir} にpcapファイルがありません")
+        sys.exit(1)
+
+    options = {
+        'store': args.store,
+        'reference': args.reference,
+        'threshold_ratio': args.threshold_ratio,
+        'min_fraction': args.min_fraction,
+    }
+
+    os.makedirs(args.store, exist_ok=True)
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.jobs, initializer=prepare_detectors,
+                             initargs=(args.detectors, options)) as executor:
+        futures = [executor.submit(evaluate_file, path, args.detectors, options) for path in pcap_files]
+        rows = [row for future in futures for row in future.result()]
+    wall_time = time.perf_counter() - start
+    write_manifest(args.store)
+
+    summary = summarize(rows)
+    for row in rows:
+        mark = '-' if row['correct'] is None else ('o' if row['correct'] else 'x')
+        print(f"{row['file']:<20} {row['detector']:<18} ラベル={row['label']} 予測={row['prediction']} {mark} "
+              f"{row['latency_ms']:8.2f} ms")
+    for name, result in summary.items():
+        accuracy = '-' if result['accuracy'] is None else f"{result['accuracy']:.1%}"
+        print(f"{name:<18} 正解率 {accuracy} ({result['labeled_files']}ファイル), "
+              f"平均 {result['mean_latency_ms']:.2f} ms/ファイル, {result['mean_per_packet_us']:.1f} us/パケット")
+    print(f"{len(pcap_files)} ファイル, {args.jobs} プロセス, 合計 {wall_time:.2f} 秒")
+
+    with open(args.output, 'w') as f:
+        json.dump({'files': rows, 'summary': summary, 'wall_time_s': wall_time, 'jobs': args.jobs}, f,
+                  indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+import numpy as np
+from nexcsi import nulls, pilots
+from dataset import DEFAULT_STORE, load_recording
+
+# サブキャリア数 -> 帯域幅 (MHz)
+BANDWIDTHS = {64: 20, 128: 40, 256: 80, 512: 160}
+
+
+def subcarrier_mask(nsub, drop_nulls=True, drop_pilots=True):
+    """
+    ヌルサブキャリア (DCと両端) とパイロットサブキャリアを除いたマスク
+
+    nexcsi.nulls / nexcsi.pilots の添字はfftshift後の並びなので、
+    unpackの出力 (fftshift済み) にそのまま使える。未知のサブキャリア数なら全て残す。
+    """
+    mask = np.ones(nsub, dtype=bool)
+    bandwidth = BANDWIDTHS.get(nsub)
+    if bandwidth is not None:
+        if drop_nulls:
+            mask[nulls[bandwidth]] = False
+        if drop_pilots:
+            mask[pilots[bandwidth]] = False
+    return mask
+
+
+class IncrementalPCA:
+    """
+    平均と散布行列を逐次更新する主成分分析
+
+    partial_fit はバッチ (またはパケット1つ) ごとに平均と散布行列を併合するだけなので
+    O(バッチサイズ × 次元数^2) で、ライブでパケットごとに呼べる。
+    主成分 (固有ベクトル) は refresh_every パケットごとに計算し直す。
+    """
+    def __init__(self, n_components=8, refresh_every=100):
+        self.n_components = n_components
+        self.refresh_every = refresh_every
+        self.n_samples = 0
+        self.mean = None
+        self.scatter = None
+        self.components = None          # (n_components, 次元数)
+        self.explained_variance = None  # (n_components,)
+        self.total_variance = None
+        self.version = 0  # refresh() のたびに増える (射影行列のキャッシュの判定用)
+        self._since_refresh = 0
+
+    def partial_fit(self, x):
+        x = np.atleast_2d(np.asarray(x, dtype=np.float64))
+        m = len(x)
+        if m == 0:
+            return self
+        batch_mean = x.mean(axis=0)
+        centered = x - batch_mean
+        batch_scatter = centered.T @ centered
+        if self.n_samples == 0:
+            self.mean = batch_mean
+            self.scatter = batch_scatter
+        else:
+            # 2つの集合の平均と散布行列を併合する (Chanらの方法)
+            total = self.n_samples + m
+            delta = batch_mean - self.mean
+            self.mean = self.mean + delta * (m / total)
+            self.scatter += batch_scatter + np.outer(delta, delta) * (self.n_samples * m / total)
+        self.n_samples += m
+        self._since_refresh += m
+        if self.components is None or self._since_refresh >= self.refresh_every:
+            self.refresh()
+        return self
+
+    def refresh(self):
+        """
+        現在の散布行列から主成分を計算し直す
+        """
+        covariance = self.scatter / max(self.n_samples - 1, 1)
+        eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+        order = np.argsort(eigenvalues)[::-1][:self.n_components]
+        components = eigenvectors[:, order].T
+        # 計算し直すたびに符号が反転しないよう、絶対値最大の要素を正にそろえる
+        signs = np.sign(components[np.arange(len(components)), np.argmax(np.abs(components), axis=1)])
+        self.components = components * signs[:, np.newaxis]
+        self.explained_variance = eigenvalues[order]
+        self.total_variance = float(np.sum(eigenvalues))
+        self.version += 1
+        self._since_refresh = 0
+
+    @property
+    def explained_variance_ratio(self):
+        if not self.total_variance:
+            return np.zeros_like(self.explained_variance)
+        return self.explained_variance / self.total_variance
+
+    def transform(self, x):
+        return (np.asarray(x, dtype=np.float64) - self.mean) @ self.components.T
+
+
+class FeatureStage:
+    """
+    検出器の前段に置く特徴量抽出 (サブキャリアのマスク → 主成分への射影)
+
+    mask が None なら最初のパケットのサブキャリア数からヌル・パイロットを除くマスクを作る。
+    pca を渡すと、マスクしたあとに少数の主成分に射影する。online=True なら
+    update() のたびに主成分も逐次更新する。
+    """
+    def __init__(self, mask=None, pca=None, online=False, drop_pilots=True):
+        self.mask = mask
+        self.pca = pca
+        self.online = online
+        self.drop_pilots = drop_pilots
+        self._projection = None
+        self._projection_version = None
+
+    @classmethod
+    def from_references(cls, pcap_paths, n_components=8, online=False, drop_pilots=True,
+                        store_dir=DEFAULT_STORE, refresh_every=100):
+        """
+        参照用のキャプチャから主成分を学習して特徴量抽出を作る
+        デコード済みのCSIはデータストアから読む (無ければ取り込む)
+        """
+        stage = cls(pca=IncrementalPCA(n_components, refresh_every), online=online, drop_pilots=drop_pilots)
+        for pcap_path in pcap_paths:
+            stage.pca.partial_fit(stage.mask_amplitude(np.abs(load_recording(pcap_path, store_dir).csi)))
+        stage.pca.refresh()
+        return stage
+
+    @property
+    def n_features(self):
+        if self.pca is not None:
+            return self.pca.n_components
+        return None if self.mask is None else int(np.count_nonzero(self.mask))
+
+    def mask_amplitude(self, amplitude):
+        amplitude = np.asarray(amplitude)
+        if self.mask is None:
+            self.mask = subcarrier_mask(amplitude.shape[-1], drop_pilots=self.drop_pilots)
+        return amplitude[..., self.mask]
+
+    def _project(self, amplitude):
+        # マスクと主成分への射影を1つの行列 W (サブキャリア数, 主成分数) にまとめておき、
+        # (x[mask] - mean) @ components.T = x @ W - mean @ components.T を1回の積で計算する
+        if self._projection_version != self.pca.version:
+            weights = np.zeros((len(self.mask), self.pca.n_components))
+            weights[self.mask] = self.pca.components.T
+            self._projection = (weights, self.pca.mean @ self.pca.components.T)
+            self._projection_version = self.pca.version
+        weights, bias = self._projection
+        return np.asarray(amplitude, dtype=np.float64) @ weights - bias
+
+    def transform(self, amplitude):
+        """
+        振幅 (パケット数, サブキャリア数) または (サブキャリア数,) を特徴量に変換する
+        """
+        if self.pca is None:
+            return self.mask_amplitude(amplitude)
+        if self.mask is None:
+            self.mask = subcarrier_mask(np.shape(amplitude)[-1], drop_pilots=self.drop_pilots)
+        return self._project(amplitude)
+
+    def update(self, amplitude):
+        """
+        1パケット分の振幅を特徴量に変換する (online=True なら主成分も更新する)
+        """
+        if self.online and self.pca is not None:
+            self.pca.partial_fit(self.mask_amplitude(amplitude))
+        return self.transform(amplitude)
+
+
+if __name__ == "__main__":
+    # 参照キャプチャから学習した主成分の寄与率を表示する
+    import sys
+
+    stage = FeatureStage.from_references(sys.argv[1:] or ['pcaps/001.pcap'], n_components=8)
+    print(f"使うサブキャリア: {np.count_nonzero(stage.mask)} / {len(stage.mask)}")
+    ratio = stage.pca.explained_variance_ratio
+    print(f"寄与率: {np.round(ratio, 3)} (累積 {np.sum(ratio):.3f})")
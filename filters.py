@@ -0,0 +1,247 @@
+import numpy as np
+from scipy import signal
+from ringbuffer import FloatRingBuffer
+
+# Hampelフィルタで中央絶対偏差を標準偏差に換算する係数
+MAD_SCALE = 1.4826
+
+
+def moving_average(x, window=5, centered=False):
+    """
+    全サブキャリアの移動平均を時間方向 (axis=0) にまとめて取る (バッチ版)
+
+    centered=True なら np.convolve(mode='same') と同じく前後を0で埋めた中心の移動平均、
+    False なら MovingAverage をパケットごとに適用した結果と同じ因果的な移動平均を返す。
+    """
+    x = np.asarray(x, dtype=np.float64)
+    if centered:
+        pad = [(window // 2, (window - 1) // 2)] + [(0, 0)] * (x.ndim - 1)
+        cumsum = np.cumsum(np.pad(x, pad), axis=0)
+        cumsum = np.concatenate([np.zeros((1,) + x.shape[1:]), cumsum])
+        return (cumsum[window:] - cumsum[:-window]) / window
+    cumsum = np.concatenate([np.zeros((1,) + x.shape[1:]), np.cumsum(x, axis=0)])
+    n = np.arange(1, len(x) + 1)
+    start = np.maximum(n - window, 0)
+    counts = (n - start).reshape((-1,) + (1,) * (x.ndim - 1))
+    return (cumsum[n] - cumsum[start]) / counts
+
+
+class StreamingFilter:
+    """
+    フィルタの共通インターフェース
+
+    update(frame) はパケットごとに状態を持ち越して因果的にフィルタした結果を返し、
+    filter(x) は (パケット数, サブキャリア数) の配列全体に同じフィルタをまとめて掛ける。
+    filter(x) の結果は、reset() した状態から x の各行を update() した結果と一致する。
+    """
+    def update(self, frame):
+        raise NotImplementedError
+
+    def filter(self, x):
+        self.reset()
+        return np.array([self.update(frame) for frame in x])
+
+    def reset(self):
+        pass
+
+
+class MovingAverage(StreamingFilter):
+    """
+    直近 window パケットの移動平均 (溜まるまでは届いた分の平均)
+    """
+    def __init__(self, window=5):
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        self.frames = FloatRingBuffer(self.window)
+        self.sum = None
+        self.since_resync = 0
+
+    def update(self, frame):
+        frame = np.asarray(frame, dtype=np.float64)
+        if self.sum is None:
+            self.sum = np.zeros(frame.shape)
+        if len(self.frames) == self.window:
+            frames, _ = self.frames.latest()
+            self.sum -= frames[0]
+        self.sum += frame
+        self.frames.append(frame)
+        # 足し引きの丸め誤差が溜まらないよう窓1周ごとに計算し直す
+        self.since_resync += 1
+        if self.since_resync >= self.window:
+            self.sum = np.sum(self.frames.latest()[0], axis=0)
+            self.since_resync = 0
+        return self.sum / len(self.frames)
+
+    def filter(self, x):
+        self.reset()
+        for frame in np.asarray(x)[-self.window:]:
+            self.update(frame)
+        return moving_average(x, self.window)
+
+
+class ExponentialMovingAverage(StreamingFilter):
+    """
+    指数移動平均 y[n] = alpha * x[n] + (1 - alpha) * y[n-1] (y[0] = x[0])
+    """
+    def __init__(self, alpha=0.3):
+        if not 0 < alpha <= 1:
+            raise ValueError("alpha は 0 < alpha <= 1 で指定してください")
+        self.alpha = alpha
+        self.reset()
+
+    def reset(self):
+        self.state = None
+
+    def update(self, frame):
+        frame = np.asarray(frame, dtype=np.float64)
+        if self.state is None:
+            self.state = frame.copy()
+        else:
+            self.state += self.alpha * (frame - self.state)
+        return self.state.copy()
+
+    def filter(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        self.reset()
+        if len(x) == 0:
+            return x.copy()
+        zi = (1 - self.alpha) * x[0]
+        y, _ = signal.lfilter([self.alpha], [1, self.alpha - 1], x, axis=0, zi=zi[np.newaxis])
+        self.state = y[-1].copy()
+        return y
+
+
+class ButterworthLowpass(StreamingFilter):
+    """
+    Butterworthローパスフィルタ (2次セクションの縦続接続, SOS)
+    最初のパケットで定常状態になるように内部状態を初期化する
+    """
+    def __init__(self, cutoff=1.0, sample_rate=10, order=4):
+        self.cutoff = cutoff
+        self.sample_rate = sample_rate
+        self.order = order
+        self.sos = signal.butter(order, cutoff, fs=sample_rate, output='sos')
+        self.zi_unit = signal.sosfilt_zi(self.sos)  # 入力1の定常状態 (セクション数, 2)
+        self.reset()
+
+    def reset(self):
+        self.zi = None
+
+    def _initial_state(self, first):
+        return self.zi_unit[:, :, np.newaxis] * first.reshape(1, 1, -1)
+
+    def update(self, frame):
+        frame = np.asarray(frame, dtype=np.float64)
+        shape = frame.shape
+        frame = frame.reshape(1, -1)
+        if self.zi is None:
+            self.zi = self._initial_state(frame[0])
+        y, self.zi = signal.sosfilt(self.sos, frame, axis=0, zi=self.zi)
+        return y[0].reshape(shape)
+
+    def filter(self, x, zero_phase=False):
+        """
+        zero_phase=True なら前後両方向に掛けて位相遅れのない結果を返す (バッチ専用)
+        """
+        x = np.asarray(x, dtype=np.float64)
+        self.reset()
+        if zero_phase:
+            return signal.sosfiltfilt(self.sos, x, axis=0)
+        if len(x) == 0:
+            return x.copy()
+        flat = x.reshape(len(x), -1)
+        y, self.zi = signal.sosfilt(self.sos, flat, axis=0, zi=self._initial_state(flat[0]))
+        return y.reshape(x.shape)
+
+
+class HampelFilter(StreamingFilter):
+    """
+    Hampelフィルタによる外れ値の除去
+
+    直近 window パケット (現在のパケットを含む) の中央値から
+    n_sigmas × 1.4826 × 中央絶対偏差 より離れた値を中央値で置き換える。
+    因果的に動かすため、判定には現在までのパケットだけを使う。
+    """
+    def __init__(self, window=7, n_sigmas=3.0):
+        self.window = window
+        self.n_sigmas = n_sigmas
+        self.reset()
+
+    def reset(self):
+        self.frames = FloatRingBuffer(self.window)
+
+    def _replace(self, current, windows):
+        median = np.median(windows, axis=0)
+        mad = MAD_SCALE * np.median(np.abs(windows - median), axis=0)
+        return np.where(np.abs(current - median) > self.n_sigmas * mad, median, current)
+
+    def update(self, frame):
+        frame = np.asarray(frame, dtype=np.float64)
+        self.frames.append(frame)
+        windows, _ = self.frames.latest()
+        return self._replace(frame, windows)
+
+    def filter(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        self.reset()
+        head = min(len(x), self.window - 1)
+        result = np.empty_like(x)
+        # 窓が埋まるまではパケットごとに、埋まった後は全窓をまとめて処理する
+        for i in range(head):
+            result[i] = self.update(x[i])
+        if len(x) >= self.window:
+            windows = np.lib.stride_tricks.sliding_window_view(x, self.window, axis=0)
+            result[head:] = self._replace(x[head:], np.moveaxis(windows, -1, 0))
+            for frame in x[-self.window:]:
+                self.frames.append(frame)
+        return result
+
+
+class FilterChain(StreamingFilter):
+    """
+    複数のフィルタを順に掛ける (例: 外れ値除去 → ローパス)
+    """
+    def __init__(self, filters):
+        self.filters = list(filters)
+
+    def reset(self):
+        for f in self.filters:
+            f.reset()
+
+    def update(self, frame):
+        for f in self.filters:
+            frame = f.update(frame)
+        return frame
+
+    def filter(self, x):
+        for f in self.filters:
+            x = f.filter(x)
+        return x
+
+
+# make_filter で使う名前 -> (クラス, 位置引数の名前)
+FILTERS = {
+    'ma': (MovingAverage, ['window']),
+    'ema': (ExponentialMovingAverage, ['alpha']),
+    'butter': (ButterworthLowpass, ['cutoff', 'sample_rate', 'order']),
+    'hampel': (HampelFilter, ['window', 'n_sigmas']),
+}
+
+
+def make_filter(spec):
+    """
+    'hampel:7:3,butter:1.0:10' のような文字列からフィルタを作る
+    コンマ区切りで複数書くと、その順に掛ける FilterChain になる
+    """
+    filters = []
+    for item in spec.split(','):
+        name, *args = item.strip().split(':')
+        if name not in FILTERS:
+            raise ValueError(f"未知のフィルタです: {name} (使えるもの: {', '.join(FILTERS)})")
+        cls, arg_names = FILTERS[name]
+        kwargs = {key: (int(value) if key in ('window', 'order') else float(value))
+                  for key, value in zip(arg_names, args)}
+        filters.append(cls(**kwargs))
+    return filters[0] if len(filters) == 1 else FilterChain(filters)
@@ -0,0 +1,70 @@
+import time
+import threading
+from capture_daemon import DEFAULT_SOCKET, iter_socket_frames
+from replay import PcapReplaySource
+
+
+class FrameConsumerMixin:
+    """
+    (タイムスタンプ, CSI) の列を detect_motion に流す処理をまとめたもの
+
+    ras.py と realtime_judge.py の検出器が共通で使う。使う側は running, metrics,
+    device 属性と detect_motion(csi_frame, timestamp) を持っていること。
+    """
+    def consume(self, frames):
+        """
+        (タイムスタンプ, CSI) を返すイテラブルからフレームを読み、順に detect_motion に渡す
+        """
+        metrics = self.metrics
+        waited = time.perf_counter()
+        for timestamp, csi_frame in frames:
+            if not self.running:
+                break
+            if metrics is not None:
+                metrics.observe_capture(time.perf_counter() - waited)
+            try:
+                self.detect_motion(csi_frame, timestamp)
+                if metrics is not None:
+                    metrics.observe_frame(timestamp)
+            except Exception as e:
+                if metrics is not None:
+                    metrics.frames_failed.inc()
+                print(f"パケット処理中にエラー: {e}")
+            waited = time.perf_counter()
+
+    def start_subscriber(self, socket_path=DEFAULT_SOCKET, retry_interval=1.0):
+        """
+        自分ではキャプチャせず、capture_daemon が配るデコード済みフレームを購読する
+        デーモンに接続できないか接続が切れたら retry_interval 秒ごとに接続し直す
+        (retry_interval=None なら接続し直さずに購読を終える)
+        """
+        self.running = True
+        threading.Thread(target=self._subscribe, args=(socket_path, retry_interval), daemon=True).start()
+        print(f"キャプチャデーモン {socket_path} の購読を開始")
+
+    def _subscribe(self, socket_path, retry_interval):
+        while self.running:
+            try:
+                self.consume(iter_socket_frames(socket_path))
+                reason = "接続が切れました"
+            except (OSError, ValueError) as e:
+                reason = f"接続できません: {e}"
+            if not self.running:
+                break
+            if retry_interval is None:
+                print(f"キャプチャデーモン {socket_path} の購読を終了します ({reason})")
+                self.running = False
+                break
+            print(f"キャプチャデーモン {socket_path} に{reason}。{retry_interval} 秒後に接続し直します")
+            time.sleep(retry_interval)
+
+    def start_replay(self, pcap_path, speed=1.0):
+        """
+        記録済みpcapをライブキャプチャの代わりに流す (speed=None でできるだけ速く)
+        """
+        self.running = True
+        source = PcapReplaySource(pcap_path, self.device, speed=speed, reuse_frames=True)
+        if self.metrics is not None:
+            self.metrics.attach_parser(source.parser)
+        threading.Thread(target=self.consume, args=(source,), daemon=True).start()
+        print(f"{pcap_path} の再生を開始")
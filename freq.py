@@ -1,5 +1,6 @@
 from scipy.fft import fft, fftfreq
 from nexcsi import decoder
+import pcap_loader
 import numpy as np
 import matplotlib.pyplot as plt
 from scipy.signal import spectrogram
@@ -7,7 +8,7 @@ from scipy.signal import spectrogram
 # デバイス設定
 device = 'raspberrypi'
 # pcapファイルの読み込みとCSIデータの取得
-samples = decoder(device).read_pcap('pcaps/19.pcap')  # ファイル名は適宜変更
+samples = pcap_loader.read_pcap('pcaps/19.pcap')  # ファイル名は適宜変更
 csi_data = decoder(device).unpack(samples['csi'])
 
 amplitude = np.abs(csi_data)
@@ -0,0 +1,447 @@
+import time
+import struct
+import socket
+import argparse
+import threading
+import socketserver
+import multiprocessing
+from collections import OrderedDict
+from itertools import combinations
+import numpy as np
+
+# センサーノード -> 統合サービス間で送るCSIフレームの形式
+# マジック, ノードID, 連番, タイムスタンプ, サブキャリア数 の後に complex64 のCSIが続く
+FRAME_MAGIC = b'CSIF'
+FRAME_HEADER = struct.Struct('<4sHIdH')
+LENGTH_PREFIX = struct.Struct('<I')  # TCPでのフレーム長
+
+
+def encode_frame(node_id, seq, timestamp, csi):
+    csi = np.ascontiguousarray(csi, dtype=np.complex64).ravel()
+    return FRAME_HEADER.pack(FRAME_MAGIC, node_id, seq & 0xffffffff, timestamp, len(csi)) + csi.tobytes()
+
+
+def decode_frame(data):
+    """
+    Returns:
+        (ノードID, 連番, タイムスタンプ, CSI複素数配列)
+    """
+    magic, node_id, seq, timestamp, nsub = FRAME_HEADER.unpack_from(data)
+    if magic != FRAME_MAGIC:
+        raise ValueError("CSIフレームのマジックナンバーが不正です")
+    csi = np.frombuffer(data, dtype=np.complex64, count=nsub, offset=FRAME_HEADER.size)
+    return node_id, seq, timestamp, csi
+
+
+def cross_features(node_ids, frames, eps=1e-6):
+    """
+    受信機間の特徴量 (振幅の差と比) をノードの組ごとに計算する
+    ノードのCSIが (フレーム数, サブキャリア数) なら平均振幅を使う
+
+    Returns:
+        {'difference': {(i, j): 配列}, 'ratio': {(i, j): 配列}}
+    """
+    amplitude = {node_id: np.abs(np.atleast_2d(frames[node_id])).mean(axis=0)
+                 for node_id in node_ids if node_id in frames}
+    features = {'difference': {}, 'ratio': {}}
+    for i, j in combinations(sorted(amplitude), 2):
+        features['difference'][(i, j)] = amplitude[i] - amplitude[j]
+        features['ratio'][(i, j)] = amplitude[i] / (amplitude[j] + eps)
+    return features
+
+
+class TimeAligner:
+    """
+    複数ノードのフレームを共通の時間グリッドにそろえる
+
+    タイムスタンプを grid_period 秒ごとのスロットに割り当て、スロットに入ったフレームはノードごとに全て残す。
+    全ノードからスロットの終わりより max_skew 秒以上新しいフレームが届いたらスロットを閉じて出力し、
+    そろわないスロットも最初のフレームの到着から max_delay 秒経てば min_nodes 以上あれば出力する。
+    出力 (on_fused の呼び出し) は start() で起動する1つのスレッドが時刻順に行うので、
+    on_fused はスレッドセーフでなくてよく、入力が途絶えても保留中のスロットは max_delay で出力される。
+    保留中のスロット数は max_pending までに制限し、あふれた古いスロットは待たずに閉じて出力する (forced_emits に数える)。
+
+    on_fused(タイムスタンプ, {ノードID: CSI (フレーム数, サブキャリア数)}, 受信機間特徴量)
+    """
+    def __init__(self, node_ids, on_fused, grid_period=0.01, max_delay=0.1, min_nodes=2, max_pending=1000,
+                 max_skew=None):
+        self.node_ids = sorted(node_ids)
+        self.on_fused = on_fused
+        self.grid_period = grid_period
+        self.max_delay = max_delay
+        self.min_nodes = min_nodes
+        self.max_pending = max_pending
+        # ノード間の時計ずれ・到着順の入れ替わりの許容幅 (デフォルトはグリッド1つ分)
+        self.max_skew = grid_period if max_skew is None else max_skew
+        self._slots = OrderedDict()  # スロット -> (締め切り, {ノードID: [CSI, ...]})
+        self._newest = {}            # ノードごとの最新のタイムスタンプ
+        self._last_emitted = None
+        self._cond = threading.Condition()
+        self._thread = None
+        self.running = False
+        self.received = 0
+        self.fused = 0
+        self.fused_frames = 0
+        self.partial = 0
+        self.dropped_late = 0
+        self.dropped_unknown = 0
+        self.dropped_incomplete = 0
+        self.forced_emits = 0  # 保留があふれて、閉じるのを待たずに出力したスロット数
+
+    def start(self):
+        self.running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        出力スレッドを止め、保留中のスロットを全て出力する
+        """
+        with self._cond:
+            self.running = False
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+        with self._cond:
+            ready = self._pop_ready(flush=True)
+        self._emit_all(ready)
+
+    def add(self, node_id, timestamp, csi):
+        slot = int(round(timestamp / self.grid_period))
+        with self._cond:
+            self.received += 1
+            if node_id not in self.node_ids:
+                self.dropped_unknown += 1
+                return
+            if self._last_emitted is not None and slot <= self._last_emitted:
+                self.dropped_late += 1
+                return
+            entry = self._slots.get(slot)
+            if entry is None:
+                newest_slot = next(reversed(self._slots)) if self._slots else None
+                entry = self._slots[slot] = (time.monotonic() + self.max_delay, {})
+                # スロットは時刻順に並べておく (ほとんどの場合は末尾への追加で済む)
+                if newest_slot is not None and slot < newest_slot:
+                    self._slots = OrderedDict(sorted(self._slots.items()))
+            entry[1].setdefault(node_id, []).append(csi)
+            self._newest[node_id] = max(self._newest.get(node_id, timestamp), timestamp)
+            self._cond.notify()
+
+    def _closed(self, slot, deadline, now):
+        if now >= deadline:
+            return True
+        # 全ノードのフレームがスロットの終わり + max_skew を過ぎていれば、このスロットにはもう届かない
+        end = (slot + 0.5) * self.grid_period + self.max_skew
+        return all(self._newest.get(node_id, -np.inf) >= end for node_id in self.node_ids)
+
+    def _pop_ready(self, flush=False):
+        # 閉じたスロットを古い順に取り出す (ロックを持って呼ぶ)
+        now = time.monotonic()
+        ready = []
+        while self._slots:
+            slot, (deadline, frames) = next(iter(self._slots.items()))
+            forced = len(self._slots) > self.max_pending
+            if not forced and not flush and not self._closed(slot, deadline, now):
+                break
+            self._slots.popitem(last=False)
+            self._last_emitted = slot
+            if len(frames) >= self.min_nodes:
+                self.forced_emits += forced
+                ready.append((slot, frames))
+            else:
+                self.dropped_incomplete += 1
+        return ready
+
+    def _next_deadline(self):
+        if not self._slots:
+            return None
+        return next(iter(self._slots.values()))[0]
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self.running:
+                    return
+                ready = self._pop_ready()
+                if not ready:
+                    deadline = self._next_deadline()
+                    timeout = self.max_delay if deadline is None else max(deadline - time.monotonic(), 0)
+                    self._cond.wait(timeout)
+                    continue
+            self._emit_all(ready)
+
+    def _emit_all(self, ready):
+        for slot, frames in ready:
+            self._emit(slot, frames)
+
+    def _emit(self, slot, frames):
+        frames = {node_id: np.array(node_frames) for node_id, node_frames in frames.items()}
+        self.fused += 1
+        self.fused_frames += sum(len(node_frames) for node_frames in frames.values())
+        if len(frames) < len(self.node_ids):
+            self.partial += 1
+        self.on_fused(slot * self.grid_period, frames, cross_features(self.node_ids, frames))
+
+    def stats(self):
+        return {
+            'received': self.received,
+            'fused': self.fused,
+            'fused_frames': self.fused_frames,
+            'partial': self.partial,
+            'dropped_late': self.dropped_late,
+            'dropped_unknown': self.dropped_unknown,
+            'dropped_incomplete': self.dropped_incomplete,
+            'forced_emits': self.forced_emits,
+            'pending': len(self._slots),
+        }
+
+
+class FusionServer:
+    """
+    複数のセンサーノードからUDP/TCPでCSIフレームを受け取り、時刻をそろえて統合する
+
+    on_fused(タイムスタンプ, {ノードID: CSI}, 受信機間特徴量) が統合スロットごとに、
+    TimeAligner の出力スレッドから1つずつ呼ばれる
+    """
+    def __init__(self, node_ids, on_fused, host='0.0.0.0', port=5600, grid_period=0.01, max_delay=0.1,
+                 min_nodes=2, max_pending=1000, max_skew=None):
+        self.host = host
+        self.port = port
+        self.aligner = TimeAligner(node_ids, on_fused, grid_period, max_delay, min_nodes, max_pending, max_skew)
+        self.running = False
+        self.decode_errors = 0
+        self.udp_socket = None
+        self.tcp_server = None
+        self.threads = []
+
+    def start(self):
+        self.running = True
+        self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+        self.udp_socket.bind((self.host, self.port))
+        self.udp_socket.settimeout(0.5)
+
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                server._tcp_loop(self.rfile)
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self.tcp_server = socketserver.ThreadingTCPServer((self.host, self.port), Handler)
+        self.tcp_server.daemon_threads = True
+
+        self.aligner.start()
+        self.threads = [
+            threading.Thread(target=self._udp_loop, daemon=True),
+            threading.Thread(target=self.tcp_server.serve_forever, daemon=True),
+        ]
+        for thread in self.threads:
+            thread.start()
+        print(f"統合サービスを {self.host}:{self.port} (UDP/TCP) で開始しました")
+
+    def stop(self):
+        self.running = False
+        if self.tcp_server is not None:
+            self.tcp_server.shutdown()
+            self.tcp_server.server_close()
+        for thread in self.threads:
+            thread.join(timeout=2)
+        if self.udp_socket is not None:
+            self.udp_socket.close()
+        self.aligner.stop()
+
+    def _handle(self, data):
+        try:
+            node_id, _, timestamp, csi = decode_frame(data)
+        except (ValueError, struct.error):
+            self.decode_errors += 1
+            return
+        self.aligner.add(node_id, timestamp, csi)
+
+    def _udp_loop(self):
+        buffer = bytearray(65536)
+        while self.running:
+            try:
+                nbytes = self.udp_socket.recv_into(buffer)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            # 統合スロットが残っている間も参照されるのでコピーしてから渡す
+            self._handle(bytes(buffer[:nbytes]))
+
+    def _tcp_loop(self, rfile):
+        while self.running:
+            header = rfile.read(LENGTH_PREFIX.size)
+            if len(header) < LENGTH_PREFIX.size:
+                return
+            length, = LENGTH_PREFIX.unpack(header)
+            data = rfile.read(length)
+            if len(data) < length:
+                return
+            self._handle(data)
+
+    def stats(self):
+        stats = self.aligner.stats()
+        stats['decode_errors'] = self.decode_errors
+        return stats
+
+
+class SensorNode:
+    """
+    センサーノード側: CSIフレームを統合サービスへ送る
+    """
+    def __init__(self, node_id, host, port=5600, protocol='udp'):
+        self.node_id = node_id
+        self.address = (host, port)
+        self.protocol = protocol
+        self.seq = 0
+        if protocol == 'udp':
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        else:
+            self.sock = socket.create_connection(self.address)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def send(self, timestamp, csi):
+        data = encode_frame(self.node_id, self.seq, timestamp, csi)
+        self.seq += 1
+        if self.protocol == 'udp':
+            self.sock.sendto(data, self.address)
+        else:
+            self.sock.sendall(LENGTH_PREFIX.pack(len(data)) + data)
+
+    def close(self):
+        self.sock.close()
+
+
+def run_live_node(node_id, host, port, interface, protocol='udp', capture_filter='dst port 5500'):
+    """
+    ラズパイ上でtcpdumpのストリームを読み、デコードしたCSIを統合サービスへ送り続ける
+    """
+    import subprocess
+    from csi_stream import iter_pcap_frames
+
+    node = SensorNode(node_id, host, port, protocol)
+    cmd = ['sudo', 'tcpdump', '-i', interface, '-U', '-w', '-'] + capture_filter.split()
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    try:
+        for timestamp, csi_frame in iter_pcap_frames(process.stdout):
+            node.send(timestamp, csi_frame)
+    finally:
+        process.terminate()
+        node.close()
+
+
+def simulate_node(node_id, host, port, pcap_path, rate, duration, protocol='udp', jitter=0.002, start_time=None):
+    """
+    記録済みpcapのCSIを rate フレーム/秒で送り続ける模擬ノード (別プロセスで実行)
+    """
+    from pcap_loader import load_csi
+
+    csi = load_csi(pcap_path, 'raspberrypi')
+    node = SensorNode(node_id, host, port, protocol)
+    rng = np.random.default_rng(node_id)
+    start_time = time.time() if start_time is None else start_time
+    period = 1.0 / rate
+    i = 0
+    while True:
+        # 全ノード共通の時刻グリッド上の時刻に、ノードごとの時計ずれを加えて送る
+        timestamp = start_time + i * period
+        if timestamp - start_time > duration:
+            break
+        delay = timestamp - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        node.send(timestamp + rng.uniform(-jitter, jitter), csi[i % len(csi)])
+        i += 1
+    node.close()
+
+
+def feed_detector(detector, pair, feature='ratio'):
+    """
+    統合した受信機間特徴量を検出器の detect_motion に流す on_fused コールバックを作る
+    on_fused は TimeAligner の出力スレッドだけから呼ばれるので、検出器の状態にロックは要らない
+    """
+    def on_fused(timestamp, frames, features):
+        values = features[feature].get(pair)
+        if values is not None:
+            detector.detect_motion(values, timestamp)
+    return on_fused
+
+
+def main():
+    parser = argparse.ArgumentParser(description='複数ラズパイのCSIを統合するサービス')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    server_parser = subparsers.add_parser('server', help='統合サービスを起動する')
+    server_parser.add_argument('--nodes', type=int, nargs='+', default=[0, 1, 2], help='ノードID')
+    server_parser.add_argument('--port', type=int, default=5600)
+    server_parser.add_argument('--grid', type=float, default=0.01, help='時間グリッドの間隔 (秒)')
+    server_parser.add_argument('--max-delay', type=float, default=0.1, help='スロットを待つ最大時間 (秒)')
+    server_parser.add_argument('--max-skew', type=float, default=None,
+                               help='ノード間の時計ずれの許容幅 (秒, デフォルトはグリッド1つ分)')
+    server_parser.add_argument('--simulate', type=str, nargs='*', default=None,
+                               help='指定したpcapを再生する模擬ノードをローカルで起動する')
+    server_parser.add_argument('--rate', type=float, default=500, help='模擬ノード1台あたりのフレーム/秒')
+    server_parser.add_argument('--duration', type=float, default=10, help='模擬ノードの送信時間 (秒)')
+    server_parser.add_argument('--protocol', choices=['udp', 'tcp'], default='udp')
+    server_parser.add_argument('--detect', action='store_true', help='ノード0と1の振幅比で動き検出を行う')
+
+    node_parser = subparsers.add_parser('node', help='センサーノードとしてCSIを送る')
+    node_parser.add_argument('--node-id', type=int, required=True)
+    node_parser.add_argument('--server', type=str, required=True, help='統合サービスのホスト名')
+    node_parser.add_argument('--port', type=int, default=5600)
+    node_parser.add_argument('-i', '--interface', type=str, default='wlan0')
+    node_parser.add_argument('--protocol', choices=['udp', 'tcp'], default='udp')
+
+    args = parser.parse_args()
+
+    if args.command == 'node':
+        run_live_node(args.node_id, args.server, args.port, args.interface, args.protocol)
+        return
+
+    if args.detect:
+        from ras import NexmonCSIMotionDetector
+        on_fused = feed_detector(NexmonCSIMotionDetector(), (args.nodes[0], args.nodes[1]))
+    else:
+        on_fused = lambda timestamp, frames, features: None
+
+    server = FusionServer(args.nodes, on_fused, port=args.port, grid_period=args.grid, max_delay=args.max_delay,
+                          max_skew=args.max_skew)
+    server.start()
+
+    processes = []
+    if args.simulate is not None:
+        pcap_files = args.simulate or ['pcaps/001.pcap']
+        start_time = time.time() + 1.0
+        for n, node_id in enumerate(args.nodes):
+            process = multiprocessing.Process(
+                target=simulate_node,
+                args=(node_id, '127.0.0.1', args.port, pcap_files[n % len(pcap_files)], args.rate,
+                      args.duration, args.protocol),
+                kwargs={'jitter': args.grid / 4, 'start_time': start_time},
+                daemon=True,
+            )
+            process.start()
+            processes.append(process)
+
+    start = time.time()
+    try:
+        while not processes or any(process.is_alive() for process in processes):
+            time.sleep(1)
+            stats = server.stats()
+            elapsed = time.time() - start
+            print(f"受信 {stats['received'] / elapsed:.0f} フレーム/秒, 統合 {stats['fused'] / elapsed:.0f} スロット/秒 "
+                  f"({stats['fused_frames']} フレーム), 欠け {stats['partial']}, 遅着 {stats['dropped_late']}, "
+                  f"保留 {stats['pending']}")
+        time.sleep(args.max_delay * 2)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+        print(server.stats())
+
+
+if __name__ == "__main__":
+    main()
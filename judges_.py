@@ -1,64 +1,90 @@
 import numpy as np
 from nexcsi import decoder
+import pcap_loader
 import matplotlib.pyplot as plt
+from functools import lru_cache
+from reference_cache import load_profile
+from dataset import load_recording
+from scoring import squared_error
 
 # デバイス設定
 device = 'raspberrypi'    
 
+class ReferenceModel:
+    """
+    参照データの平均振幅と二乗誤差の統計を一度だけ求めて保持するモデル
+    (パケット数, サブキャリア数) の配列をまとめて判定する
+    """
+    def __init__(self, features=None):
+        self.mean = None
+        self.train_error_mean = None
+        # features.FeatureStage を渡すと、マスク・主成分への射影をした特徴量の空間で比較する
+        self.features = features
+
+    def fit(self, amp):
+        """
+        参照データの振幅 (パケット数, サブキャリア数) から統計を求める
+        """
+        x = self._transform(amp)
+        self.mean = np.average(x, axis=0)
+        self.train_error_mean = np.average(get_squared_error(x, self.mean))
+        return self
+
+    @classmethod
+    def from_pcap(cls, pcap_path, device=device, features=None):
+        """
+        キャッシュ済みの参照プロファイルからモデルを作る
+        特徴量の空間で比較する場合は、データストアのCSIから学習し直す
+        """
+        if features is not None:
+            return cls(features).fit(np.abs(load_recording(pcap_path).csi))
+        profile = load_profile(pcap_path, device)
+        model = cls()
+        model.mean = profile.mean
+        model.train_error_mean = profile.error_mean
+        return model
+
+    def _transform(self, data):
+        data = np.asarray(data)
+        return data if self.features is None else self.features.transform(data)
+
+    def squared_error(self, data):
+        return get_squared_error(self._transform(data), self.mean)
+
+    def label(self, data, threshold_ratio, label, below=True):
+        """
+        二乗誤差が threshold_ratio * 学習時の誤差平均 より小さい(below=False なら大きい)
+        パケットに label を付けたラベル配列を返す
+        """
+        error = self.squared_error(data)
+        threshold = threshold_ratio * self.train_error_mean
+        hit = error < threshold if below else error > threshold
+        return np.where(hit, label, 0)
+
+
+@lru_cache(maxsize=None)
+def reference_model(pcap_path):
+    """
+    pcapファイルごとに一度だけ作ったモデルを使い回す
+    """
+    return ReferenceModel.from_pcap(pcap_path)
+
+
 #立ったかどうかを判定できればうれしい
 def isStanding(data, threshold_ratio=3):
-    #立った状態のエラーの平均
-    standing = decoder(device).read_pcap('pcaps/013.pcap')
-    standing_csi = decoder(device).unpack(standing['csi'])
-    standing_amp = np.abs(standing_csi)
-    #こいつは比較用のやつ
-    standing_ave = np.average(standing_amp, axis=0)
-    error1 = get_squared_error(standing_amp, standing_ave)
-    train_error_ave = np.average(error1)
-    
-    error = get_squared_error(data, standing_ave)
-
-    isStandingLabel = [0]*len(error)
-    for i in range(len(error)):
-        if error[i] < threshold_ratio * train_error_ave:
-            isStandingLabel[i] = 1
-    
-    return isStandingLabel
+    #立った状態の参照データとの二乗誤差が小さければ1
+    return reference_model('pcaps/013.pcap').label(data, threshold_ratio, 1, below=True)
 
 def isSitting(data, threshold_ratio=8):
-    # 座っている状態のエラーの平均
-    sitting = decoder(device).read_pcap('pcaps/014.pcap')  # 座っているときのPCAPファイルを使用
-    sitting_csi = decoder(device).unpack(sitting['csi'])
-    sitting_amp = np.abs(sitting_csi)
-    
-    # 座っているときのデータの平均振幅
-    sitting_ave = np.average(sitting_amp, axis=0)
-    
-    # 座っているときのエラーを計算
-    error1 = get_squared_error(sitting_amp, sitting_ave)
-    train_error_ave = np.average(error1)
-    
-    # 新しいデータとの比較を行う
-    error = get_squared_error(data, sitting_ave)
-
-    # 座っているラベルのリスト
-    isSittingLabel = [0]*len(error)
-    for i in range(len(error)):
-        if error[i] > threshold_ratio * train_error_ave:
-            isSittingLabel[i] = 2
-    
-    return isSittingLabel
+    # 座っている状態の参照データとの二乗誤差が大きければ2
+    return reference_model('pcaps/014.pcap').label(data, threshold_ratio, 2, below=False)
 
 #二乗誤差和を計算
 def get_squared_error(data, judge_ave):
-    error = []
-    for i in range(len(data)):
-        error.append(np.sum((data[i] - judge_ave)**2))
-
-    return error
+    return squared_error(data, judge_ave)
 
 if __name__=="__main__":
-    sample = decoder(device).read_pcap('pcaps/015.pcap')
+    sample = pcap_loader.read_pcap('pcaps/015.pcap')
     data = decoder(device).unpack(sample['csi'])
     data_amp = np.abs(data)
 
@@ -1,11 +1,12 @@
 from nexcsi import decoder
+import pcap_loader
 import numpy as np
 import matplotlib.pyplot as plt
 from judges_ import isStanding
 
 device = 'raspberrypi'
 
-sample = decoder(device).read_pcap('pcaps/009.pcap')
+sample = pcap_loader.read_pcap('pcaps/009.pcap')
 data = decoder(device).unpack(sample['csi'])
 data_amp = np.abs(data)
 
@@ -0,0 +1,275 @@
+import time
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_METRICS_PORT = 9110
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# 段ごとの処理時間のヒストグラムの境界 (秒)
+STAGE_BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0)
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric:
+    """
+    メトリクスの基底クラス (ラベルごとの子を持つ)
+
+    ラベルなしならそのまま inc/set/observe を呼び、ラベルありなら
+    labels(値...) で子を取り出してから呼ぶ。子は作ったものを使い回すので、
+    よく使う子は変数に取っておけば更新は属性の足し算だけで済む。
+    """
+    type_name = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._children[()] = self._new_child()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        key = tuple(str(v) for v in values)
+        if len(key) != len(self.labelnames):
+            raise ValueError(f"{self.name} のラベルは {self.labelnames} です")
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def __getattr__(self, attr):
+        # ラベルなしのメトリクスは子のメソッドをそのまま呼べるようにする
+        if attr.startswith('_') or self.labelnames:
+            raise AttributeError(attr)
+        return getattr(self._children[()], attr)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        for key, child in list(self._children.items()):
+            lines.extend(child.render(self.name, self.labelnames, key))
+        return lines
+
+
+class _Value:
+    def __init__(self):
+        self.value = 0.0
+        self.function = None
+
+    def set_function(self, function):
+        """
+        出力するときに function() を呼んで値を取る (既存のカウンタをそのまま公開する場合など)
+        """
+        self.function = function
+
+    def get(self):
+        return self.function() if self.function is not None else self.value
+
+    def render(self, name, labelnames, key):
+        return [f"{name}{_format_labels(labelnames, key)} {_format_value(self.get())}"]
+
+
+class _CounterValue(_Value):
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class _GaugeValue(_Value):
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+
+class _HistogramValue:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labelnames, key):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            labels = _format_labels(labelnames, key, ('le', _format_value(bound)))
+            lines.append(f"{name}_bucket{labels} {cumulative}")
+        labels = _format_labels(labelnames, key)
+        lines.append(f"{name}_sum{labels} {_format_value(self.sum)}")
+        lines.append(f"{name}_count{labels} {self.count}")
+        return lines
+
+
+class Counter(Metric):
+    type_name = 'counter'
+
+    def _new_child(self):
+        return _CounterValue()
+
+
+class Gauge(Metric):
+    type_name = 'gauge'
+
+    def _new_child(self):
+        return _GaugeValue()
+
+
+class Histogram(Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=STAGE_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        Metric.__init__(self, name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+
+class Registry:
+    """
+    メトリクスをまとめてPrometheusのテキスト形式で出力する
+    """
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"{metric.name} は登録済みです")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=STAGE_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+class PipelineMetrics:
+    """
+    検出器の キャプチャ → デコード → 特徴量 → 判定 の各段を計測するメトリクス一式
+
+    各段の処理時間は time.perf_counter() の差をヒストグラムに足すだけで、
+    パケット数などはパーサが元々数えている値を出力時に読むので、常時有効にしてよい。
+    """
+    STAGES = ('capture', 'decode', 'feature', 'decision')
+
+    def __init__(self, registry=None):
+        self.registry = registry or Registry()
+        r = self.registry
+        self.stage_seconds = r.histogram('csi_stage_seconds', 'パイプラインの段ごとの処理時間 (秒)', ['stage'])
+        self.stages = {stage: self.stage_seconds.labels(stage) for stage in self.STAGES}
+        self.packets = r.counter('csi_packets_total', '段ごとのパケット数', ['state'])
+        self.frames_processed = self.packets.labels('processed')
+        self.frames_failed = self.packets.labels('failed')
+        self.decisions = r.counter('csi_decisions_total', '判定の結果ごとの回数', ['result'])
+        self.queue_depth = r.gauge('csi_queue_depth', '処理待ちのデータ量', ['queue'])
+        self.lag = r.gauge('csi_capture_lag_seconds', '最後に処理したパケットのキャプチャ時刻からの遅れ (秒)')
+        self.baseline_drift = r.gauge('csi_baseline_drift', '適応的な背景の基準時点からのずれ (基準の標準偏差単位)')
+        r.gauge('csi_start_time_seconds', '計測を始めた時刻 (UNIX時間)').set(time.time())
+        self._decode_seconds = 0.0
+
+    def attach_parser(self, parser):
+        """
+        PcapStreamParser の数えているパケット数をメトリクスとして公開し、デコード時間を計測させる
+        """
+        self.packets.labels('received').set_function(lambda: parser.records)
+        self.packets.labels('decoded').set_function(lambda: parser.frames)
+        self.packets.labels('decode_error').set_function(lambda: parser.decode_errors)
+        self.packets.labels('lost').set_function(lambda: parser.lost_packets)
+        self.queue_depth.labels('parser_bytes').set_function(parser.buffered_bytes)
+        parser.decode_observer = self.observe_decode
+        return parser
+
+    def observe_decode(self, seconds):
+        self.stages['decode'].observe(seconds)
+        self._decode_seconds += seconds
+
+    def observe_capture(self, waited):
+        """
+        次のフレームを待った時間を記録する
+        待ち時間にはパーサでのデコード時間も含まれるので、それを引いた分をキャプチャの時間とする
+        """
+        self.stages['capture'].observe(max(waited - self._decode_seconds, 0.0))
+        self._decode_seconds = 0.0
+
+    def observe_frame(self, timestamp):
+        self.frames_processed.inc()
+        if timestamp:
+            self.lag.set(time.time() - timestamp)
+
+    def observe_decision(self, result):
+        self.decisions.labels(result).inc()
+
+    def render(self):
+        return self.registry.render()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = None
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # アクセスごとのログは出さない
+        pass
+
+
+def serve_metrics(registry, port=DEFAULT_METRICS_PORT, host='127.0.0.1'):
+    """
+    /metrics でメトリクスを返すHTTPサーバを別スレッドで起動する
+    """
+    handler = type('MetricsHandler', (_MetricsHandler,), {'registry': registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"メトリクスを http://{host}:{server.server_address[1]}/metrics で公開しています")
+    return server
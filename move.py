@@ -1,7 +1,5 @@
-from nexcsi import decoder
-import numpy as np
 import matplotlib.pyplot as plt
-import seaborn as sns
+from csiphase import load_phase, phase_change
 
 # デバイス設定
 device = 'raspberrypi'
@@ -12,21 +10,12 @@ sum_abs_phase_diff_list = []  # 結果を保存するリスト
 
 # 2つのPCAPファイルのデータ処理
 for pcap_file in pcap_files:
-    # pcapファイルの読み込みとCSIデータの取得
-    samples = decoder(device).read_pcap(pcap_file)
-    csi_data = decoder(device).unpack(samples['csi'])
-
-    # 位相データの抽出
-    phase = np.angle(csi_data)
-
-    # 位相差分の計算
-    phase_diff = np.diff(phase, axis=0)
-
-    # 位相差分の絶対値を計算
-    abs_phase_diff = np.abs(phase_diff)
+    # 補正済みの位相 (アンラップしてパケットごとの傾きとオフセットを除いたもの) を取得
+    # 1度計算した位相はデータストアにキャッシュされる
+    phase = load_phase(pcap_file)
 
     # 各時点での絶対位相変化の合計を計算
-    sum_abs_phase_diff = np.sum(abs_phase_diff, axis=1)
+    sum_abs_phase_diff = phase_change(phase)
     
     # 結果をリストに追加
     sum_abs_phase_diff_list.append(sum_abs_phase_diff)
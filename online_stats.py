@@ -0,0 +1,240 @@
+import numpy as np
+from ringbuffer import FloatRingBuffer
+
+
+class SlidingWindowStats:
+    """
+    直近 window フレームの統計をサブキャリアごとに逐次更新する
+
+    フレームが窓に入る/出るたびに和・二乗和・隣接フレーム差の絶対値の和を
+    足し引きするだけなので、1フレームあたりの計算量は O(サブキャリア数) で
+    窓の長さによらない。丸め誤差が溜まらないよう、resync_every フレームごとに
+    窓全体から計算し直す (ならすと1フレームあたり O(サブキャリア数))。
+    """
+    def __init__(self, window, resync_every=None):
+        if window < 1:
+            raise ValueError("window は1以上を指定してください")
+        self.window = window
+        self.resync_every = resync_every if resync_every is not None else window
+        self.frames = FloatRingBuffer(window)
+        self._shift = None  # 桁落ちを防ぐため、和と二乗和はこの値を引いてから取る
+        self._sum = None
+        self._sumsq = None
+        self._diff_sum = None
+        self._since_resync = 0
+
+    def __len__(self):
+        return len(self.frames)
+
+    def update(self, frame, timestamp=0.0):
+        """
+        フレームを1つ窓に追加し、あふれた最古のフレームを統計から取り除く
+        """
+        frame = np.asarray(frame, dtype=np.float64)
+        if self._sum is None:
+            self._shift = frame.copy()
+            self._sum = np.zeros(frame.shape)
+            self._sumsq = np.zeros(frame.shape)
+            self._diff_sum = np.zeros(frame.shape)
+
+        n = len(self.frames)
+        if n > 0:
+            window, _ = self.frames.latest()
+            if n == self.window:
+                # 最古のフレームと、それと次のフレームとの差を取り除く
+                oldest = window[0]
+                shifted = oldest - self._shift
+                self._sum -= shifted
+                self._sumsq -= shifted * shifted
+                if n > 1:
+                    self._diff_sum -= np.abs(window[1] - oldest)
+            if self.window > 1:
+                self._diff_sum += np.abs(frame - window[-1])
+
+        shifted = frame - self._shift
+        self._sum += shifted
+        self._sumsq += shifted * shifted
+        self.frames.append(frame, timestamp)
+
+        self._since_resync += 1
+        if self._since_resync >= self.resync_every:
+            self.resync()
+
+    def resync(self):
+        """
+        窓全体から統計を計算し直す
+        """
+        window, _ = self.frames.latest()
+        self._shift = np.mean(window, axis=0)
+        shifted = window - self._shift
+        self._sum = np.sum(shifted, axis=0)
+        self._sumsq = np.sum(shifted * shifted, axis=0)
+        self._diff_sum = np.sum(np.abs(np.diff(window, axis=0)), axis=0)
+        self._since_resync = 0
+
+    def mean(self):
+        return self._shift + self._sum / len(self.frames)
+
+    def var(self):
+        shifted_mean = self._sum / len(self.frames)
+        return np.maximum(self._sumsq / len(self.frames) - shifted_mean * shifted_mean, 0)
+
+    def std(self):
+        return np.sqrt(self.var())
+
+    def mean_abs_diff(self):
+        """
+        窓内の隣接フレーム間の差の絶対値の平均 (サブキャリアごと)
+        """
+        n = len(self.frames)
+        if n < 2:
+            return np.zeros_like(self._sum)
+        return self._diff_sum / (n - 1)
+
+
+class AdaptiveBaseline:
+    """
+    静かなときの振幅をサブキャリアごとの指数移動平均・分散として追い続ける背景モデル
+
+    各パケットを背景からのずれ (サブキャリアごとの (x - 平均)^2 / 分散 の平均) で評価し、
+    motion_threshold を超えたら動きありとみなす。動きがある間と、その後 hold パケットの間は
+    背景を更新しない (動いている人を背景に取り込まない)。家具の移動や温度・AGCの変化のような
+    ゆっくりした変化は背景の更新で吸収し、基準時点からの背景のずれが drift_bound を超えたら
+    drifted を立てる (参照の取り直しの目安)。
+
+    急に変わってそのまま戻らない変化 (家具の移動など) では、背景を止めたままだと動きありが
+    いつまでも続く。更新の停止が max_freeze パケット続いたら動きではなく背景の変化とみなし、
+    暖機と同じ手順で今のパケットから背景を作り直す。ドリフトの基準はそのまま残すので、
+    作り直した背景のずれは drift / drifted に表れる (max_freeze=None なら作り直さない)。
+
+    更新は作業用の配列を使い回すサブキャリア数に比例する計算だけなので、
+    1パケットあたり O(サブキャリア数) でキャプチャと同じ速度で回せる。
+    """
+    def __init__(self, alpha=0.01, warmup=50, motion_threshold=4.0, hold=10, drift_bound=2.0, min_var=1e-6,
+                 max_freeze=2000):
+        if not 0 < alpha <= 1:
+            raise ValueError("alpha は 0 < alpha <= 1 で指定してください")
+        self.alpha = alpha
+        self.warmup = warmup
+        self.motion_threshold = motion_threshold
+        self.hold = hold
+        self.drift_bound = drift_bound
+        self.min_var = min_var
+        self.max_freeze = max_freeze
+        self.reset()
+
+    def reset(self):
+        self.n = 0  # 背景の更新に使ったパケット数
+        self.mean = None
+        self.var = None
+        self.reference_mean = None  # ドリフトを測る基準 (暖機の終わりか rebase() の時点の背景)
+        self.reference_std = None
+        self.score = 0.0
+        self.drift = 0.0
+        self.motion = False
+        self.drifted = False
+        self.frozen_until = 0
+        self.frozen_since = None  # 背景の更新を止めはじめたパケット番号
+        self.relearned = 0  # 停止が長すぎて背景を作り直した回数
+        self.packets = 0
+        self._diff = None
+        self._work = None
+
+    @property
+    def ready(self):
+        return self.n >= self.warmup
+
+    def deviation(self, frame):
+        """
+        背景からのずれ (サブキャリアごとの (x - 平均)^2 / 分散 の平均, 静かなときはおよそ1)
+        """
+        np.subtract(frame, self.mean, out=self._diff)
+        np.multiply(self._diff, self._diff, out=self._work)
+        self._work /= self.var
+        return float(np.mean(self._work))
+
+    def update(self, frame, motion=None):
+        """
+        1パケット分の振幅で背景を更新し、動きありと判定したかを返す
+
+        motion を渡すと (検出器自身の判定など) 自前の判定の代わりにそれで背景の更新を止める。
+        暖機中 (warmup パケットまで) は通常の平均・分散として背景を作り、動きありとは判定しない。
+        """
+        frame = np.asarray(frame, dtype=np.float64)
+        self.packets += 1
+        if self.mean is None:
+            self.mean = frame.copy()
+            self.var = np.zeros(frame.shape)
+            self._diff = np.empty(frame.shape)
+            self._work = np.empty(frame.shape)
+            self.n = 1
+            return False
+
+        if not self.ready:
+            # 暖機中は重み 1/n の (指数でない) 平均・分散
+            self._accumulate(frame, 1.0 / (self.n + 1))
+            if self.ready:
+                if self.reference_mean is None:
+                    self.rebase()
+                else:
+                    # 作り直した背景は元の基準と比べる
+                    self._update_drift()
+            return False
+
+        self.score = self.deviation(frame)
+        if motion is None:
+            motion = self.score > self.motion_threshold
+        self.motion = bool(motion)
+        if self.motion:
+            self.frozen_until = self.packets + self.hold
+            if self.frozen_since is None:
+                self.frozen_since = self.packets
+            if self.max_freeze is not None and self.packets - self.frozen_since >= self.max_freeze:
+                self._relearn(frame)
+                return False
+        elif self.packets > self.frozen_until:
+            self.frozen_since = None
+            self._accumulate(frame, self.alpha)
+            self._update_drift()
+        return self.motion
+
+    def _relearn(self, frame):
+        # 今のパケットから暖機をやり直す (平均・分散だけ捨て、ドリフトの基準は残す)
+        self.mean[:] = frame
+        self.var[:] = 0
+        self.n = 1
+        self.motion = False
+        self.frozen_until = 0
+        self.frozen_since = None
+        self.relearned += 1
+
+    def _accumulate(self, frame, weight):
+        # 指数重み付きの平均と分散の逐次更新 (weight = 1/n なら通常の平均・分散と同じ)
+        diff = np.subtract(frame, self.mean, out=self._diff)
+        increment = np.multiply(diff, weight, out=self._work)
+        self.mean += increment
+        diff *= increment
+        self.var += diff
+        self.var *= 1 - weight
+        np.maximum(self.var, self.min_var, out=self.var)
+        self.n += 1
+
+    def _update_drift(self):
+        # 基準時点の背景からのずれを、基準時点の標準偏差を単位にしてサブキャリアについて平均する
+        np.subtract(self.mean, self.reference_mean, out=self._work)
+        np.abs(self._work, out=self._work)
+        self._work /= self.reference_std
+        self.drift = float(np.mean(self._work))
+        self.drifted = self.drift > self.drift_bound
+
+    def rebase(self):
+        """
+        現在の背景をドリフトの基準にする (参照を取り直したときなど)
+        """
+        self.reference_mean = self.mean.copy()
+        self.reference_std = np.sqrt(np.maximum(self.var, self.min_var))
+        self.drift = 0.0
+        self.drifted = False
+
+    def std(self):
+        return np.sqrt(self.var)
@@ -0,0 +1,223 @@
+import os
+import struct
+import numpy as np
+from nexcsi import decoder, nulls, pilots
+from csi_stream import (PCAP_GLOBAL_HEADER_LEN, PCAP_RECORD_HEADER_LEN, NBYTES_HEADERS, NBYTES_NEXMON_META,
+                        INTERLEAVED_DEVICES, parse_global_header, find_bandwidth)
+
+# レコードヘッダの先頭から見た、IPアドレス・ポート (12バイト) とUDPペイロード (Nexmonメタデータ) の位置
+ADDR_OFFSET = PCAP_RECORD_HEADER_LEN + 26
+PAYLOAD_OFFSET = PCAP_RECORD_HEADER_LEN + NBYTES_HEADERS
+
+
+def sample_dtype(bandwidth, pcap_path=None):
+    """
+    nexcsi の read_pcap と同じ構造化dtype (メタデータも同じ)
+    """
+    nsub = int(bandwidth * 3.2)
+    return np.dtype(
+        [
+            ("ts_sec", np.uint32),
+            ("ts_usec", np.uint32),
+            ("saddr", np.dtype(np.uint32).newbyteorder('>')),
+            ("daddr", np.dtype(np.uint32).newbyteorder('>')),
+            ("sport", np.dtype(np.uint16).newbyteorder('>')),
+            ("dport", np.dtype(np.uint16).newbyteorder('>')),
+            ("magic", np.uint16),
+            ("rssi", np.int8),
+            ("fctl", np.uint8),
+            ("mac", np.uint8, 6),
+            ("seq", np.uint16),
+            ("css", np.uint16),
+            ("csp", np.uint16),
+            ("cvr", np.uint16),
+            ("csi", np.int16, nsub * 2),
+        ],
+        metadata={
+            'bandwidth': bandwidth,
+            'pcap_filepath': pcap_path,
+            'nulls': nulls[bandwidth],
+            'pilots': pilots[bandwidth],
+        }
+    )
+
+
+def record_dtype(dtype, stride, byteorder='<'):
+    """
+    pcapのレコード1つ (レコードヘッダ + パケット, stride バイト) を sample_dtype と同じ名前の
+    フィールドで読む構造化dtype。ファイル上のレコードの並びにそのまま重ねて使う。
+    """
+    names, formats, offsets = [], [], []
+    for name in dtype.names:
+        field_dtype, offset = dtype.fields[name][:2]
+        if offset < 8:
+            # タイムスタンプはレコードヘッダ (pcapのバイトオーダー)
+            field_dtype = field_dtype.newbyteorder(byteorder)
+        elif offset < 20:
+            offset += ADDR_OFFSET - 8
+        else:
+            offset += PAYLOAD_OFFSET - 20
+        names.append(name)
+        formats.append(field_dtype)
+        offsets.append(offset)
+    return np.dtype({'names': names, 'formats': formats, 'offsets': offsets, 'itemsize': stride})
+
+
+def index_records(raw, byteorder='<', min_len=0):
+    """
+    pcapのレコードの位置を1回の走査で調べ、長さの同じレコードが連続する区間
+    (先頭のオフセット, レコードの間隔, レコード数) のリストを返す
+
+    全レコードが同じ長さなら、長さの列をストライド付きのビューで確かめるだけで済ませる。
+    min_len より短いパケット (CSIの入っていないパケット) と末尾の書きかけのレコードは除く。
+    """
+    size = len(raw)
+    offset = PCAP_GLOBAL_HEADER_LEN
+    if size < offset + PCAP_RECORD_HEADER_LEN:
+        return []
+    record_header = struct.Struct(byteorder + 'IIII')
+    first_len = record_header.unpack_from(raw, offset)[2]
+    stride = PCAP_RECORD_HEADER_LEN + first_len
+    count, rest = divmod(size - offset, stride)
+    if rest == 0 and first_len >= min_len:
+        lengths = np.ndarray(count, dtype=byteorder + 'u4', buffer=raw, offset=offset + 8, strides=(stride,))
+        if np.all(lengths == first_len):
+            return [(offset, stride, count)]
+
+    runs = []
+    run_start, run_stride, run_count = offset, 0, 0
+    while offset + PCAP_RECORD_HEADER_LEN <= size:
+        incl_len = record_header.unpack_from(raw, offset)[2]
+        stride = PCAP_RECORD_HEADER_LEN + incl_len
+        if offset + stride > size:
+            break
+        if incl_len >= min_len:
+            if stride == run_stride and offset == run_start + run_stride * run_count:
+                run_count += 1
+            else:
+                if run_count:
+                    runs.append((run_start, run_stride, run_count))
+                run_start, run_stride, run_count = offset, stride, 1
+        offset += stride
+    if run_count:
+        runs.append((run_start, run_stride, run_count))
+    return runs
+
+
+class PcapIndex:
+    """
+    メモリマップしたpcapファイルと、そのCSIパケットの位置の索引
+    """
+    def __init__(self, pcap_path, bandwidth=None):
+        if os.path.getsize(pcap_path) < PCAP_GLOBAL_HEADER_LEN:
+            raise ValueError(f"pcapファイルではありません: {pcap_path}")
+        self.pcap_path = pcap_path
+        self.raw = np.memmap(pcap_path, dtype=np.uint8, mode='r')
+        self.byteorder, _ = parse_global_header(self.raw[:PCAP_GLOBAL_HEADER_LEN].tobytes())
+        if bandwidth is None:
+            # nexcsi と同じく最初のパケットの長さから帯域幅を決める
+            first_len = 0
+            if len(self.raw) >= PCAP_GLOBAL_HEADER_LEN + PCAP_RECORD_HEADER_LEN:
+                first_len = struct.unpack_from(self.byteorder + 'I', self.raw, PCAP_GLOBAL_HEADER_LEN + 8)[0]
+            bandwidth = find_bandwidth(first_len)
+        self.bandwidth = bandwidth
+        self.nsub = int(bandwidth * 3.2)
+        self.dtype = sample_dtype(bandwidth, pcap_path)
+        min_len = NBYTES_HEADERS + NBYTES_NEXMON_META + self.nsub * 4
+        self.runs = index_records(self.raw, self.byteorder, min_len)
+        self.n_packets = sum(count for _, _, count in self.runs)
+
+    def views(self):
+        """
+        区間ごとに (出力での先頭位置, レコードに重ねた構造化配列のビュー) を返す (コピーはしない)
+        """
+        position = 0
+        for offset, stride, count in self.runs:
+            dtype = record_dtype(self.dtype, stride, self.byteorder)
+            yield position, np.ndarray(count, dtype=dtype, buffer=self.raw, offset=offset, strides=(stride,))
+            position += count
+
+    def samples(self):
+        """
+        nexcsi の read_pcap と同じ構造化配列にまとめて読み出す
+        """
+        samples = np.empty(self.n_packets, dtype=self.dtype)
+        for position, view in self.views():
+            samples[position:position + len(view)] = view
+        return samples
+
+    def csi(self, out=None):
+        """
+        全パケットのCSIを fftshift済みの complex64 (パケット数, サブキャリア数) に読み出す
+        (int16の実部・虚部の並びの機種用。nexcsi の unpack と同じ結果)
+        """
+        nsub = self.nsub
+        if out is None:
+            out = np.empty((self.n_packets, nsub), dtype=np.complex64)
+        values = out.view(np.float32)
+        for position, view in self.views():
+            csi = view['csi']
+            rows = slice(position, position + len(view))
+            np.copyto(values[rows, :nsub], csi[:, nsub:], casting='unsafe')
+            np.copyto(values[rows, nsub:], csi[:, :nsub], casting='unsafe')
+        return out
+
+
+def read_pcap(pcap_path, bandwidth=None):
+    """
+    nexcsi の read_pcap の代わりに使う、メモリマップによる一括読み込み
+    同じフィールド・メタデータの構造化配列を返す
+
+    nexcsi との違い: CSIが入りきらない短いパケット (帯域幅から決まる長さに満たないもの) と
+    末尾の書きかけのレコードは読み飛ばす。nexcsi はこれらも1パケットとして読み、足りない分に
+    次のレコードのバイトを詰めるので、そうしたパケットを含むpcapではパケット数と並びが nexcsi と
+    一致しない。結果を nexcsi の unpack でデコードしても、パケットの集合はこの関数で決まる。
+    """
+    return PcapIndex(pcap_path, bandwidth).samples()
+
+
+def unpack(csi, device='raspberrypi'):
+    """
+    read_pcap の 'csi' 列 (int16, (パケット数, サブキャリア数 * 2)) を
+    fftshift済みの complex64 の ndarray に変換する (nexcsi の unpack と同じ値, np.matrix ではない)
+    """
+    csi = np.asarray(csi)
+    if device not in INTERLEAVED_DEVICES:
+        return np.asarray(decoder(device).unpack(csi))
+    nsub = csi.shape[-1] // 2
+    out = np.empty(csi.shape[:-1] + (nsub,), dtype=np.complex64)
+    values = out.view(np.float32)
+    np.copyto(values[..., :nsub], csi[..., nsub:], casting='unsafe')
+    np.copyto(values[..., nsub:], csi[..., :nsub], casting='unsafe')
+    return out
+
+
+def load_csi(pcap_path, device='raspberrypi'):
+    """
+    pcapファイルのCSIだけを complex64 (パケット数, サブキャリア数) で読む
+    構造化配列を経由せず、ファイルから出力の配列に直接書き込む
+    (read_pcap と同じく短いパケットは読み飛ばす)
+    """
+    if device not in INTERLEAVED_DEVICES:
+        return unpack(read_pcap(pcap_path)['csi'], device)
+    return PcapIndex(pcap_path).csi()
+
+
+if __name__ == "__main__":
+    # nexcsi の read_pcap / unpack と結果が一致することと、読み込み時間を比べる
+    import sys
+    import time
+
+    device = 'raspberrypi'
+    for pcap_file in sys.argv[1:]:
+        start = time.perf_counter()
+        expected = decoder(device).read_pcap(pcap_file)
+        expected_csi = np.asarray(decoder(device).unpack(expected['csi']))
+        nexcsi_time = time.perf_counter() - start
+        start = time.perf_counter()
+        samples = read_pcap(pcap_file)
+        csi = unpack(samples['csi'], device)
+        loader_time = time.perf_counter() - start
+        same = np.array_equal(samples, expected) and np.array_equal(csi, expected_csi)
+        print(f"{pcap_file}: {len(samples)} パケット 一致 {same}  "
+              f"nexcsi {nexcsi_time * 1e3:.1f} ms / pcap_loader {loader_time * 1e3:.1f} ms")
@@ -1,4 +1,5 @@
 from nexcsi import decoder
+import pcap_loader
 import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
@@ -7,7 +8,7 @@ import seaborn as sns
 device = 'raspberrypi'
 
 # pcapファイルの読み込みとCSIデータの取得
-samples = decoder(device).read_pcap('pcaps/001.pcap')  # ファイル名は適宜変更
+samples = pcap_loader.read_pcap('pcaps/001.pcap')  # ファイル名は適宜変更
 csi_data = decoder(device).unpack(samples['csi'])
 
 # 位相データの抽出
@@ -1,27 +1,18 @@
-import numpy as np
 import matplotlib.pyplot as plt
-from nexcsi import decoder
+from csiphase import load_phase
 
 # デバイス設定
 device = 'raspberrypi'
 
-# pcapファイル1の読み込みとCSIデータの取得
-samples1 = decoder(device).read_pcap('pcaps/001.pcap')  # ファイル名は適宜変更
-csi_data1 = decoder(device).unpack(samples1['csi'])
+# 補正済みの位相 (アンラップしてパケットごとの傾きとオフセットを除いたもの) を取得（ファイル1）
+phase1 = load_phase('pcaps/001.pcap')  # ファイル名は適宜変更
 
-# pcapファイル2の読み込みとCSIデータの取得
-samples2 = decoder(device).read_pcap('pcaps/101.pcap')  # ファイル名は適宜変更
-csi_data2 = decoder(device).unpack(samples2['csi'])
+# 補正済みの位相を取得（ファイル2）
+phase2 = load_phase('pcaps/101.pcap')  # ファイル名は適宜変更
 
-# それぞれのcsiデータの形を確認
-print(f"CSI Data 1 shape: {csi_data1.shape}")
-print(f"CSI Data 2 shape: {csi_data2.shape}")
-
-# 位相データの抽出（ファイル1）
-phase1 = np.angle(csi_data1)
-
-# 位相データの抽出（ファイル2）
-phase2 = np.angle(csi_data2)
+# それぞれの位相データの形を確認
+print(f"Phase Data 1 shape: {phase1.shape}")
+print(f"Phase Data 2 shape: {phase2.shape}")
 
 # 位相のヒートマップをプロット
 plt.figure(figsize=(14, 6))
@@ -1,20 +1,16 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import sys
-import time
 import threading
 import subprocess
 import signal
 import argparse
 import numpy as np
 import matplotlib.pyplot as plt
-import matplotlib as mpl
 from matplotlib import font_manager
 from matplotlib.animation import FuncAnimation
 from matplotlib.lines import Line2D
-from datetime import datetime
-import os
+from matplotlib.collections import LineCollection
 
 # 日本語フォントサポートを設定
 def setup_japanese_fonts():
@@ -43,34 +39,38 @@ def setup_japanese_fonts():
         plt.rcParams['font.sans-serif'] = ['DejaVu Sans', 'Arial', 'Helvetica', 'sans-serif']
         return False
 
-# nexcsiライブラリをインポート
-try:
-    import nexcsi
-except ImportError:
-    print("nexcsiライブラリがインストールされていません。")
-    print("pip install nexcsi でインストールしてください。")
-    sys.exit(1)
+from csi_stream import PcapStreamParser, iter_pcap_frames
+from ringbuffer import ComplexRingBuffer, FloatRingBuffer
+from capture_daemon import DEFAULT_SOCKET, iter_socket_frames
+from recorder import CSIRecorder
+from shm_pipeline import SharedRingBuffer
 
 # グローバル変数
 running = True
-data_lock = threading.Lock()
-csi_buffer = []
-buffer_max_size = 100
+buffer_max_size = 1000  # 描画の間に届くフレームをすべて保持できる長さ
+csi_buffer = ComplexRingBuffer(buffer_max_size)
 
 # 設定
 SUBCARRIER_NUM = 64  # サブキャリア数
 PLOT_LEN = 100       # プロット表示するサンプル数
+DEFAULT_FPS = 10     # 描画レート (キャプチャのレートとは独立)
 
 class CSICapture(threading.Thread):
-    def __init__(self, interface, mac_address=None, buffer=None):
+    def __init__(self, interface, mac_address=None, buffer=None, socket_path=None):
         threading.Thread.__init__(self)
         self.interface = interface
         self.mac_address = mac_address
-        self.buffer = buffer if buffer is not None else []
+        self.socket_path = socket_path  # 指定するとcapture_daemonの配信を購読する
+        self.buffer = buffer if buffer is not None else ComplexRingBuffer(buffer_max_size)
         self.process = None
+        self.parser = PcapStreamParser()
         self.daemon = True
         
     def run(self):
+        if self.socket_path:
+            self._run_subscriber()
+            return
+
         # tcpdumpコマンドを構築
         cmd = ['sudo', 'tcpdump', '-i', self.interface, '-U', '-w', '-']
         if self.mac_address:
@@ -85,32 +85,13 @@ class CSICapture(threading.Thread):
             stderr=subprocess.DEVNULL
         )
         
-        # CSIデータの取得ループ
+        # pcapストリームをレコード単位で組み立ててCSIデータを取得するループ
         try:
-            while running:
-                # パケットデータを読み取る（サイズは調整可能）
-                packet_data = self.process.stdout.read(2048)
-                
-                if not packet_data:
-                    time.sleep(0.001)
-                    continue
-                
-                # nexcsi.decoderでCSIデータを抽出
-                try:
-                    csi_data = nexcsi.decoder(packet_data)
-                    if csi_data is not None:
-                        # CSIデータが取得できた場合、バッファに追加
-                        with data_lock:
-                            self.buffer.append({
-                                'timestamp': time.time(),
-                                'csi': csi_data
-                            })
-                            # バッファサイズ制限
-                            if len(self.buffer) > buffer_max_size:
-                                self.buffer.pop(0)
-                except Exception as e:
-                    # デコードエラーは無視
-                    pass
+            for timestamp, csi_data in iter_pcap_frames(self.process.stdout, parser=self.parser):
+                if not running:
+                    break
+                # 容量を超えた古いフレームはリングバッファが上書きする
+                self.buffer.append(csi_data, timestamp)
                 
         except Exception as e:
             print(f"CSIキャプチャエラー: {e}")
@@ -122,28 +103,40 @@ class CSICapture(threading.Thread):
                 except:
                     self.process.kill()
 
+    def _run_subscriber(self):
+        # 自分ではキャプチャせず、デーモンがデコード済みのフレームを受け取る
+        print(f"キャプチャデーモン {self.socket_path} を購読します")
+        try:
+            for timestamp, csi_data in iter_socket_frames(self.socket_path):
+                if not running:
+                    break
+                self.buffer.append(csi_data, timestamp)
+        except Exception as e:
+            print(f"CSI購読エラー: {e}")
+
 class CSIRealTimePlot:
-    def __init__(self, csi_buffer, save_dir=None, mode='amplitude'):
+    def __init__(self, csi_buffer, save_dir=None, mode='amplitude', capture=None, fps=DEFAULT_FPS):
         self.csi_buffer = csi_buffer
+        self.cursor = csi_buffer.count  # 前回の描画までに読んだフレーム数
+        self.fps = fps
+        self.capture = capture  # スループット表示用のCSICapture
         self.save_dir = save_dir
         self.mode = mode  # 'amplitude' または 'phase'
         self.ani = None  # アニメーションオブジェクトを初期化
         
-        # データ保存用ディレクトリの作成
+        # データの保存は別スレッドのレコーダーがリングバッファから直接行う
+        # (CSVが必要なら python recorder.py csv <save_dir> で変換する)
         if save_dir:
-            os.makedirs(save_dir, exist_ok=True)
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            self.csv_file = open(f"{save_dir}/csi_data_{timestamp}.csv", 'w')
-            self.csv_file.write("timestamp,")
-            for i in range(SUBCARRIER_NUM):
-                self.csv_file.write(f"subcarrier{i},")
-            self.csv_file.write("\n")
+            self.recorder = CSIRecorder(csi_buffer, save_dir)
+            self.recorder.start()
         else:
-            self.csv_file = None
+            self.recorder = None
         
         # プロット用のデータ配列を初期化
-        self.amplitude_history = np.zeros((PLOT_LEN, SUBCARRIER_NUM))
-        self.timestamp_history = np.zeros(PLOT_LEN)
+        self.history = FloatRingBuffer(PLOT_LEN, (SUBCARRIER_NUM,))
+        for _ in range(PLOT_LEN):
+            self.history.append(np.zeros(SUBCARRIER_NUM))
+        self.amplitude_history, self.timestamp_history = self.history.latest()
         
         # プロット設定
         plt.style.use('ggplot')
@@ -163,11 +156,13 @@ class CSIRealTimePlot:
         self.ax1.set_xlabel('サンプル')
         self.ax1.grid(True)
         
-        # サブキャリアごとの線をプロット
-        self.lines = []
-        for i in range(SUBCARRIER_NUM):
-            line, = self.ax1.plot([], [], lw=1, label=f'SC {i}' if i % 16 == 0 else "")
-            self.lines.append(line)
+        # 全サブキャリアの線を1つのLineCollectionとしてまとめて描画する
+        # 線分の座標配列 (サブキャリア数, PLOT_LEN, 2) は使い回し、y座標だけを書き換える
+        self.segments = np.zeros((SUBCARRIER_NUM, PLOT_LEN, 2))
+        self.segments[:, :, 0] = np.arange(PLOT_LEN)
+        colors = plt.get_cmap('viridis')(np.linspace(0, 1, SUBCARRIER_NUM))
+        self.lines = LineCollection(self.segments, colors=colors, linewidths=1)
+        self.ax1.add_collection(self.lines)
         
         # 凡例
         legend_elements = [Line2D([0], [0], color='black', lw=1, label='サブキャリア')]
@@ -199,14 +194,18 @@ class CSIRealTimePlot:
         self.cbar.set_label(self.cbar_label)
         
         # パケット情報表示用のテキスト
-        self.info_text = self.fig.text(0.5, 0.01, '', ha='center')
+        # blitで再描画できるのは軸に属するアーティストだけなので、figureではなく上段の軸の中に置く
+        self.info_text = self.ax1.text(
+            0.01, 0.97, '', transform=self.ax1.transAxes, ha='left', va='top',
+            bbox=dict(facecolor='white', alpha=0.8, edgecolor='none')
+        )
     
     def start_animation(self):
         # アニメーションの作成と保持
         self.ani = FuncAnimation(
             self.fig, 
             self.update_plot, 
-            interval=100, 
+            interval=1000 / self.fps,
             cache_frame_data=False,
             blit=True
         )
@@ -215,60 +214,60 @@ class CSIRealTimePlot:
     def update_plot(self, frame):
         global running
         
-        # バッファからデータを取得
-        with data_lock:
-            buffer_data = list(self.csi_buffer)
-        
-        if not buffer_data:
-            return self.lines + [self.heatmap]
+        # 前回の描画以降にバッファへ届いたフレームをすべて取得
+        frames, timestamps, self.cursor = self.csi_buffer.read_since(self.cursor, copy=True)
         
-        # 最新のCSIデータを処理
-        latest_data = buffer_data[-1]
-        csi_complex = latest_data['csi']
+        if len(frames) == 0:
+            return [self.lines, self.heatmap, self.info_text]
         
-        # CSIデータの振幅または位相を計算
+        # 受け取った全フレームの振幅または位相をまとめて計算
+        csi_values = frames[:, :SUBCARRIER_NUM]
         if self.mode == 'amplitude':
-            csi_values = np.abs(csi_complex)
-            # 0-1に正規化
-            max_val = np.max(csi_values) if np.max(csi_values) > 0 else 1
-            csi_values = csi_values / max_val
+            csi_values = np.abs(csi_values)
+            # フレームごとに0-1に正規化
+            max_val = np.max(csi_values, axis=1, keepdims=True)
+            csi_values = csi_values / np.where(max_val > 0, max_val, 1)
         else:
-            csi_values = np.angle(csi_complex)
+            csi_values = np.angle(csi_values)
         
-        # 履歴データを更新
-        self.amplitude_history = np.roll(self.amplitude_history, -1, axis=0)
-        self.amplitude_history[-1, :] = csi_values[:SUBCARRIER_NUM]
+        # 履歴データを更新 (表示に使うのは直近PLOT_LENフレームだけ)
+        self.history.extend(csi_values, timestamps)
+        self.amplitude_history, self.timestamp_history = self.history.latest()
         
-        self.timestamp_history = np.roll(self.timestamp_history, -1)
-        self.timestamp_history[-1] = latest_data['timestamp']
-        
-        # プロットを更新
-        x = np.arange(PLOT_LEN)
-        for i, line in enumerate(self.lines):
-            if i < SUBCARRIER_NUM:
-                line.set_data(x, self.amplitude_history[:, i])
+        # プロットを更新 (描画コストは届いたフレーム数によらず一定)
+        self.segments[:, :, 1] = self.amplitude_history.T
+        self.lines.set_segments(self.segments)
         
         # ヒートマップを更新
-        self.heatmap.set_array(self.amplitude_history.T)
+        self.heatmap.set_data(self.amplitude_history.T)
         
         # 情報テキストを更新
-        self.info_text.set_text(f'取得パケット数: {len(buffer_data)}')
-        
-        # データを保存
-        if self.csv_file:
-            timestamp_str = datetime.fromtimestamp(latest_data['timestamp']).strftime("%Y-%m-%d %H:%M:%S.%f")
-            self.csv_file.write(f"{timestamp_str},")
-            for val in csi_values[:SUBCARRIER_NUM]:
-                self.csv_file.write(f"{val},")
-            self.csv_file.write("\n")
-            self.csv_file.flush()
+        if self.capture is not None:
+            stats = self.capture.parser.stats()
+            self.info_text.set_text(
+                f"取得パケット数: {stats['frames']}  "
+                f"{stats['packets_per_sec']:.0f} pkt/s  "
+                f"ロス率: {stats['loss_rate']:.1%}  "
+                f"デコード失敗: {stats['decode_errors']}"
+            )
+        elif isinstance(self.csi_buffer, SharedRingBuffer):
+            # 別プロセスのキャプチャがリングバッファに書き出した統計を表示する
+            stats = self.csi_buffer.stats()
+            self.info_text.set_text(
+                f"取得パケット数: {stats['written']}  "
+                f"{stats['packets_per_sec']:.0f} pkt/s  "
+                f"ロス率: {stats['loss_rate']:.1%}  "
+                f"デコード失敗: {stats['decode_errors']}"
+            )
+        else:
+            self.info_text.set_text(f'取得パケット数: {self.csi_buffer.count}')
         
-        return self.lines + [self.heatmap]
+        return [self.lines, self.heatmap, self.info_text]
     
     def close(self):
         plt.close(self.fig)
-        if self.csv_file:
-            self.csv_file.close()
+        if self.recorder:
+            self.recorder.stop()
 
 def signal_handler(sig, frame):
     global running
@@ -286,28 +285,41 @@ def main():
     
     # コマンドライン引数
     parser = argparse.ArgumentParser(description='nexcsiを使用したリアルタイムCSIプロットツール')
-    parser.add_argument('-i', '--interface', type=str, required=True,
+    parser.add_argument('-i', '--interface', type=str, default='wlan0',
                         help='CSIデータを取得するネットワークインターフェース名 (例: wlan0)')
     parser.add_argument('-m', '--mac', type=str, default=None,
                         help='CSIデータを取得する対象のMACアドレス (例: 00:11:22:33:44:55)')
     parser.add_argument('-s', '--save-dir', type=str, default=None,
                         help='CSIデータを保存するディレクトリ')
+    parser.add_argument('-d', '--daemon', type=str, nargs='?', const=DEFAULT_SOCKET, default=None,
+                        help='tcpdumpを起動せず、capture_daemon のソケットを購読する')
+    parser.add_argument('--shm', type=str, default=None,
+                        help='キャプチャせず、shm_pipeline の共有メモリのリングバッファ (名前) を描画する')
     parser.add_argument('-p', '--phase', action='store_true',
                         help='振幅の代わりに位相をプロットする')
+    parser.add_argument('--fps', type=float, default=DEFAULT_FPS,
+                        help=f'1秒あたりの描画回数 (デフォルト: {DEFAULT_FPS})')
     
     args = parser.parse_args()
     
     # 信号ハンドラ設定
     signal.signal(signal.SIGINT, signal_handler)
     
-    # CSIキャプチャスレッドの開始
-    csi_thread = CSICapture(args.interface, args.mac, csi_buffer)
-    csi_thread.start()
+    # CSIキャプチャスレッドの開始 (共有メモリを描画するだけなら、キャプチャは別プロセスが行う)
+    buffer = csi_buffer
+    csi_thread = None
+    if args.shm:
+        buffer = SharedRingBuffer.attach(args.shm)
+    else:
+        csi_thread = CSICapture(args.interface, args.mac, csi_buffer, socket_path=args.daemon)
+        csi_thread.start()
     
     # プロットの設定と開始
+    plot = None
     try:
         mode = 'phase' if args.phase else 'amplitude'
-        plot = CSIRealTimePlot(csi_buffer, args.save_dir, mode)
+        plot = CSIRealTimePlot(buffer, args.save_dir, mode,
+                               capture=None if args.daemon else csi_thread, fps=args.fps)
         
         # アニメーションを開始し、グローバル変数に保持して参照を保つ
         global animation
@@ -319,8 +331,14 @@ def main():
     finally:
         global running
         running = False
-        if csi_thread.is_alive():
+        if csi_thread is not None and csi_thread.is_alive():
             csi_thread.join(timeout=2)
+        if plot is not None:
+            plot.close()
+            if plot.recorder:
+                print(f"記録したフレーム数: {plot.recorder.stats()['frames']}")
+        if buffer is not csi_buffer:
+            buffer.close()
 
 if __name__ == "__main__":
     # グローバル変数として参照を保持するためにanimationを定義
@@ -0,0 +1,114 @@
+import numpy as np
+from scipy.fft import fft
+from ringbuffer import FloatRingBuffer
+
+
+def band_mask(n, sample_rate, freq_band):
+    """
+    長さnのFFTの各ビンが周波数帯 freq_band (絶対値) に入るかどうかのマスク
+    """
+    freq_axis = np.fft.fftfreq(n, 1/sample_rate)
+    return (freq_band[0] <= np.abs(freq_axis)) & (np.abs(freq_axis) <= freq_band[1])
+
+
+def band_energy(fft_abs, mask):
+    """
+    帯域内の各ビンについてサブキャリア平均の振幅スペクトルを取り、その和を返す
+    """
+    return np.sum(np.mean(fft_abs[mask], axis=1))
+
+
+def batch_presence(csi_amp, sample_rate=10, freq_band=(0.1, 2.0), threshold=10000):
+    """
+    記録全体をFFTして、人の動きに対応する帯域のエネルギーで在室を判定する (バッチ版)
+    """
+    fft_result = np.abs(fft(csi_amp, axis=0))
+    energy = band_energy(fft_result, band_mask(csi_amp.shape[0], sample_rate, freq_band))
+    return energy, energy > threshold
+
+
+class StreamingPresenceDetector:
+    """
+    batch_presence (frequency.ispresent) をパケットごとに更新するストリーミング版
+
+    直近 window パケットについて、帯域内のビンだけをスライディングDFTで
+    パケットごとに O(ビン数 × サブキャリア数) で更新し、hop パケットごとに判定を出す。
+    判定の遅れは最大 hop パケット。window を記録全体の長さにすれば、
+    最後のパケットでの判定はバッチ版と一致する。
+    """
+    def __init__(self, window=100, sample_rate=10, freq_band=(0.1, 2.0), threshold=10000, hop=10):
+        self.window = window
+        self.sample_rate = sample_rate
+        self.freq_band = freq_band
+        self.threshold = threshold
+        self.hop = hop
+
+        # 実数入力では |X[n-k]| = |X[k]| なので、帯域内のビンを k = 0..n/2 にまとめて重みを付ける
+        mask = band_mask(window, sample_rate, freq_band)
+        folded = np.minimum(np.arange(window), window - np.arange(window))[mask]
+        self.bins, self.weights = np.unique(folded, return_counts=True)
+        self.twiddle = np.exp(2j * np.pi * self.bins / window)[:, np.newaxis]
+        # 窓全体から計算し直すときのDFT行列 (ビン数, window)
+        self.dft_matrix = np.exp(-2j * np.pi * np.outer(self.bins, np.arange(window)) / window)
+
+        self.frames = FloatRingBuffer(window)
+        self.spectrum = None
+        self.since_resync = 0
+        self.since_decision = 0
+        self.energy = None
+        self.present = None
+
+    def update(self, amplitude, timestamp=0.0):
+        """
+        1パケット分の振幅を追加する
+        判定を出したパケットでは (エネルギー, 在室かどうか) を、それ以外は None を返す
+        """
+        amplitude = np.asarray(amplitude, dtype=np.float64).ravel()
+        if self.spectrum is None:
+            self.spectrum = np.zeros((len(self.bins), len(amplitude)), dtype=np.complex128)
+
+        if len(self.frames) == self.window:
+            frames, _ = self.frames.latest()
+            oldest = frames[0]
+        else:
+            oldest = 0
+        # X_k <- (X_k - x_old + x_new) * exp(2πik/N)
+        self.spectrum += amplitude - oldest
+        self.spectrum *= self.twiddle
+        self.frames.append(amplitude, timestamp)
+
+        # 丸め誤差が溜まらないよう窓1周ごとに計算し直す
+        self.since_resync += 1
+        if self.since_resync >= self.window:
+            self.resync()
+
+        if len(self.frames) < self.window:
+            return None
+        self.since_decision += 1
+        if self.since_decision < self.hop and self.present is not None:
+            return None
+        self.since_decision = 0
+        self.energy = float(np.dot(self.weights, np.mean(np.abs(self.spectrum), axis=1)))
+        self.present = self.energy > self.threshold
+        return self.energy, self.present
+
+    def resync(self):
+        frames, _ = self.frames.latest()
+        if len(frames) == self.window:
+            self.spectrum = self.dft_matrix @ frames
+        self.since_resync = 0
+
+
+if __name__ == "__main__":
+    # 記録済みpcapでバッチ版とストリーミング版の判定が一致することを確認する
+    import sys
+    from pcap_loader import load_csi
+
+    device = 'raspberrypi'
+    for pcap_file in sys.argv[1:]:
+        amplitude = np.abs(load_csi(pcap_file, device))
+        energy, present = batch_presence(amplitude)
+        detector = StreamingPresenceDetector(window=len(amplitude))
+        for frame in amplitude:
+            result = detector.update(frame)
+        print(f"{pcap_file}: バッチ {energy:.1f} ({present}), ストリーミング {result[0]:.1f} ({result[1]})")
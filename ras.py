@@ -5,13 +5,18 @@ import time
 from scipy import signal
 from datetime import datetime
 from nexcsi import decoder
+from csi_stream import PcapStreamParser, iter_pcap_frames
+from frame_consumer import FrameConsumerMixin
+from metrics import DEFAULT_METRICS_PORT, PipelineMetrics, serve_metrics
+from online_stats import SlidingWindowStats
 
-class NexmonCSIMotionDetector:
-    def __init__(self, interface='wlan0', window_size=3, threshold=0.12, k=2.0, pcap_filename='hoge.pcap'):
+class NexmonCSIMotionDetector(FrameConsumerMixin):
+    def __init__(self, interface='wlan0', window_size=3, threshold=0.12, k=2.0, pcap_filename='hoge.pcap', streaming=True, presence_detector=None, metrics=None, prefilter=None, features=None, baseline=None):
         self.interface = interface
         self.window_size = window_size
         self.threshold = threshold
-        self.csi_buffer = []
+        self.window_stats = SlidingWindowStats(window_size)
+        self.csi_buffer = self.window_stats.frames
         self.last_detection_time = 0
         self.cooldown_period = 1  # 検出後のクールダウン（秒）
         self.running = False
@@ -19,12 +24,30 @@ class NexmonCSIMotionDetector:
         self.device = 'raspberrypi'
         self.pcap_filename = pcap_filename
         self.k = k
+        self.streaming = streaming  # Trueならtcpdumpを常駐させてストリームを直接読む
+        self.capture_process = None
+        # presence.StreamingPresenceDetector を渡すとライブで在室判定も行う
+        self.presence_detector = presence_detector
+        self.present = None
+        self.decoder = decoder(self.device)
+        self.file_parser = PcapStreamParser(self.device, reuse_frames=True)
+        # metrics.PipelineMetrics を渡すと段ごとの処理時間やパケット数を計測する
+        self.metrics = metrics
+        # filters.StreamingFilter を渡すと振幅をパケットごとにフィルタしてから判定する
+        self.prefilter = prefilter
+        # features.FeatureStage を渡すと、ヌル・パイロットを除いたサブキャリア (や主成分) で判定する
+        self.features = features
+        # online_stats.AdaptiveBaseline を渡すと、ゆっくり追従する背景からのずれでも動きを検出し、
+        # 背景のドリフトが大きくなったら知らせる
+        self.baseline = baseline
+        self.drifted = False
+        if metrics is not None and baseline is not None:
+            metrics.baseline_drift.set_function(lambda: baseline.drift)
 
     def get_dynamic_threshold(self):
-        if len(self.csi_buffer) < 2:
+        if len(self.window_stats) < 2:
             return 0
-        avg_amplitude = np.mean(self.csi_buffer, axis=0)
-        std_amplitude = np.std(self.csi_buffer, axis=0)
+        std_amplitude = self.window_stats.std()
 
         threshold = self.threshold + self.k * np.mean(std_amplitude)
         return threshold
@@ -69,9 +92,44 @@ class NexmonCSIMotionDetector:
         threading.Thread(target=self._capture_loop, daemon=True).start()
         print(f"Nexmon CSI キャプチャを {self.interface} で開始")
     
+    def stop_capture(self):
+        self.running = False
+        if self.capture_process is not None and self.capture_process.poll() is None:
+            self.capture_process.terminate()
+
     def _capture_loop(self):
+        if self.streaming:
+            self._stream_capture_loop()
+        else:
+            self._file_capture_loop()
+
+    def _stream_capture_loop(self):
         """
-        `tcpdump` の出力をリアルタイムに取得して表示
+        tcpdumpを1つだけ起動し、`-w -` のpcapストリームを読み続けて
+        デコードしたCSIフレームをそのまま detect_motion に渡す
+        """
+        print("CSIデータキャプチャ中 (ストリーミング)...")
+        capture_cmd = ['sudo', 'tcpdump', '-i', self.interface, '-U', '-w', '-'] + self.capture_filter.split()
+        try:
+            self.capture_process = subprocess.Popen(capture_cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            # フレームはすぐに detect_motion で使い切るので、毎回同じ配列にデコードさせる
+            parser = PcapStreamParser(self.device, reuse_frames=True)
+            if self.metrics is not None:
+                self.metrics.attach_parser(parser)
+            self.consume(iter_pcap_frames(self.capture_process.stdout, parser=parser))
+        except Exception as e:
+            print(f"キャプチャループ中にエラー: {e}")
+        finally:
+            if self.capture_process is not None and self.capture_process.poll() is None:
+                self.capture_process.terminate()
+                try:
+                    self.capture_process.wait(timeout=2)
+                except subprocess.TimeoutExpired:
+                    self.capture_process.kill()
+
+    def _file_capture_loop(self):
+        """
+        1パケットごとにtcpdumpを起動してpcapファイルに書き出し、読み直す (旧方式)
         """
         print("CSIデータキャプチャ中...")
         try:
@@ -122,44 +180,86 @@ class NexmonCSIMotionDetector:
 
     def process_pcap_file(self):
         try:
-            sample = decoder(self.device).read_pcap(self.pcap_filename)
-            self.csi_data = decoder(self.device).unpack(sample['csi'])
+            sample = self.decoder.read_pcap(self.pcap_filename)
+            self.csi_data = np.asarray(self.decoder.unpack(sample['csi']))
+            return self.csi_data
         except Exception as e:
             print(f"pcap解析中にエラー:{e}")
+
     def _parse_csi_data(self, raw_line):
+        # tcpdump -c 1 が書き出したpcapを、検出器ごとに1つのパーサで確保済みの配列にデコードする
+        # (返す配列は次のパケットで上書きされる)
         try:
-            samples = decoder(self.device).read_pcap(self.pcap_filename)
-            csi_data = decoder(self.device).unpack(samples['csi'])
-            return np.array(csi_data)
-        
-        except ValueError:
+            csi_frame = None
+            self.file_parser.reset_stream()
+            with open(self.pcap_filename, 'rb') as f:
+                for _, csi_frame in iter_pcap_frames(f, parser=self.file_parser):
+                    pass
+            return csi_frame if csi_frame is not None else np.array([])
+        except (OSError, ValueError):
             return np.array([])
     
-    def detect_motion(self, csi_frame):
+    def _update_presence(self, amplitude, current_time):
+        result = self.presence_detector.update(amplitude, current_time)
+        if result is None:
+            return
+        energy, present = result
+        if present != self.present:
+            self.present = present
+            state = "在室" if present else "不在"
+            print(f"[{datetime.now().strftime('%H:%M:%S')}] {state}と判定しました (エネルギー: {energy:.0f})")
+
+    def _update_baseline(self, amplitude):
+        motion = self.baseline.update(amplitude)
+        if self.baseline.drifted != self.drifted:
+            self.drifted = self.baseline.drifted
+            if self.drifted:
+                print(f"[{datetime.now().strftime('%H:%M:%S')}] 背景が基準から大きくずれました (ドリフト: {self.baseline.drift:.2f})")
+        return motion
+
+    def detect_motion(self, csi_frame, timestamp=None):
         if len(csi_frame) == 0:
             return
-        current_time = time.time()
-        amplitude = np.abs(csi_frame)
+        if self.metrics is not None:
+            start = time.perf_counter()
+        # キャプチャ時刻があればそれを使う (再生時もクールダウンが記録時の間隔で働く)
+        current_time = timestamp if timestamp is not None else time.time()
+        amplitude = np.abs(np.asarray(csi_frame).ravel())
+        if self.prefilter is not None:
+            amplitude = self.prefilter.update(amplitude)
+        if self.presence_detector is not None:
+            self._update_presence(amplitude, current_time)
         amplitude = np.clip(amplitude, 0, 3000)
+        if self.features is not None:
+            amplitude = self.features.update(amplitude)
+        baseline_motion = self._update_baseline(amplitude) if self.baseline is not None else False
         dynamic_threshold = self.get_dynamic_threshold()
         normalized_amplitude = (amplitude - np.mean(amplitude)) / np.std(amplitude)
-        self.csi_buffer.append(normalized_amplitude)
-        if len(self.csi_buffer) > self.window_size:
-            self.csi_buffer.pop(0)
-        if len(self.csi_buffer) < 2:
+        self.window_stats.update(normalized_amplitude, current_time)
+        if self.metrics is not None:
+            feature_done = time.perf_counter()
+            self.metrics.stages['feature'].observe(feature_done - start)
+        if len(self.window_stats) < 2:
             return
-        avg_diff = np.mean([np.mean(np.abs(self.csi_buffer[i] - self.csi_buffer[i-1])) for i in range(1, len(self.csi_buffer))])
+        avg_diff = np.mean(self.window_stats.mean_abs_diff())
         print(avg_diff)
-        if avg_diff > self.threshold and current_time - self.last_detection_time > self.cooldown_period:
+        detected = (avg_diff > self.threshold or baseline_motion) and current_time - self.last_detection_time > self.cooldown_period
+        if detected:
             self.last_detection_time = current_time
             print(f"[{datetime.now().strftime('%H:%M:%S')}] 動きを検出しました")
+        if self.metrics is not None:
+            self.metrics.stages['decision'].observe(time.perf_counter() - feature_done)
+            self.metrics.observe_decision('motion' if detected else 'none')
+        return detected
 
 if __name__ == "__main__":
-    detector = NexmonCSIMotionDetector()
+    metrics = PipelineMetrics()
+    serve_metrics(metrics.registry, DEFAULT_METRICS_PORT)
+    detector = NexmonCSIMotionDetector(metrics=metrics)
     detector.start_capture()
     try:
         while True:
             time.sleep(1)
     except KeyboardInterrupt:
-        detector.running = False
+        detector.stop_capture()
         print("終了します")
\ No newline at end of file
@@ -3,10 +3,16 @@ import subprocess
 import threading
 import time
 from datetime import datetime
-from nexcsi import decoder
+from csi_stream import PcapStreamParser, iter_pcap_frames
+from frame_consumer import FrameConsumerMixin
+from metrics import DEFAULT_METRICS_PORT, PipelineMetrics, serve_metrics
+from reference_cache import load_profile
+from templates import REJECT
 
-class NexmonCSIMotionDetector:
-    def __init__(self, interface='wlan0', window_size=3, threshold=0.12, k=2.0, pcap_filename='hoge.pcap'):
+class NexmonCSIMotionDetector(FrameConsumerMixin):
+    def __init__(self, interface='wlan0', window_size=3, threshold=0.12, k=2.0, pcap_filename='hoge.pcap', streaming=True,
+                 standing_pcap='pcaps/013.pcap', sitting_pcap='pcaps/014.pcap', metrics=None, prefilter=None,
+                 templates=None, stand_threshold=2.5, sit_threshold=8):
         self.interface = interface
         self.window_size = window_size
         self.threshold = threshold
@@ -18,38 +24,55 @@ class NexmonCSIMotionDetector:
         self.device = 'raspberrypi'
         self.pcap_filename = pcap_filename
         self.k = k
+        self.streaming = streaming  # Trueならtcpdumpを常駐させてストリームを直接読む
+        self.capture_process = None
+        self.standing_pcap = standing_pcap
+        self.sitting_pcap = sitting_pcap
         self.standing_ave = None
         self.sitting_ave = None
-        self.load_reference_data()
+        self.file_parser = PcapStreamParser(self.device, reuse_frames=True)
+        # metrics.PipelineMetrics を渡すと段ごとの処理時間やパケット数を計測する
+        self.metrics = metrics
+        # filters.StreamingFilter を渡すと振幅をパケットごとにフィルタしてから判定する
+        self.prefilter = prefilter
+        # templates.TemplateIndex を渡すと、立位・座位の2つの参照の代わりにその分類結果を使う
+        self.templates = templates
+        # 参照データの二乗誤差和に対する閾値の倍率 (templates を使わない場合)
+        self.stand_threshold = stand_threshold
+        self.sit_threshold = sit_threshold
+        if templates is None:
+            self.load_reference_data()
 
     def load_reference_data(self):
         """
         座っている状態と立っている状態の参照データを読み込む
         """
         try:
-            # 座っている状態のPCAPファイル
-            sitting = decoder(self.device).read_pcap('pcaps/014.pcap')
-            sitting_csi = decoder(self.device).unpack(sitting['csi'])
-            self.sitting_ave = np.average(np.abs(sitting_csi), axis=0)
-            self.th_sitting = np.sum((np.abs(sitting_csi) - self.sitting_ave)**2)
-
-            # 立っている状態のPCAPファイル
-            standing = decoder(self.device).read_pcap('pcaps/013.pcap')
-            standing_csi = decoder(self.device).unpack(standing['csi'])
-            self.standing_ave = np.average(np.abs(standing_csi), axis=0)
-            self.th_standing = np.sum((np.abs(standing_csi) - self.standing_ave)**2)
-            
+            # キャッシュ済みの参照プロファイルをメモリマップで読み込む
+            # (元のpcapが変更されたときだけデコードし直す)
+            sitting = load_profile(self.sitting_pcap, self.device)
+            self.sitting_ave = sitting.mean
+            self.th_sitting = sitting.error_sum
+
+            standing = load_profile(self.standing_pcap, self.device)
+            self.standing_ave = standing.mean
+            self.th_standing = standing.error_sum
+
             print("参照データの読み込みが完了しました。")
         except Exception as e:
             print(f"参照データの読み込みエラー: {e}")
 
     def _parse_csi_data(self, raw_line):
+        # tcpdump -c 1 が書き出したpcapを、検出器ごとに1つのパーサで確保済みの配列にデコードする
+        # (返す配列は次のパケットで上書きされる)
         try:
-            samples = decoder(self.device).read_pcap(self.pcap_filename)
-            csi_data = decoder(self.device).unpack(samples['csi'])
-            return np.array(csi_data)
-        
-        except ValueError:
+            csi_frame = None
+            self.file_parser.reset_stream()
+            with open(self.pcap_filename, 'rb') as f:
+                for _, csi_frame in iter_pcap_frames(f, parser=self.file_parser):
+                    pass
+            return csi_frame if csi_frame is not None else np.array([])
+        except (OSError, ValueError):
             return np.array([])
     def setup_interface(self):
         """
@@ -85,9 +108,44 @@ class NexmonCSIMotionDetector:
         threading.Thread(target=self._capture_loop, daemon=True).start()
         print(f"Nexmon CSI キャプチャを {self.interface} で開始")
     
+    def stop_capture(self):
+        self.running = False
+        if self.capture_process is not None and self.capture_process.poll() is None:
+            self.capture_process.terminate()
+
     def _capture_loop(self):
+        if self.streaming:
+            self._stream_capture_loop()
+        else:
+            self._file_capture_loop()
+
+    def _stream_capture_loop(self):
         """
-        `tcpdump` の出力をリアルタイムに取得して表示
+        tcpdumpを1つだけ起動し、`-w -` のpcapストリームを読み続けて
+        デコードしたCSIフレームをそのまま detect_motion に渡す
+        """
+        print("CSIデータキャプチャ中 (ストリーミング)...")
+        capture_cmd = ['sudo', 'tcpdump', '-i', self.interface, '-U', '-w', '-'] + self.capture_filter.split()
+        try:
+            self.capture_process = subprocess.Popen(capture_cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            # フレームはすぐに detect_motion で使い切るので、毎回同じ配列にデコードさせる
+            parser = PcapStreamParser(self.device, reuse_frames=True)
+            if self.metrics is not None:
+                self.metrics.attach_parser(parser)
+            self.consume(iter_pcap_frames(self.capture_process.stdout, parser=parser))
+        except Exception as e:
+            print(f"キャプチャループ中にエラー: {e}")
+        finally:
+            if self.capture_process is not None and self.capture_process.poll() is None:
+                self.capture_process.terminate()
+                try:
+                    self.capture_process.wait(timeout=2)
+                except subprocess.TimeoutExpired:
+                    self.capture_process.kill()
+
+    def _file_capture_loop(self):
+        """
+        1パケットごとにtcpdumpを起動してpcapファイルに書き出し、読み直す (旧方式)
         """
         print("CSIデータキャプチャ中...")
         try:
@@ -118,32 +176,46 @@ class NexmonCSIMotionDetector:
         except Exception as e:
             print(f"パケット処理中にエラー: {e}")
     
-    def detect_motion(self, csi_frame):
+    def detect_motion(self, csi_frame, timestamp=None):
         if len(csi_frame) == 0:
             return
-        current_time = time.time()
+        if self.metrics is not None:
+            start = time.perf_counter()
+        # キャプチャ時刻があればそれを使う (再生時もクールダウンが記録時の間隔で働く)
+        current_time = timestamp if timestamp is not None else time.time()
         amplitude = np.abs(csi_frame)
-        amplitude = np.clip(amplitude, 0, 3000)
+        if self.prefilter is not None:
+            amplitude = self.prefilter.update(amplitude)
+        if self.templates is None:
+            # テンプレートは参照プロファイル (クリップしていない平均振幅) と比べるのでクリップしない
+            amplitude = np.clip(amplitude, 0, 3000)
+        if self.metrics is not None:
+            feature_done = time.perf_counter()
+            self.metrics.stages['feature'].observe(feature_done - start)
 
-        # 座っているか立っているかを判定する
-        is_standing = self.is_standing_or_sitting(amplitude)
-        if is_standing == 1:
-            print(f"[{datetime.now().strftime('%H:%M:%S')}] 立っている状態が検出されました")
-        elif is_standing == 2:
-            print(f"[{datetime.now().strftime('%H:%M:%S')}] 座っている状態が検出されました")
+        if self.templates is not None:
+            # 登録済みのテンプレートのうち最も近いクラスを判定結果にする
+            result = self.templates.classify(amplitude)
+            if result != REJECT:
+                print(f"[{datetime.now().strftime('%H:%M:%S')}] {result} の状態が検出されました")
+        else:
+            # 座っているか立っているかを判定する
+            is_standing = self.is_standing_or_sitting(amplitude)
+            if is_standing == 1:
+                print(f"[{datetime.now().strftime('%H:%M:%S')}] 立っている状態が検出されました")
+            elif is_standing == 2:
+                print(f"[{datetime.now().strftime('%H:%M:%S')}] 座っている状態が検出されました")
+            result = {1: 'standing', 2: 'sitting'}.get(is_standing, REJECT)
+        if self.metrics is not None:
+            self.metrics.stages['decision'].observe(time.perf_counter() - feature_done)
+            self.metrics.observe_decision(result)
 
     def compute_average_error(self, pcap_filename):
         """
         指定されたPCAPファイルに基づいて平均誤差和を計算
         """
-        # pcapファイルを読み込む
-        sample = decoder(self.device).read_pcap(pcap_filename)
-        csi_data = decoder(self.device).unpack(sample['csi'])
-        csi_amp = np.abs(csi_data)
-        
-        # 平均振幅を計算
-        ave_amp = np.mean(csi_amp, axis=0)
-        return ave_amp
+        # 平均振幅はキャッシュ済みの参照プロファイルから取り出す
+        return load_profile(pcap_filename, self.device).mean
 
     def is_standing_or_sitting(self, data):
         """
@@ -151,32 +223,30 @@ class NexmonCSIMotionDetector:
         """
         # 立っている状態と座っている状態の平均を計算
         if self.standing_ave is None or self.sitting_ave is None:
-            self.standing_ave = self.compute_average_error('pcaps/013.pcap')
-            self.sitting_ave = self.compute_average_error('pcaps/014.pcap')
+            self.standing_ave = self.compute_average_error(self.standing_pcap)
+            self.sitting_ave = self.compute_average_error(self.sitting_pcap)
 
         # 立っている状態と座っている状態の誤差を計算
         standing_error = np.sum((data - self.standing_ave) ** 2)
         sitting_error = np.sum((data - self.sitting_ave) ** 2)
 
-        # 閾値を動的に計算
-        stand_threshold = 2.5
-        sit_threshold = 8
-        
-        # 判定処理
-        if standing_error > stand_threshold * self.th_standing:
+        # 判定処理 (閾値はそれぞれの参照データの二乗誤差和に対する倍率)
+        if standing_error > self.stand_threshold * self.th_standing:
             return 1  # 立っている状態
-        elif sitting_error < sit_threshold * self.th_standing:
+        elif sitting_error < self.sit_threshold * self.th_sitting:
             return 2  # 座っている状態
         else:
             return 0  # 判定できない（例えば、両方とも閾値より大きい場合）
 
 
 if __name__ == "__main__":
-    detector = NexmonCSIMotionDetector()
+    metrics = PipelineMetrics()
+    serve_metrics(metrics.registry, DEFAULT_METRICS_PORT)
+    detector = NexmonCSIMotionDetector(metrics=metrics)
     detector.start_capture()
     try:
         while True:
             time.sleep(1)
     except KeyboardInterrupt:
-        detector.running = False
+        detector.stop_capture()
         print("終了します")
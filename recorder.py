@@ -0,0 +1,220 @@
+import os
+import glob
+import time
+import argparse
+import threading
+from datetime import datetime
+import numpy as np
+
+FILE_EXT = '.csirec'
+DEFAULT_CHUNK_FRAMES = 1000
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_MAX_SECONDS = 600
+
+
+def chunk_dtype(nsub):
+    """
+    記録ファイル1チャンク分の構造化配列の型 (タイムスタンプと複素CSI)
+    """
+    return np.dtype([('timestamp', np.float64), ('csi', np.complex64, (nsub,))])
+
+
+class CSIRecorder(threading.Thread):
+    """
+    リングバッファに届いたCSIフレームを別スレッドでバイナリファイルに記録する
+
+    記録ファイルは np.save した構造化配列 (チャンク) を順に連結したもので、
+    chunk_frames フレームか flush_interval 秒ごとに1チャンク書き出す。
+    ファイルが max_bytes を超えるか max_seconds 秒経つと新しいファイルに切り替える。
+    リングバッファを自分のcursorで読むだけなので、描画やキャプチャを止めることはない。
+    """
+    def __init__(self, buffer, save_dir, chunk_frames=DEFAULT_CHUNK_FRAMES, flush_interval=1.0,
+                 max_bytes=DEFAULT_MAX_BYTES, max_seconds=DEFAULT_MAX_SECONDS, poll_interval=0.05):
+        threading.Thread.__init__(self)
+        self.buffer = buffer
+        self.save_dir = save_dir
+        self.chunk_frames = chunk_frames
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.poll_interval = poll_interval
+        self.cursor = buffer.count
+        self.daemon = True
+
+        self.file = None
+        self.path = None
+        self.paths = []
+        self.opened_at = 0.0
+        self.pending = []
+        self.pending_frames = 0
+        self.last_flush = time.monotonic()
+        self.frames = 0
+        self.dropped = 0  # 書き出しが追いつかずリングバッファで上書きされたフレーム数
+        self._stop_event = threading.Event()
+        os.makedirs(save_dir, exist_ok=True)
+
+    def run(self):
+        try:
+            while not self._stop_event.wait(self.poll_interval):
+                self._poll()
+            self._poll()
+        finally:
+            self._flush()
+            self._close()
+
+    def stop(self, timeout=5):
+        """
+        残りのフレームを書き出してからスレッドを止める
+        """
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    def _poll(self):
+        cursor = self.cursor
+        frames, timestamps, self.cursor = self.buffer.read_since(cursor, copy=True)
+        self.dropped += self.cursor - cursor - len(frames)
+        if len(frames) > 0:
+            self.pending.append((timestamps, frames))
+            self.pending_frames += len(frames)
+        if (self.pending_frames >= self.chunk_frames
+                or time.monotonic() - self.last_flush >= self.flush_interval):
+            self._flush()
+
+    def _flush(self):
+        self.last_flush = time.monotonic()
+        if self.pending_frames == 0:
+            return
+        timestamps = np.concatenate([t for t, _ in self.pending])
+        frames = np.concatenate([f for _, f in self.pending])
+        self.pending = []
+        self.pending_frames = 0
+
+        chunk = np.empty(len(frames), dtype=chunk_dtype(frames.shape[1]))
+        chunk['timestamp'] = timestamps
+        chunk['csi'] = frames
+        if self.file is None or self._should_rotate():
+            self._open()
+        np.save(self.file, chunk)
+        self.file.flush()
+        self.frames += len(chunk)
+
+    def _should_rotate(self):
+        return (self.file.tell() >= self.max_bytes
+                or time.monotonic() - self.opened_at >= self.max_seconds)
+
+    def _open(self):
+        self._close()
+        name = datetime.now().strftime("csi_data_%Y%m%d_%H%M%S_%f")
+        self.path = os.path.join(self.save_dir, name + FILE_EXT)
+        self.file = open(self.path, 'wb')
+        self.paths.append(self.path)
+        self.opened_at = time.monotonic()
+
+    def _close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def stats(self):
+        return {
+            'frames': self.frames,
+            'dropped': self.dropped,
+            'files': len(self.paths),
+            'path': self.path,
+        }
+
+
+def iter_chunks(path):
+    """
+    記録ファイルのチャンク (構造化配列) を順に返す
+    書き込み途中で切れた最後のチャンクは読み飛ばす
+    """
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        while f.tell() < size:
+            try:
+                yield np.load(f)
+            except (ValueError, EOFError):
+                return
+
+
+def recording_files(path):
+    """
+    ファイルならそれ自身を、ディレクトリなら中の記録ファイルを古い順に返す
+    """
+    if os.path.isdir(path):
+        return sorted(glob.glob(os.path.join(path, '*' + FILE_EXT)))
+    return [path]
+
+
+def read_recording(path):
+    """
+    記録ファイル (またはそれを含むディレクトリ) を読み込む
+
+    Returns:
+        (タイムスタンプ, CSI複素数行列)
+    """
+    chunks = [chunk for file_path in recording_files(path) for chunk in iter_chunks(file_path)]
+    if not chunks:
+        return np.zeros(0), np.zeros((0, 0), dtype=np.complex64)
+    records = np.concatenate(chunks)
+    return records['timestamp'], records['csi']
+
+
+def to_csv(path, csv_path, mode='amplitude', subcarrier_num=64):
+    """
+    記録ファイルを plot.py が以前保存していたCSVと同じ形式に変換する
+    (振幅は各フレームの最大値で0-1に正規化、位相はラジアン)
+    """
+    timestamps, csi = read_recording(path)
+    csi = csi[:, :subcarrier_num]
+    if mode == 'amplitude':
+        values = np.abs(csi)
+        max_val = np.max(values, axis=1, keepdims=True) if len(values) else 1
+        values = values / np.where(max_val > 0, max_val, 1)
+    else:
+        values = np.angle(csi)
+
+    with open(csv_path, 'w') as f:
+        f.write("timestamp,")
+        for i in range(subcarrier_num):
+            f.write(f"subcarrier{i},")
+        f.write("\n")
+        for timestamp, row in zip(timestamps, values):
+            timestamp_str = datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S.%f")
+            f.write(timestamp_str + "," + ",".join(str(val) for val in row) + ",\n")
+    return len(timestamps)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='CSI記録ファイルの確認とCSVへの変換')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    info_parser = subparsers.add_parser('info', help='記録の概要を表示する')
+    info_parser.add_argument('path', help='記録ファイルまたはディレクトリ')
+
+    csv_parser = subparsers.add_parser('csv', help='以前のCSV形式に変換する')
+    csv_parser.add_argument('path', help='記録ファイルまたはディレクトリ')
+    csv_parser.add_argument('-o', '--output', type=str, default=None, help='出力するCSVファイル')
+    csv_parser.add_argument('-p', '--phase', action='store_true', help='振幅の代わりに位相を出力する')
+    args = parser.parse_args()
+
+    if args.command == 'info':
+        for file_path in recording_files(args.path):
+            chunks = list(iter_chunks(file_path))
+            n = sum(len(chunk) for chunk in chunks)
+            if n == 0:
+                print(f"{file_path}: 0 フレーム")
+                continue
+            start, end = chunks[0]['timestamp'][0], chunks[-1]['timestamp'][-1]
+            print(f"{file_path}: {n} フレーム {len(chunks)} チャンク "
+                  f"{datetime.fromtimestamp(start)} - {datetime.fromtimestamp(end)}")
+    else:
+        output = args.output or os.path.splitext(args.path.rstrip('/'))[0] + '.csv'
+        n = to_csv(args.path, output, 'phase' if args.phase else 'amplitude')
+        print(f"{n} フレームを {output} に書き出しました")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+import os
+import hashlib
+import tempfile
+import contextlib
+import numpy as np
+from pcap_loader import read_pcap, unpack
+
+# キャッシュ形式のバージョン (フィールドを変えたら上げる)
+PROFILE_VERSION = 1
+CACHE_DIRNAME = '.cache'
+
+
+def profile_dtype(nsub):
+    """
+    参照プロファイル1件分の構造化dtype
+    """
+    return np.dtype([
+        ('version', np.int32),
+        ('source_sha256', 'S64'),
+        ('source_size', np.int64),
+        ('source_mtime_ns', np.int64),
+        ('device', 'S32'),
+        ('bandwidth', np.int32),
+        ('fftshift', np.bool_),
+        ('n_packets', np.int32),
+        ('error_sum', np.float64),   # 全パケットの二乗誤差和 (realtime_judge の閾値)
+        ('error_mean', np.float64),  # パケットごとの二乗誤差の平均 (judges_ の閾値)
+        ('error_std', np.float64),
+        ('mean', np.float64, (nsub,)),  # 平均振幅ベクトル
+    ])
+
+
+class ReferenceProfile:
+    """
+    メモリマップした参照プロファイル
+    """
+    def __init__(self, record, path):
+        self.path = path
+        self.mean = record['mean'][0]
+        self.error_sum = float(record['error_sum'][0])
+        self.error_mean = float(record['error_mean'][0])
+        self.error_std = float(record['error_std'][0])
+        self.n_packets = int(record['n_packets'][0])
+        self.bandwidth = int(record['bandwidth'][0])
+        self.device = record['device'][0].decode()
+        self.source_sha256 = record['source_sha256'][0].decode()
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def profile_path(pcap_path, device='raspberrypi', cache_dir=None):
+    """
+    pcapファイルに対応するキャッシュファイルのパスを返す
+    デフォルトでは pcap と同じディレクトリの .cache/ に置く
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(pcap_path), CACHE_DIRNAME)
+    stem = os.path.splitext(os.path.basename(pcap_path))[0]
+    return os.path.join(cache_dir, f"{stem}.{device}.profile.npy")
+
+
+def build_profile(pcap_path, device='raspberrypi'):
+    """
+    pcapファイルをデコードして参照プロファイルを作成する
+    """
+    samples = read_pcap(pcap_path)
+    amplitude = np.abs(unpack(samples['csi'], device))
+
+    mean = np.average(amplitude, axis=0)
+    errors = np.sum((amplitude - mean) ** 2, axis=1)
+
+    stat = os.stat(pcap_path)
+    record = np.zeros(1, dtype=profile_dtype(amplitude.shape[1]))
+    record['version'] = PROFILE_VERSION
+    record['source_sha256'] = file_sha256(pcap_path).encode()
+    record['source_size'] = stat.st_size
+    record['source_mtime_ns'] = stat.st_mtime_ns
+    record['device'] = device.encode()
+    record['bandwidth'] = samples.dtype.metadata['bandwidth']
+    record['fftshift'] = True
+    record['n_packets'] = len(amplitude)
+    record['error_sum'] = np.sum(errors)
+    record['error_mean'] = np.mean(errors)
+    record['error_std'] = np.std(errors)
+    record['mean'] = mean
+    return record
+
+
+def _is_fresh(record, pcap_path, device, path):
+    # デコード設定が変わっていれば作り直す (pcap_loader は常に fftshift する)
+    if (record['version'][0] != PROFILE_VERSION or record['device'][0].decode() != device
+            or not record['fftshift'][0]):
+        return False
+    # 元のpcapが無い場合はキャッシュをそのまま使う
+    if not os.path.exists(pcap_path):
+        return True
+    stat = os.stat(pcap_path)
+    if stat.st_size == record['source_size'][0] and stat.st_mtime_ns == record['source_mtime_ns'][0]:
+        return True
+    # 更新日時だけが変わった場合は中身のハッシュで判断する
+    if stat.st_size != record['source_size'][0] or file_sha256(pcap_path) != record['source_sha256'][0].decode():
+        return False
+    # 中身が同じなら新しい更新日時を書き戻し、次からはハッシュを計算しないで済ませる
+    try:
+        writable = np.load(path, mmap_mode='r+')
+        writable['source_mtime_ns'] = stat.st_mtime_ns
+        writable.flush()
+        del writable
+    except OSError as e:
+        print(f"参照プロファイルのキャッシュを更新できません: {e}")
+    return True
+
+
+def _save_atomic(path, record):
+    # 書き込み途中のファイルを読まないように一時ファイル経由で置き換える。
+    # 複数のプロセスが同時に作っても互いの一時ファイルを消さないよう、名前はプロセスごとに変える
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, record)
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        raise
+
+
+def load_profile(pcap_path, device='raspberrypi', cache_dir=None):
+    """
+    参照プロファイルをキャッシュからメモリマップで読み込む
+    キャッシュが無いか、元のpcapが変更されていれば作り直す
+    """
+    path = profile_path(pcap_path, device, cache_dir)
+    if os.path.exists(path):
+        try:
+            record = np.load(path, mmap_mode='r')
+            if _is_fresh(record, pcap_path, device, path):
+                return ReferenceProfile(record, path)
+        except (ValueError, OSError) as e:
+            print(f"参照プロファイルのキャッシュが壊れています。作り直します: {e}")
+
+    record = build_profile(pcap_path, device)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    _save_atomic(path, record)
+    return ReferenceProfile(np.load(path, mmap_mode='r'), path)
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+
+    for pcap_path in sys.argv[1:]:
+        start = time.perf_counter()
+        profile = load_profile(pcap_path)
+        elapsed = (time.perf_counter() - start) * 1000
+        print(f"{pcap_path}: {profile.n_packets} パケット, 誤差平均 {profile.error_mean:.1f}, {elapsed:.2f} ms ({profile.path})")
@@ -0,0 +1,215 @@
+import io
+import os
+import sys
+import time
+import argparse
+import contextlib
+import numpy as np
+from csi_stream import PcapStreamParser, iter_pcap_frames
+from filters import make_filter
+
+
+class PcapReplaySource:
+    """
+    記録済みpcapをライブキャプチャと同じ (タイムスタンプ, CSI) の列として流す
+
+    tcpdumpの出力の代わりにpcapファイルを iter_pcap_frames に通すので、デコードから
+    detector.consume までライブと同じ経路を通る。speed=1 で記録時と同じ間隔、
+    speed=10 なら10倍速、speed=None (または0) なら待たずにできるだけ速く流す。
+
+    各フレームは本来届くはずの時刻に送り出し、消費側が次のフレームを取りに来るまでを
+    そのフレームの処理時間とみなす。送り出し予定時刻からの遅れ (待ち + 処理) を
+    エンドツーエンドの遅延として記録する。
+    """
+    def __init__(self, pcap_path, device='raspberrypi', speed=1.0, loops=1, rebase_timestamps=True,
+                 reuse_frames=False):
+        self.pcap_path = pcap_path
+        self.device = device
+        self.speed = speed or None
+        self.loops = loops
+        # Trueならタイムスタンプを再生開始時刻基準に付け直す (ライブと同じく壁時計の時刻になる)
+        self.rebase_timestamps = rebase_timestamps
+        # reuse_frames=True なら各フレームを同じ配列にデコードする (消費側がすぐ使い切る場合用)
+        self.parser = PcapStreamParser(device, reuse_frames=reuse_frames)
+        self.latencies = []
+        self.processing_times = []
+        self.start_time = None
+        self.end_time = None
+
+    def __iter__(self):
+        self.latencies = []
+        self.processing_times = []
+        self.start_time = time.perf_counter()
+        wall_start = time.time()
+        offset = 0.0  # 繰り返し再生するときに前の周の長さだけタイムスタンプをずらす
+        first_timestamp = None
+        try:
+            for _ in range(self.loops):
+                last_timestamp = None
+                n_frames = 0
+                self.parser.reset_stream()
+                with open(self.pcap_path, 'rb') as f:
+                    for timestamp, csi_frame in iter_pcap_frames(f, parser=self.parser):
+                        if first_timestamp is None:
+                            first_timestamp = timestamp
+                        elapsed = timestamp - first_timestamp + offset
+                        last_timestamp = timestamp
+                        n_frames += 1
+                        if self.speed is None:
+                            due = time.perf_counter()
+                        else:
+                            due = self.start_time + elapsed / self.speed
+                            delay = due - time.perf_counter()
+                            if delay > 0:
+                                time.sleep(delay)
+                        if self.rebase_timestamps:
+                            timestamp = wall_start + elapsed
+                        sent = time.perf_counter()
+                        yield timestamp, csi_frame
+                        done = time.perf_counter()
+                        self.processing_times.append(done - sent)
+                        self.latencies.append(done - due)
+                if last_timestamp is not None:
+                    # 周と周のつなぎ目は平均のパケット間隔だけ空ける
+                    duration = last_timestamp - first_timestamp
+                    offset += duration + (duration / (n_frames - 1) if n_frames > 1 else 0.0)
+                    first_timestamp = None
+        finally:
+            self.end_time = time.perf_counter()
+
+    def stats(self):
+        """
+        再生結果の集計 (遅延と処理時間はミリ秒)
+        """
+        n = len(self.latencies)
+        elapsed = (self.end_time or time.perf_counter()) - self.start_time if self.start_time else 0.0
+        latencies = np.asarray(self.latencies) * 1e3
+        processing = np.asarray(self.processing_times) * 1e3
+        stats = {
+            'pcap': self.pcap_path,
+            'speed': self.speed,
+            'frames': n,
+            'decode_errors': self.parser.stats()['decode_errors'],
+            'elapsed': elapsed,
+            'throughput': n / elapsed if elapsed > 0 else 0.0,
+        }
+        if n:
+            stats.update({
+                'latency_mean_ms': float(np.mean(latencies)),
+                'latency_p50_ms': float(np.percentile(latencies, 50)),
+                'latency_p99_ms': float(np.percentile(latencies, 99)),
+                'latency_max_ms': float(np.max(latencies)),
+                'processing_mean_ms': float(np.mean(processing)),
+                'processing_max_ms': float(np.max(processing)),
+                # 処理時間だけから見積もった1秒あたりの最大処理フレーム数
+                'max_throughput': float(n / np.sum(processing) * 1e3) if np.sum(processing) > 0 else 0.0,
+            })
+        return stats
+
+
+def replay(detector, pcap_path, speed=1.0, loops=1, quiet=False):
+    """
+    検出器に pcap をライブと同じ consume() 経由で流し、再生結果の集計を返す
+    """
+    source = PcapReplaySource(pcap_path, detector.device, speed=speed, loops=loops, reuse_frames=True)
+    if getattr(detector, 'metrics', None) is not None:
+        detector.metrics.attach_parser(source.parser)
+    detector.running = True
+    output = contextlib.redirect_stdout(io.StringIO()) if quiet else contextlib.nullcontext()
+    try:
+        with output:
+            detector.consume(source)
+    finally:
+        detector.running = False
+    return source.stats()
+
+
+def check_references(name, args):
+    """
+    検出器が読み込む参照pcapが全てあるかを確かめる (無ければ FileNotFoundError)
+    検出器の中で読み込みに失敗すると、全フレームの処理がエラーになるだけで気づきにくいため
+    """
+    paths = []
+    if name == 'realtime_judge':
+        if args.template:
+            from templates import parse_references
+            paths = [path for pcaps in parse_references(args.template).values() for path in pcaps]
+        else:
+            paths = [args.standing, args.sitting]
+    missing = [path for path in paths if not os.path.exists(path)]
+    if missing:
+        raise FileNotFoundError(f"{name} の参照pcapがありません: {', '.join(missing)} "
+                                f"(--standing / --sitting / -T で指定してください)")
+
+
+def make_detector(name, args):
+    check_references(name, args)
+    prefilter = make_filter(args.prefilter) if args.prefilter else None
+    if name == 'ras':
+        from ras import NexmonCSIMotionDetector
+        baseline = None
+        if args.baseline:
+            from online_stats import AdaptiveBaseline
+            max_freeze = args.baseline_max_freeze if args.baseline_max_freeze > 0 else None
+            baseline = AdaptiveBaseline(alpha=args.baseline_alpha, max_freeze=max_freeze)
+        return NexmonCSIMotionDetector(prefilter=prefilter, baseline=baseline)
+    if name == 'realtime_judge':
+        from realtime_judge import NexmonCSIMotionDetector
+        templates = None
+        if args.template:
+            from templates import TemplateIndex, parse_references
+            templates = TemplateIndex.from_profiles(parse_references(args.template), method=args.method)
+        return NexmonCSIMotionDetector(standing_pcap=args.standing, sitting_pcap=args.sitting, prefilter=prefilter,
+                                       templates=templates)
+    raise ValueError(f"未知の検出器です: {name}")
+
+
+def add_detector_arguments(parser):
+    """
+    make_detector で使う検出器の選択と設定のオプションを追加する
+    """
+    parser.add_argument('-D', '--detector', choices=['ras', 'realtime_judge'], default='ras')
+    parser.add_argument('-p', '--prefilter', type=str, default=None,
+                        help="検出器の前に掛けるフィルタ (例: 'hampel:7:3,butter:1:10')")
+    parser.add_argument('-B', '--baseline', action='store_true', help='ras で適応的な背景モデルも使う')
+    parser.add_argument('--baseline-alpha', type=float, default=0.01, help='背景の指数移動平均の重み')
+    parser.add_argument('--baseline-max-freeze', type=int, default=2000,
+                        help='背景の更新停止がこのパケット数続いたら背景を作り直す (0で作り直さない)')
+    parser.add_argument('--standing', type=str, default='pcaps/013.pcap', help='realtime_judge の立位の参照pcap')
+    parser.add_argument('--sitting', type=str, default='pcaps/014.pcap', help='realtime_judge の座位の参照pcap')
+    parser.add_argument('-T', '--template', action='append', default=[],
+                        help="realtime_judge で分類に使う ラベル=pcap[,pcap...] (繰り返し指定できる)")
+    parser.add_argument('--method', choices=['centroid', 'knn'], default='centroid', help='テンプレートでの分類方法')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='記録済みpcapをリアルタイム検出器に流して遅延とスループットを測る')
+    parser.add_argument('pcaps', nargs='+', help='再生するpcapファイル')
+    parser.add_argument('-s', '--speed', type=float, default=1.0,
+                        help='再生速度の倍率 (1で記録時と同じ間隔)')
+    parser.add_argument('-f', '--fast', action='store_true', help='待たずにできるだけ速く流す')
+    parser.add_argument('-l', '--loops', type=int, default=1, help='各pcapを繰り返す回数')
+    parser.add_argument('-q', '--quiet', action='store_true', help='検出器の出力を捨てる')
+    add_detector_arguments(parser)
+    args = parser.parse_args()
+
+    try:
+        check_references(args.detector, args)
+    except FileNotFoundError as e:
+        parser.error(str(e))
+
+    speed = None if args.fast else args.speed
+    for pcap_path in args.pcaps:
+        detector = make_detector(args.detector, args)
+        stats = replay(detector, pcap_path, speed=speed, loops=args.loops, quiet=args.quiet)
+        if not stats['frames']:
+            print(f"{pcap_path}: CSIフレームがありません", file=sys.stderr)
+            continue
+        print(f"{pcap_path}: {stats['frames']} フレーム {stats['elapsed']:.2f} 秒 "
+              f"({stats['throughput']:.0f} fps, 最大 {stats['max_throughput']:.0f} fps)  "
+              f"遅延 平均 {stats['latency_mean_ms']:.2f} ms / p99 {stats['latency_p99_ms']:.2f} ms / "
+              f"最大 {stats['latency_max_ms']:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
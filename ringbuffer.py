@@ -0,0 +1,141 @@
+import threading
+import numpy as np
+
+
+class RingBuffer:
+    """
+    容量固定のNumPyリングバッファ (書き込み1スレッド・読み出し複数スレッド)
+
+    各フレームを領域 [0, capacity) と [capacity, 2*capacity) の2か所に書き込むため、
+    直近nフレームは常に連続した領域になり、コピーせずに時間順のビューを返せる。
+    返したビューは、その後 capacity - n 回 append されるまでは書き換わらない。
+    """
+    dtype = np.dtype(np.float64)
+
+    def __init__(self, capacity, frame_shape=None, dtype=None):
+        if capacity < 1:
+            raise ValueError("capacity は1以上を指定してください")
+        self.capacity = capacity
+        if dtype is not None:
+            self.dtype = np.dtype(dtype)
+        self.frame_shape = None
+        self._data = None
+        self._timestamps = np.zeros(2 * capacity)
+        self._count = 0  # これまでにappendしたフレーム数
+        self._lock = threading.Lock()
+        if frame_shape is not None:
+            self._allocate(frame_shape)
+
+    def _allocate(self, frame_shape):
+        self.frame_shape = tuple(frame_shape)
+        self._data = np.zeros((2 * self.capacity,) + self.frame_shape, dtype=self.dtype)
+
+    def __len__(self):
+        return min(self._count, self.capacity)
+
+    @property
+    def count(self):
+        """
+        これまでにappendしたフレームの総数
+        """
+        return self._count
+
+    def append(self, frame, timestamp=0.0):
+        """
+        フレームを1つ追加する (O(1))
+        フレームの形は最初のappendで決まる
+        """
+        if self._data is None:
+            self._allocate(np.shape(frame))
+        i = self._count % self.capacity
+        with self._lock:
+            self._data[i] = frame
+            self._data[i + self.capacity] = frame
+            self._timestamps[i] = timestamp
+            self._timestamps[i + self.capacity] = timestamp
+            self._count += 1
+
+    def extend(self, frames, timestamps=None):
+        """
+        複数フレームをまとめて追加する (O(フレーム数))
+        """
+        frames = np.asarray(frames)
+        n = len(frames)
+        if n == 0:
+            return
+        if timestamps is None:
+            timestamps = np.zeros(n)
+        if self._data is None:
+            self._allocate(frames.shape[1:])
+        # 容量を超える分は最終的に上書きされるので書き込まない
+        skip = max(0, n - self.capacity)
+        frames, timestamps = frames[skip:], np.asarray(timestamps)[skip:]
+        with self._lock:
+            index = (self._count + skip + np.arange(len(frames))) % self.capacity
+            self._data[index] = frames
+            self._data[index + self.capacity] = frames
+            self._timestamps[index] = timestamps
+            self._timestamps[index + self.capacity] = timestamps
+            self._count += n
+
+    def clear(self):
+        with self._lock:
+            self._count = 0
+
+    def _window(self, count, n):
+        start = (count - n) % self.capacity
+        return self._data[start:start + n], self._timestamps[start:start + n]
+
+    def latest(self, n=None, copy=False):
+        """
+        直近nフレームを古い順に並べた (フレーム, タイムスタンプ) を返す
+        デフォルトではコピーしないビューを返す
+        """
+        with self._lock:
+            count = self._count
+            size = min(count, self.capacity)
+            n = size if n is None else min(n, size)
+            if self._data is None or n == 0:
+                return self._empty()
+            frames, timestamps = self._window(count, n)
+            if copy:
+                frames, timestamps = frames.copy(), timestamps.copy()
+        return frames, timestamps
+
+    def read_since(self, cursor, copy=False):
+        """
+        総数が cursor だった時点より後に追加されたフレームを返す
+        読み出し側ごとに cursor を持てば、各自が取りこぼしなく順に読める
+        (容量を超えて溜まった古いフレームは失われる)
+
+        Returns:
+            (フレーム, タイムスタンプ, 新しいcursor)
+        """
+        with self._lock:
+            count = self._count
+            n = min(count - cursor, self.capacity)
+            if self._data is None or n <= 0:
+                frames, timestamps = self._empty()
+                return frames, timestamps, count
+            frames, timestamps = self._window(count, n)
+            if copy:
+                frames, timestamps = frames.copy(), timestamps.copy()
+        return frames, timestamps, count
+
+    def _empty(self):
+        shape = (0,) + (self.frame_shape or ())
+        return np.zeros(shape, dtype=self.dtype), np.zeros(0)
+
+
+class ComplexRingBuffer(RingBuffer):
+    """
+    CSI複素数フレーム用のリングバッファ
+    """
+    dtype = np.dtype(np.complex64)
+
+
+class FloatRingBuffer(RingBuffer):
+    """
+    振幅や位相などの実数フレーム用のリングバッファ
+    """
+    dtype = np.dtype(np.float64)
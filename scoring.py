@@ -0,0 +1,156 @@
+import numpy as np
+
+# 1チャンクで使う作業メモリの上限 (バイト)
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+
+def _prepare(data, templates):
+    # data (float32やメモリマップのこともある) は元のdtypeのまま受け取り、チャンクごとにfloat64にする
+    data = np.asarray(data)
+    templates = np.asarray(templates, dtype=np.float64)
+    squeeze_data = data.ndim == 1
+    squeeze_templates = templates.ndim == 1
+    return np.atleast_2d(data), np.atleast_2d(templates), squeeze_data, squeeze_templates
+
+
+def _finish(result, squeeze_data, squeeze_templates):
+    if squeeze_templates:
+        result = result[:, 0]
+    if squeeze_data:
+        result = result[0]
+    return result
+
+
+def _chunks(n_rows, n_templates, n_features, max_bytes, copies=1):
+    # 1行あたりの作業領域 (float64): 出力行 + 入力行のfloat64への変換やその途中結果 copies 行分
+    row_bytes = 8 * (n_features * copies + n_templates)
+    step = max(1, int(max_bytes // row_bytes))
+    for start in range(0, n_rows, step):
+        yield slice(start, min(start + step, n_rows))
+
+
+def _normalize_rows(x, center):
+    if center:
+        x = x - x.mean(axis=1, keepdims=True)
+    norm = np.linalg.norm(x, axis=1, keepdims=True)
+    norm[norm == 0] = 1
+    return x / norm
+
+
+def squared_error(data, templates, max_bytes=DEFAULT_MAX_BYTES):
+    """
+    N個のパケットとM個のテンプレートの二乗誤差和をまとめて計算する
+
+    Parameters:
+        data (numpy.ndarray): 振幅データ (N, サブキャリア数) または (サブキャリア数,)
+        templates (numpy.ndarray): テンプレート (M, サブキャリア数) または (サブキャリア数,)
+        max_bytes (int): 1チャンクで使う作業メモリの上限
+
+    Returns:
+        numpy.ndarray: 二乗誤差和 (N, M)。1次元で渡した軸は落とす
+    """
+    data, templates, squeeze_data, squeeze_templates = _prepare(data, templates)
+    # ||x - t||^2 = ||x||^2 - 2 x・t + ||t||^2
+    template_sq = np.einsum('ij,ij->i', templates, templates)
+    result = np.empty((len(data), len(templates)))
+    # チャンクのfloat64への変換 + einsum の途中結果
+    for rows in _chunks(len(data), len(templates), data.shape[1], max_bytes, copies=2):
+        chunk = data[rows].astype(np.float64, copy=False)
+        out = result[rows]
+        np.matmul(chunk, templates.T, out=out)
+        out *= -2
+        out += np.einsum('ij,ij->i', chunk, chunk)[:, np.newaxis]
+        out += template_sq
+        np.maximum(out, 0, out=out)
+    return _finish(result, squeeze_data, squeeze_templates)
+
+
+def pearson(data, templates, max_bytes=DEFAULT_MAX_BYTES):
+    """
+    N個のパケットとM個のテンプレートのピアソン相関係数をまとめて計算する
+    """
+    data, templates, squeeze_data, squeeze_templates = _prepare(data, templates)
+    templates = _normalize_rows(templates, center=True)
+    result = np.empty((len(data), len(templates)))
+    # チャンクのfloat64への変換 + 中心化したコピー + 正規化したコピー
+    for rows in _chunks(len(data), len(templates), data.shape[1], max_bytes, copies=3):
+        chunk = data[rows].astype(np.float64, copy=False)
+        np.matmul(_normalize_rows(chunk, center=True), templates.T, out=result[rows])
+    return _finish(result, squeeze_data, squeeze_templates)
+
+
+def cosine(data, templates, max_bytes=DEFAULT_MAX_BYTES):
+    """
+    N個のパケットとM個のテンプレートのコサイン類似度をまとめて計算する
+    """
+    data, templates, squeeze_data, squeeze_templates = _prepare(data, templates)
+    templates = _normalize_rows(templates, center=False)
+    result = np.empty((len(data), len(templates)))
+    # チャンクのfloat64への変換 + 正規化したコピー
+    for rows in _chunks(len(data), len(templates), data.shape[1], max_bytes, copies=2):
+        chunk = data[rows].astype(np.float64, copy=False)
+        np.matmul(_normalize_rows(chunk, center=False), templates.T, out=result[rows])
+    return _finish(result, squeeze_data, squeeze_templates)
+
+
+METRICS = {
+    'squared_error': squared_error,
+    'pearson': pearson,
+    'cosine': cosine,
+}
+
+
+def score(data, templates, metric='squared_error', max_bytes=DEFAULT_MAX_BYTES):
+    return METRICS[metric](data, templates, max_bytes=max_bytes)
+
+
+if __name__ == "__main__":
+    # pcaps/ 以下の全ファイルで、これまでのループ実装とバッチ実装の速度を比較する
+    import glob
+    import time
+    from pcap_loader import load_csi
+
+    device = 'raspberrypi'
+
+    def loop_squared_error(data, judge_ave):
+        error = []
+        for i in range(len(data)):
+            error.append(np.sum((data[i] - judge_ave)**2))
+        return error
+
+    def loop_corr(data, judge_amp):
+        r = []
+        for i in range(len(data)):
+            corr = np.corrcoef(np.array([data[i], judge_amp]))
+            r.append(corr[0][1])
+        return r
+
+    amplitudes = []
+    for pcap_file in sorted(glob.glob('pcaps/*.pcap')):
+        amplitudes.append(np.abs(load_csi(pcap_file, device)))
+    data = np.concatenate(amplitudes)
+    templates = np.array([np.average(amp, axis=0) for amp in amplitudes])
+    print(f"パケット数 {len(data)}, テンプレート数 {len(templates)}")
+
+    def measure(func, repeat=3):
+        best = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            best = min(best, time.perf_counter() - start)
+        return best
+
+    loop_se = measure(lambda: [loop_squared_error(data, t) for t in templates])
+    batch_se = measure(lambda: squared_error(data, templates))
+    loop_r = measure(lambda: [loop_corr(data, t) for t in templates])
+    batch_r = measure(lambda: pearson(data, templates))
+    batch_cos = measure(lambda: cosine(data, templates))
+
+    expected_se = np.array([loop_squared_error(data, t) for t in templates]).T
+    expected_r = np.array([loop_corr(data, t) for t in templates]).T
+    assert np.allclose(squared_error(data, templates), expected_se, rtol=1e-4)
+    assert np.allclose(pearson(data, templates), expected_r, atol=1e-6)
+
+    print(f"二乗誤差: ループ {loop_se * 1000:.1f} ms, バッチ {batch_se * 1000:.2f} ms ({loop_se / batch_se:.0f}倍)")
+    print(f"相関係数: ループ {loop_r * 1000:.1f} ms, バッチ {batch_r * 1000:.2f} ms ({loop_r / batch_r:.0f}倍)")
+    print(f"コサイン類似度: バッチ {batch_cos * 1000:.2f} ms")
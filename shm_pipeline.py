@@ -0,0 +1,408 @@
+import os
+import io
+import sys
+import time
+import argparse
+import contextlib
+import subprocess
+import multiprocessing
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+from csi_stream import PcapStreamParser, iter_pcap_frames
+from replay import PcapReplaySource, add_detector_arguments, check_references, make_detector
+
+DEFAULT_CAPACITY = 4096  # 80MHz (256サブキャリア) で約8MB
+DEFAULT_NSUB = 256
+RING_MAGIC = 0x43534952  # 'CSIR'
+RING_VERSION = 1
+
+# ヘッダ (int64) の各要素の位置
+H_MAGIC, H_VERSION, H_CAPACITY, H_NSUB, H_COUNT, H_CLOSED, H_MISMATCHED = range(7)
+HEADER_LEN = 8
+# 書き込み側が公開するパーサの統計 (float64) の各要素の位置と名前
+STATS_FIELDS = ('elapsed', 'records', 'frames', 'decode_errors', 'lost_packets', 'loss_rate', 'packets_per_sec')
+STATS_INTERVAL = 64  # この数のフレームごとに統計を書き出す
+
+
+def _ring_layout(capacity, nsub):
+    """
+    共有メモリ内の各配列の (オフセット, 形, dtype) と全体の大きさ
+    """
+    fields = [
+        ('header', (HEADER_LEN,), np.int64),
+        ('stats', (len(STATS_FIELDS),), np.float64),
+        ('seq', (capacity,), np.int64),
+        ('timestamps', (2 * capacity,), np.float64),
+        ('frames', (2 * capacity, nsub), np.complex64),
+    ]
+    layout = {}
+    offset = 0
+    for name, shape, dtype in fields:
+        layout[name] = (offset, shape, dtype)
+        offset += int(np.prod(shape)) * np.dtype(dtype).itemsize
+    return layout, offset
+
+
+def _attach(name):
+    # 別に起動したプロセス (plot.py など) が終了したときに、その resource_tracker が
+    # 共有メモリを消さないようにする (消すのは作成したプロセスだけ)。
+    # multiprocessing で起動した子プロセスは親と同じ resource_tracker を使うので登録を外さない
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+        if multiprocessing.parent_process() is None:
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+class SharedRingBuffer:
+    """
+    multiprocessing.shared_memory 上のCSIフレームのリングバッファ (書き込み1プロセス・読み出し複数プロセス)
+
+    ringbuffer.RingBuffer と同じく各フレームを2か所に書き込むので、直近nフレームは常に連続した
+    領域になり、読み出し側はコピーもpickleもせずに時間順のビューを得られる。
+    ロックは使わず、スロットごとのシーケンス番号 (seqlock) で上書きを検出する。
+    n番目のフレームを書く間はスロットの番号を 2n+1 (書き込み中)、書き終えたら 2n+2 にするので、
+    読み出し側はコピーした後に番号が 2n+2 のままかを確かめれば、途中で上書きされたフレームを捨てられる。
+    書き込み側は読み出し側を待たないので、描画などで読み出しが遅れてもキャプチャは止まらない
+    (capacity を超えて遅れた分は読み出し側で失われる)。
+    """
+    def __init__(self, shm, owner=False):
+        self.shm = shm
+        self.owner = owner
+        header = np.ndarray((HEADER_LEN,), dtype=np.int64, buffer=shm.buf)
+        if header[H_MAGIC] != RING_MAGIC or header[H_VERSION] != RING_VERSION:
+            raise ValueError(f"CSIのリングバッファではありません: {shm.name}")
+        self.capacity = int(header[H_CAPACITY])
+        self.nsub = int(header[H_NSUB])
+        self.frame_shape = (self.nsub,)
+        layout, _ = _ring_layout(self.capacity, self.nsub)
+        for name, (offset, shape, dtype) in layout.items():
+            setattr(self, f"_{name}", np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset))
+
+    @classmethod
+    def create(cls, capacity=DEFAULT_CAPACITY, nsub=DEFAULT_NSUB, name=None):
+        _, size = _ring_layout(capacity, nsub)
+        shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        header = np.ndarray((HEADER_LEN,), dtype=np.int64, buffer=shm.buf)
+        header[:] = 0
+        header[H_CAPACITY] = capacity
+        header[H_NSUB] = nsub
+        header[H_VERSION] = RING_VERSION
+        header[H_MAGIC] = RING_MAGIC
+        ring = cls(shm, owner=True)
+        ring._seq[:] = 0
+        ring._stats[:] = 0
+        return ring
+
+    @classmethod
+    def attach(cls, name):
+        return cls(_attach(name))
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    @property
+    def count(self):
+        """
+        これまでに書き込んだフレームの総数
+        """
+        return int(self._header[H_COUNT])
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    @property
+    def closed(self):
+        """
+        書き込み側が終了したかどうか
+        """
+        return bool(self._header[H_CLOSED])
+
+    def mark_closed(self):
+        self._header[H_CLOSED] = 1
+
+    def append(self, frame, timestamp=0.0):
+        """
+        フレームを1つ書き込む (書き込み側のプロセスだけが呼ぶ)
+        サブキャリア数が違うフレームは数えるだけで書き込まない
+        """
+        if np.shape(frame) != self.frame_shape:
+            self._header[H_MISMATCHED] += 1
+            return False
+        n = int(self._header[H_COUNT])
+        i = n % self.capacity
+        self._seq[i] = 2 * n + 1
+        self._frames[i] = frame
+        self._frames[i + self.capacity] = frame
+        self._timestamps[i] = timestamp
+        self._timestamps[i + self.capacity] = timestamp
+        self._seq[i] = 2 * n + 2
+        self._header[H_COUNT] = n + 1
+        return True
+
+    def _window(self, count, n):
+        start = (count - n) % self.capacity
+        return self._frames[start:start + n], self._timestamps[start:start + n]
+
+    def _valid_from(self, count, n):
+        # 読んだ n フレームのうち、上書きされていない最初のフレームの位置 (古い方から上書きされる)
+        numbers = np.arange(count - n, count)
+        valid = self._seq[numbers % self.capacity] == 2 * numbers + 2
+        if valid.all():
+            return 0
+        return int(np.flatnonzero(~valid)[-1]) + 1
+
+    def read_since(self, cursor, copy=False):
+        """
+        総数が cursor だった時点より後に書き込まれたフレームを返す (RingBuffer.read_since と同じ)
+
+        copy=False なら共有メモリのビューをそのまま返す。ビューは、その後 capacity - n 回
+        書き込まれるまでは書き換わらない。copy=True ならコピーしてから上書きされていないかを
+        確かめ、途中で上書きされたフレームを除いて返す。
+
+        Returns:
+            (フレーム, タイムスタンプ, 新しいcursor)
+        """
+        count = self.count
+        n = min(count - cursor, self.capacity)
+        if n <= 0:
+            return np.zeros((0, self.nsub), dtype=np.complex64), np.zeros(0), count
+        frames, timestamps = self._window(count, n)
+        if copy:
+            frames, timestamps = frames.copy(), timestamps.copy()
+            skip = self._valid_from(count, n)
+            frames, timestamps = frames[skip:], timestamps[skip:]
+        return frames, timestamps, count
+
+    def latest(self, n=None, copy=False):
+        """
+        直近nフレームを古い順に並べた (フレーム, タイムスタンプ) を返す
+        """
+        count = self.count
+        n = len(self) if n is None else min(n, len(self))
+        frames, timestamps, _ = self.read_since(count - n, copy)
+        return frames, timestamps
+
+    def publish_stats(self, parser):
+        """
+        書き込み側のパーサの統計を読み出し側から見えるように書き出す
+        """
+        stats = parser.stats()
+        self._stats[:] = [stats[key] for key in STATS_FIELDS]
+
+    def stats(self):
+        """
+        書き込み側のパーサの統計 (PcapStreamParser.stats と同じキー) とリングの状態を返す
+        """
+        stats = {key: float(value) for key, value in zip(STATS_FIELDS, self._stats)}
+        for key in ('records', 'frames', 'decode_errors', 'lost_packets'):
+            stats[key] = int(stats[key])
+        stats['written'] = self.count
+        stats['mismatched'] = int(self._header[H_MISMATCHED])
+        stats['closed'] = self.closed
+        return stats
+
+    def close(self):
+        # ビューが残っていると共有メモリを閉じられないので先に手放す
+        for name in ('_header', '_stats', '_seq', '_timestamps', '_frames'):
+            setattr(self, name, None)
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class RingFrameSource:
+    """
+    リングバッファから (タイムスタンプ, CSI) を順に返すイテラブル (detector.consume に渡せる)
+
+    新しく書き込まれた分をまとめてコピーしてからシーケンス番号で確かめ、読んでいる間に
+    上書きされたフレームと、読み出しが capacity 以上遅れて読めなかったフレームは返さずに
+    lost に数える。cursor を省略すると読み始めた時点より後に書き込まれたフレームから読む。
+    書き込み側が終了して読み切ったか、stop_event がセットされたら終わる。
+
+    ここではゼロコピーをあきらめている。検出器に共有メモリのビューをそのまま渡すと、
+    検出器が使っている最中に書き込み側が一周して上書きしても、使い終わった後にしか
+    気づけず、壊れたフレームでの判定を取り消せない。コピーは 80MHz でも1フレーム
+    2KiB (1フレーム 0.3μs ほど) で、ras の検出 (1フレーム 100μs ほど) に比べて小さい。
+    ゼロコピーで読みたい側 (自分で使い終わりを確かめられる場合) は read_since(copy=False) を使う。
+    """
+    def __init__(self, ring, stop_event=None, poll_interval=0.001, cursor=None):
+        self.ring = ring
+        self.stop_event = stop_event
+        self.poll_interval = poll_interval
+        self.cursor = cursor
+        self.received = 0  # 返したフレーム数
+        self.lost = 0      # 上書きされて返せなかったフレーム数
+
+    def __iter__(self):
+        ring = self.ring
+        if self.cursor is None:
+            self.cursor = ring.count
+        while True:
+            frames, timestamps, new_cursor = ring.read_since(self.cursor, copy=True)
+            self.lost += new_cursor - self.cursor - len(frames)
+            self.cursor = new_cursor
+            if len(frames) == 0:
+                if ring.closed or (self.stop_event is not None and self.stop_event.is_set()):
+                    return
+                time.sleep(self.poll_interval)
+                continue
+            for timestamp, frame in zip(timestamps, frames):
+                self.received += 1
+                yield float(timestamp), frame
+
+
+def capture_worker(ring_name, command=None, replay_path=None, speed=None, device='raspberrypi', stop_event=None):
+    """
+    キャプチャとデコードを行い、フレームをリングバッファに書き込む (別プロセスで実行)
+
+    command (tcpdump など) の標準出力のpcapストリームを読むか、replay_path のpcapを
+    記録時の間隔 (speed 倍) で流す。
+    """
+    ring = SharedRingBuffer.attach(ring_name)
+    process = None
+    warned = False
+    try:
+        if replay_path is not None:
+            source = PcapReplaySource(replay_path, device, speed=speed, reuse_frames=True)
+            parser = source.parser
+            frames = source
+        else:
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            parser = PcapStreamParser(device, reuse_frames=True)
+            frames = iter_pcap_frames(process.stdout, parser=parser)
+        for timestamp, csi_frame in frames:
+            if stop_event is not None and stop_event.is_set():
+                break
+            if not ring.append(csi_frame, timestamp) and not warned:
+                # 帯域が違うとすべてのフレームが書き込まれないので、最初の1つで知らせる
+                print(f"{ring_name}: サブキャリア数 {np.shape(csi_frame)[-1]} のフレームを受け取りましたが、"
+                      f"リングバッファは {ring.nsub} サブキャリアです。-n/--nsub で合わせてください "
+                      f"(合わないフレームは書き込まずに数えるだけです)", file=sys.stderr)
+                warned = True
+            if parser.frames % STATS_INTERVAL == 0:
+                ring.publish_stats(parser)
+        ring.publish_stats(parser)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        ring.mark_closed()
+        if process is not None and process.poll() is None:
+            process.terminate()
+            try:
+                process.wait(timeout=2)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        ring.close()
+
+
+def detector_worker(ring_name, args, stop_event=None, quiet=False, ready=None):
+    """
+    リングバッファのフレームを検出器に流す (別プロセスで実行)
+    検出器の選択と設定は replay.make_detector と同じオプションで行う
+    準備 (参照データの読み込みなど) ができたら ready をセットする
+    """
+    ring = SharedRingBuffer.attach(ring_name)
+    detector = make_detector(args.detector, args)
+    detector.running = True
+    source = RingFrameSource(ring, stop_event, cursor=ring.count)
+    if ready is not None:
+        ready.set()
+
+    output = contextlib.redirect_stdout(io.StringIO()) if quiet else contextlib.nullcontext()
+    try:
+        with output:
+            detector.consume(source)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # consume が途中で止まった場合は、まだ読んでいない分も取りこぼしに数える
+        unread = ring.count - source.cursor
+        print(f"検出器 {args.detector} ({ring_name}): {source.received} フレーム処理, "
+              f"取りこぼし {source.lost + unread}")
+        ring.close()
+
+
+def ring_name_for(index):
+    return f"csi_ring_{os.getpid()}_{index}"
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='キャプチャ・デコード、検出、描画を別プロセスで動かし、共有メモリのリングバッファでフレームを渡す')
+    parser.add_argument('-i', '--interface', action='append', default=[],
+                        help='キャプチャするインターフェース (繰り返し指定すると各々を別プロセスでキャプチャ)')
+    parser.add_argument('-f', '--filter', type=str, default='dst port 5500', help='tcpdumpのフィルタ')
+    parser.add_argument('-r', '--replay', action='append', default=[],
+                        help='tcpdumpの代わりに流すpcapファイル (試験用, 繰り返し指定できる)')
+    parser.add_argument('-s', '--speed', type=float, default=1.0, help='--replay の再生速度 (0でできるだけ速く)')
+    parser.add_argument('-c', '--capacity', type=int, default=DEFAULT_CAPACITY, help='リングバッファのフレーム数')
+    parser.add_argument('-n', '--nsub', type=int, default=DEFAULT_NSUB, help='サブキャリア数 (80MHzなら256)')
+    parser.add_argument('--no-detector', action='store_true', help='検出器のプロセスを起動しない')
+    parser.add_argument('-q', '--quiet', action='store_true', help='検出器の出力を捨てる')
+    parser.add_argument('--plot', action='store_true', help='最初のリングバッファを plot.py で描画する')
+    add_detector_arguments(parser)
+    args = parser.parse_args()
+    if not args.no_detector:
+        try:
+            check_references(args.detector, args)
+        except FileNotFoundError as e:
+            parser.error(str(e))
+
+    sources = [{'command': ['sudo', 'tcpdump', '-i', interface, '-U', '-w', '-'] + args.filter.split()}
+               for interface in args.interface]
+    sources += [{'replay_path': path, 'speed': args.speed or None} for path in args.replay]
+    if not sources:
+        sources = [{'command': ['sudo', 'tcpdump', '-i', 'wlan0', '-U', '-w', '-'] + args.filter.split()}]
+
+    stop_event = multiprocessing.Event()
+    rings = [SharedRingBuffer.create(args.capacity, args.nsub, ring_name_for(i)) for i in range(len(sources))]
+    captures, detectors = [], []
+    plot_process = None
+    try:
+        # 読み出し側を先に起動し、準備ができてからキャプチャを始めて最初のフレームから読めるようにする
+        ready_events = []
+        if not args.no_detector:
+            ready_events = [multiprocessing.Event() for _ in rings]
+            detectors = [multiprocessing.Process(target=detector_worker,
+                                                 args=(ring.name, args, stop_event, args.quiet, ready))
+                         for ring, ready in zip(rings, ready_events)]
+        if args.plot:
+            plot_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'plot.py')
+            plot_process = subprocess.Popen([sys.executable, plot_script, '--shm', rings[0].name])
+        for process in detectors:
+            process.start()
+        for ready, process in zip(ready_events, detectors):
+            while not ready.wait(0.1) and process.is_alive():
+                pass
+        captures = [multiprocessing.Process(target=capture_worker, args=(ring.name,), daemon=True,
+                                            kwargs=dict(source, stop_event=stop_event))
+                    for ring, source in zip(rings, sources)]
+        for process in captures:
+            process.start()
+        print(f"{len(captures)} 個のキャプチャプロセスを開始しました: {', '.join(ring.name for ring in rings)}")
+        for process in captures:
+            process.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_event.set()
+        for process in captures + detectors:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        if plot_process is not None and plot_process.poll() is None:
+            plot_process.terminate()
+        for ring in rings:
+            stats = ring.stats()
+            print(f"{ring.name}: {stats['written']} フレーム書き込み, {stats['packets_per_sec']:.0f} pkt/s, "
+                  f"ロス率 {stats['loss_rate']:.1%}, デコード失敗 {stats['decode_errors']}, "
+                  f"サブキャリア数の不一致 {stats['mismatched']}")
+            ring.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,25 @@
 import numpy as np
 from nexcsi import decoder
+import pcap_loader
 import matplotlib.pyplot as plt
+from scoring import squared_error
 
 # デバイス設定
 device = 'raspberrypi'
 
 # pcapファイルの読み込みとCSIデータの取得
-judge = decoder(device).read_pcap('pcaps/008.pcap')  # ファイル名は適宜変更
+judge = pcap_loader.read_pcap('pcaps/008.pcap')  # ファイル名は適宜変更
 judge_csi = decoder(device).unpack(judge['csi'])
 judge_amp = np.abs(judge_csi)
 
-sample = decoder(device).read_pcap('pcaps/009.pcap')
+sample = pcap_loader.read_pcap('pcaps/009.pcap')
 data = decoder(device).unpack(sample['csi'])
 data_amp = np.abs(data)
 
 judge_ave = np.average(judge_amp, axis=0)
 
 def get_squared_error(data, judge_ave=judge_ave):
-    error = []
-    for i in range(len(data)):
-        error.append(np.sum((data[i] - judge_ave)**2))
-
-    return error
+    return squared_error(data, judge_ave)
 
 error = get_squared_error(data_amp, judge_ave=judge_ave)
 error1 = get_squared_error(judge_amp, judge_ave=judge_ave)
@@ -0,0 +1,228 @@
+import numpy as np
+from reference_cache import load_profile
+from scoring import squared_error
+
+# どのクラスにも近くないときのラベル
+REJECT = 'unknown'
+
+
+class TemplateIndex:
+    """
+    ラベル付きの参照テンプレート (平均振幅ベクトル) を複数持ち、パケットや窓を分類する
+
+    各テンプレートとの二乗誤差は、テンプレートの数によらず scoring.squared_error を
+    1回呼ぶだけでまとめて求める。誤差はテンプレート (クラス) ごとの散らばり (学習時の誤差平均) で
+    割って正規化する。ただし正規化した誤差だけで比べると散らばりの大きいクラスがどのパケットも
+    引き寄せてしまうので、クラスを選ぶときは各サブキャリアを散らばりに応じた正規分布とみなした
+    負の対数尤度 (正規化した誤差 + log(散らばり)) の小さい方を選ぶ。
+
+    method='centroid' ならクラスごとにテンプレートを平均した重心の最も近いクラス、
+    method='knn' なら近い k 個のテンプレートの多数決 (同数なら近い方) を返す。
+    最も近いテンプレート (重心) の正規化した誤差が reject_ratio を超えたら REJECT を返す。
+    """
+    def __init__(self, method='centroid', k=3, reject_ratio=3.0):
+        if method not in ('centroid', 'knn'):
+            raise ValueError(f"未知の分類方法です: {method} (centroid または knn)")
+        self.method = method
+        self.k = k
+        self.reject_ratio = reject_ratio
+        self.labels = []     # テンプレートごとのラベル
+        self.sources = []    # テンプレートごとの元のpcap (分からなければ None)
+        self._means = []
+        self._scales = []
+        self._matrix = None  # 比較に使う行列 (テンプレート数 or クラス数, サブキャリア数)
+        self._matrix_scales = None
+        self._matrix_labels = None
+
+    def __len__(self):
+        return len(self.labels)
+
+    @property
+    def classes(self):
+        return list(dict.fromkeys(self.labels))
+
+    def add(self, label, mean, error_mean, source=None):
+        """
+        テンプレートを1つ追加する
+
+        Parameters:
+            label (str): クラス名 ('empty', 'standing', 'sitting', 'walking' など)
+            mean (numpy.ndarray): 平均振幅ベクトル (サブキャリア数,)
+            error_mean (float): 参照データの各パケットと mean との二乗誤差の平均
+        """
+        mean = np.asarray(mean, dtype=np.float64)
+        if self._means and mean.shape != self._means[0].shape:
+            raise ValueError(f"サブキャリア数が違います: {mean.shape} (登録済みは {self._means[0].shape})")
+        self.labels.append(label)
+        self.sources.append(source)
+        self._means.append(mean)
+        self._scales.append(max(float(error_mean), np.finfo(np.float64).tiny))
+        self._matrix = None
+        return self
+
+    def add_pcap(self, label, pcap_path, device='raspberrypi'):
+        """
+        pcapファイルの参照プロファイル (キャッシュ済みなら読むだけ) をテンプレートとして追加する
+        """
+        profile = load_profile(pcap_path, device)
+        return self.add(label, profile.mean, profile.error_mean, source=pcap_path)
+
+    @classmethod
+    def from_profiles(cls, references, device='raspberrypi', **kwargs):
+        """
+        {ラベル: [pcapファイル, ...]} から参照プロファイルを読み込んで作る
+        """
+        index = cls(**kwargs)
+        for label, pcap_paths in references.items():
+            if isinstance(pcap_paths, str):
+                pcap_paths = [pcap_paths]
+            for pcap_path in pcap_paths:
+                index.add_pcap(label, pcap_path, device)
+        return index
+
+    def _build(self):
+        # 比較に使う行列は追加のたびに作り直さず、分類するときに1回だけ作る
+        means = np.array(self._means)
+        scales = np.array(self._scales)
+        if self.method == 'centroid':
+            labels = self.classes
+            members = [np.array([l == label for l in self.labels]) for label in labels]
+            centroids = np.array([means[m].mean(axis=0) for m in members])
+            # 重心からの誤差の平均 = 各テンプレート内の誤差平均 + テンプレートの重心からのずれ
+            scales = np.array([np.mean(scales[m] + squared_error(means[m], c)) for m, c in zip(members, centroids)])
+            means = centroids
+        else:
+            labels = list(self.labels)
+        self._matrix = means
+        self._matrix_scales = scales
+        self._matrix_labels = np.array(labels, dtype=object)
+
+    def distances(self, data):
+        """
+        各パケットと各テンプレート (centroid なら各クラスの重心) との正規化した二乗誤差
+        (パケット数, テンプレート数) を返す。1次元で渡すと (テンプレート数,)
+        """
+        if not self.labels:
+            raise ValueError("テンプレートが登録されていません")
+        if self._matrix is None:
+            self._build()
+        return squared_error(data, self._matrix) / self._matrix_scales
+
+    def classify(self, data, return_distance=False):
+        """
+        パケット (サブキャリア数,) ならラベルを1つ、(パケット数, サブキャリア数) ならラベルの配列を返す
+        return_distance=True なら最も近いテンプレートの正規化した誤差も返す
+        """
+        distances = self.distances(data)
+        single = distances.ndim == 1
+        distances = np.atleast_2d(distances)
+        # 散らばりで正規化した誤差に、散らばりの大きさの分の罰則を足して比べる
+        scores = distances + np.log(self._matrix_scales)
+        rows = np.arange(len(distances))
+        nearest = np.argmin(scores, axis=1)
+        best = distances[rows, nearest]
+
+        if self.method == 'centroid' or self.k <= 1:
+            labels = self._matrix_labels[nearest]
+        else:
+            labels = self._vote(scores, nearest)
+        labels = np.where(best > self.reject_ratio, REJECT, labels)
+
+        if single:
+            labels, best = labels[0], best[0]
+        return (labels, best) if return_distance else labels
+
+    def _vote(self, scores, nearest):
+        k = min(self.k, scores.shape[1])
+        neighbours = np.argpartition(scores, k - 1, axis=1)[:, :k]
+        classes = self.classes
+        class_ids = np.array([classes.index(label) for label in self._matrix_labels])
+        votes = np.zeros((len(scores), len(classes)))
+        np.add.at(votes, (np.arange(len(scores))[:, np.newaxis], class_ids[neighbours]), 1)
+        # 同数なら最も近いテンプレートのクラスを優先する
+        votes[np.arange(len(scores)), class_ids[nearest]] += 0.5
+        return np.array(classes, dtype=object)[np.argmax(votes, axis=1)]
+
+    def classify_window(self, frames, return_distance=False):
+        """
+        窓 (パケット数, サブキャリア数) の平均振幅を1つのパケットとして分類する
+        """
+        return self.classify(np.mean(np.asarray(frames, dtype=np.float64), axis=0), return_distance)
+
+    def check(self, labelled, load=None):
+        """
+        ラベルの分かっている評価用pcap (参照に使っていないもの) が正しいクラスに分類されるかを確かめる
+
+        Parameters:
+            labelled (dict): {ラベル: [pcapファイル, ...]}
+            load: pcapファイルから振幅 (パケット数, サブキャリア数) を返す関数
+
+        Returns:
+            [(pcapファイル, 正解ラベル, 最も多かったラベル, その割合)]
+        """
+        if load is None:
+            from dataset import load_recording
+            load = lambda path: np.abs(load_recording(path).csi)
+        results = []
+        for expected, pcap_paths in labelled.items():
+            for pcap_path in pcap_paths:
+                if pcap_path in self.sources:
+                    raise ValueError(f"参照に使ったpcapは評価に使えません: {pcap_path}")
+                labels, counts = np.unique(self.classify(load(pcap_path)), return_counts=True)
+                majority = int(np.argmax(counts))
+                results.append((pcap_path, expected, str(labels[majority]), counts[majority] / counts.sum()))
+        return results
+
+
+def parse_references(items):
+    """
+    ['standing=pcaps/101.pcap,pcaps/102.pcap', 'sitting=pcaps/001.pcap'] を
+    {ラベル: [pcapファイル, ...]} にする
+    """
+    references = {}
+    for item in items:
+        label, sep, paths = item.partition('=')
+        if not sep or not paths:
+            raise ValueError(f"ラベル=pcap の形式で指定してください: {item}")
+        references.setdefault(label, []).extend(p for p in paths.split(',') if p)
+    return references
+
+
+if __name__ == "__main__":
+    # 参照pcapからテンプレートを作り、評価用pcapの各パケットの分類結果を集計する
+    # 評価用pcapを ラベル=pcap で指定すると、正しいクラスに分類されたかも確かめる
+    import sys
+    import argparse
+    from collections import Counter
+    from dataset import load_recording
+
+    parser = argparse.ArgumentParser(description='ラベル付きの参照pcapでパケットを分類する')
+    parser.add_argument('references', nargs='+', help="ラベル=pcap[,pcap...] (例: standing=pcaps/101.pcap)")
+    parser.add_argument('-e', '--evaluate', nargs='+', required=True,
+                        help='分類するpcapファイル (ラベル=pcap[,pcap...] なら正解と比べる)')
+    parser.add_argument('-m', '--method', choices=['centroid', 'knn'], default='centroid')
+    parser.add_argument('-k', type=int, default=3, help='knn の近傍数')
+    parser.add_argument('-r', '--reject-ratio', type=float, default=3.0,
+                        help='学習時の誤差平均の何倍を超えたら分類しないか')
+    parser.add_argument('--check', action='store_true',
+                        help='ラベル付きの評価用pcapの多数決が正解と違えば終了コード1で終わる')
+    args = parser.parse_args()
+
+    index = TemplateIndex.from_profiles(parse_references(args.references), method=args.method,
+                                        k=args.k, reject_ratio=args.reject_ratio)
+    print(f"テンプレート {len(index)} 件, クラス {index.classes}")
+    unlabelled = [item for item in args.evaluate if '=' not in item]
+    for pcap_file in unlabelled:
+        labels = index.classify(np.abs(load_recording(pcap_file).csi))
+        counts = Counter(labels.tolist())
+        print(f"{pcap_file}: " + ", ".join(f"{label} {n}" for label, n in counts.most_common()))
+
+    results = index.check(parse_references([item for item in args.evaluate if '=' in item]))
+    for pcap_file, expected, label, fraction in results:
+        mark = 'o' if label == expected else 'x'
+        print(f"{pcap_file}: 正解 {expected} / 分類 {label} ({fraction:.0%}) {mark}")
+    if results:
+        correct = sum(label == expected for _, expected, label, _ in results)
+        print(f"正解 {correct}/{len(results)} ファイル")
+        if args.check and correct < len(results):
+            sys.exit(1)